@@ -1,7 +1,10 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sock import Sock, ConnectionClosed
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.exc import OperationalError
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
 from datetime import datetime, timedelta
 from io import BytesIO
 import base64
@@ -10,8 +13,19 @@ import os
 import hashlib
 import secrets
 import threading
+import queue
+from collections import OrderedDict, namedtuple
 import time
+import atexit
+import zlib
 from cryptography.fernet import Fernet
+from cache_backends import make_cache_backend, FragmentCache, BlobCache
+from push_dispatcher import PushDispatcher
+import message_search
+import message_partitions
+import image_variants
+from chat_uploads import UploadStore, UploadError, clean_extension
+from compression import CompressionMiddleware
 try:
     from pywebpush import webpush, WebPushException
     PUSH_AVAILABLE = True
@@ -25,6 +39,8 @@ from markupsafe import Markup, escape
 import re
 from werkzeug.utils import secure_filename
 import requests
+import mimetypes
+from urllib.parse import quote
 
 app = Flask(__name__)
 # Use stable secret from env if provided to persist sessions across restarts
@@ -38,6 +54,21 @@ ALLOWED_EXTENSIONS = { 'png', 'jpg', 'jpeg', 'gif', 'webp' }
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# gzip (brotli when the package is installed) for HTML/JSON/JS responses; see compression.py
+app.config['COMPRESSION'] = os.environ.get('COMPRESSION', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 512))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+compression = None
+if app.config['COMPRESSION']:
+    compression = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        gzip_level=app.config['COMPRESS_GZIP_LEVEL'],
+        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY']
+    )
+    app.wsgi_app = compression
+
 @app.route('/favicon.ico')
 def favicon():
     images_dir = os.path.join(app.static_folder, 'images')
@@ -117,6 +148,7 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 }
 
 db = SQLAlchemy(app)
+sock = Sock(app)
 
 # Database migration will be handled by build command
 
@@ -124,21 +156,326 @@ db = SQLAlchemy(app)
 ENCRYPTION_KEY = Fernet.generate_key()
 cipher_suite = Fernet(ENCRYPTION_KEY)
 
-# Ultra-fast message cache with threading
-message_cache = {}
-cache_lock = threading.Lock()
-user_sessions = {}
-session_lock = threading.Lock()
+# Ultra-fast message cache, read receipts and presence sessions.
+# memory = per-process; sqlite / redis share state between gunicorn workers.
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_SQLITE_PATH'] = os.environ.get('CACHE_SQLITE_PATH')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL') or os.environ.get('REDIS_URL')
+app.config['MESSAGE_CACHE_MAX_ENTRIES'] = int(os.environ.get('MESSAGE_CACHE_MAX_ENTRIES', 50000))
+app.config['MESSAGE_CACHE_PER_CONVERSATION'] = int(os.environ.get('MESSAGE_CACHE_PER_CONVERSATION', 500))
+cache_backend = make_cache_backend(app.config)
+# Encoded JSON per message, shared by every endpoint that returns messages
+app.config['MESSAGE_FRAGMENT_CACHE_ENTRIES'] = int(os.environ.get('MESSAGE_FRAGMENT_CACHE_ENTRIES', 20000))
+message_fragments = FragmentCache(app.config['MESSAGE_FRAGMENT_CACHE_ENTRIES'])
+# Decoded avatar bytes (originals and size variants) keyed by content hash, within a byte budget
+app.config['AVATAR_CACHE_BYTES'] = int(os.environ.get('AVATAR_CACHE_BYTES', 32 * 1024 * 1024))
+avatar_blobs = BlobCache(app.config['AVATAR_CACHE_BYTES'])
+# Downscaled previews of chat photos, made in worker processes; see image_variants.PreviewPool
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['THUMBNAIL_TIMEOUT'] = float(os.environ.get('THUMBNAIL_TIMEOUT', 10))
+app.config['PREVIEW_MAX_SIDE'] = int(os.environ.get('PREVIEW_MAX_SIDE', image_variants.PREVIEW_MAX_SIDE))
+chat_previews = image_variants.PreviewPool(
+    workers=app.config['THUMBNAIL_WORKERS'] if image_variants.IMAGING_AVAILABLE else 0,
+    timeout=app.config['THUMBNAIL_TIMEOUT'],
+    max_side=app.config['PREVIEW_MAX_SIDE']
+)
+atexit.register(chat_previews.shutdown)
+# Chat attachments: chunked and resumable, stored once per sha256; see chat_uploads.py
+app.config['CHAT_UPLOAD_MAX_BYTES'] = int(os.environ.get('CHAT_UPLOAD_MAX_BYTES', 50 * 1024 * 1024))
+# Must stay under MAX_CONTENT_LENGTH, which still caps every single request
+app.config['CHAT_UPLOAD_CHUNK_BYTES'] = int(os.environ.get('CHAT_UPLOAD_CHUNK_BYTES', 1024 * 1024))
+app.config['CHAT_UPLOAD_TTL'] = int(os.environ.get('CHAT_UPLOAD_TTL', 24 * 3600))
+chat_uploads = UploadStore(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'chat'),
+    max_bytes=app.config['CHAT_UPLOAD_MAX_BYTES'],
+    ttl=app.config['CHAT_UPLOAD_TTL']
+)
 # (Legacy in-memory kept but unused for Render reliability)
 typing_status = {}
 typing_lock = threading.Lock()
-_read_receipts = {}
-read_receipts_lock = threading.Lock()
 
 # Helper: normalize typing key consistently as strings
 def _typing_key(chat_session_id, user_id):
     return (str(chat_session_id), str(user_id))
 
+class ChannelHub:
+    """In-process fan-out of JSON events to WebSocket subscribers, keyed by chat_session_id"""
+
+    def __init__(self, max_backlog=256):
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._max_backlog = max_backlog
+
+    def subscribe(self, key):
+        q = queue.Queue(maxsize=self._max_backlog)
+        with self._lock:
+            self._channels.setdefault(key, set()).add(q)
+        return q
+
+    def unsubscribe(self, key, q):
+        with self._lock:
+            subs = self._channels.get(key)
+            if subs is not None:
+                subs.discard(q)
+                if not subs:
+                    del self._channels[key]
+
+    def publish(self, key, payload, exclude=None):
+        data = json.dumps(payload)
+        with self._lock:
+            subs = [q for q in self._channels.get(key, ()) if q is not exclude]
+        for q in subs:
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                # Slow consumer: drop the event, the client catches up by polling
+                pass
+        return len(subs)
+
+    def subscriber_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._channels.get(key, ()))
+            return sum(len(subs) for subs in self._channels.values())
+
+class MessageWaiters:
+    """Wake-up events for long-polling readers, keyed by chat_session_id.
+    A notify() wakes every reader parked on that conversation and retires the event."""
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def prepare(self, key):
+        with self._lock:
+            evt = self._events.get(key)
+            if evt is None:
+                evt = self._events[key] = threading.Event()
+            return evt
+
+    def notify(self, key):
+        with self._lock:
+            evt = self._events.pop(key, None)
+        if evt is not None:
+            evt.set()
+
+    def waiting_count(self):
+        with self._lock:
+            return len(self._events)
+
+# Long-poll wake-ups for /api/messages/<id>/latest?wait=N (per process)
+message_waiters = MessageWaiters()
+_LONG_POLL_MAX_WAIT_S = 25
+# Most messages one /latest?since_id= call returns; the client pages forward with the cursor
+_LATEST_MAX_BATCH = 200
+_SSE_MAX_STREAM_S = 300
+
+class ReadMarker:
+    """Write-behind for messages.is_read.
+    Request handlers queue ids (or a whole sender->receiver direction) and a
+    background thread applies them in one UPDATE every flush_ms or max_batch ids."""
+
+    def __init__(self, flush_ms=250, max_batch=200):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_batch = max_batch
+        self._ids = set()
+        self._pairs = {}
+        self._recount = set()  # (reader_id, chat_session_id) summaries to refresh
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.flushes = 0
+        self.rows_marked = 0
+
+    def mark_ids(self, ids, reader_id=None, chat_session_id=None):
+        with self._cond:
+            self._ids.update(ids)
+            if reader_id is not None:
+                self._recount.add((reader_id, chat_session_id))
+            self._ensure_thread()
+            if len(self._ids) >= self.max_batch:
+                self._cond.notify()
+
+    def mark_pair(self, sender_id, receiver_id, chat_session_id=None):
+        """Mark everything sender_id sent to receiver_id as read"""
+        # Bounded by time so messages sent after this call stay unread
+        with self._cond:
+            self._pairs[(sender_id, receiver_id)] = datetime.utcnow()
+            if chat_session_id is not None:
+                self._recount.add((receiver_id, chat_session_id))
+            self._ensure_thread()
+
+    def is_pending(self, msg_id):
+        with self._cond:
+            return msg_id in self._ids
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._ids) + len(self._pairs)
+
+    def has_pending(self, chat_session_id):
+        """True while reads queued for this conversation haven't been written yet"""
+        with self._cond:
+            return any(chat == chat_session_id for _, chat in self._recount)
+
+    def _ensure_thread(self):
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, name='read-marker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self._ids) < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            ids, pairs, recount = self._ids, self._pairs, self._recount
+            self._ids, self._pairs, self._recount = set(), {}, set()
+        if not ids and not pairs:
+            return 0
+        clauses = []
+        if ids:
+            clauses.append(Message.id.in_(ids))
+        for (sender_id, receiver_id), cutoff in pairs.items():
+            clauses.append(db.and_(Message.sender_id == sender_id, Message.receiver_id == receiver_id, Message.timestamp <= cutoff))
+        with app.app_context():
+            try:
+                result = db.session.execute(
+                    db.update(Message)
+                    .where(Message.is_read == False, db.or_(*clauses))
+                    .values(is_read=True)
+                    .execution_options(synchronize_session=False)
+                )
+                # Same transaction: the readers' list badges come from the rows just updated
+                for reader_id, chat_session_id in recount:
+                    _recount_summary_unread(reader_id, chat_session_id)
+                db.session.commit()
+                self.flushes += 1
+                self.rows_marked += result.rowcount or 0
+                return result.rowcount or 0
+            except Exception as e:
+                db.session.rollback()
+                print(f"Read marker flush failed, retrying next cycle: {e}")
+                with self._cond:
+                    self._ids |= ids
+                    self._recount |= recount
+                    for pair, cutoff in pairs.items():
+                        self._pairs[pair] = max(cutoff, self._pairs.get(pair, cutoff))
+                return 0
+            finally:
+                db.session.remove()
+
+    def stop(self):
+        """Stop the worker and write out whatever is still queued"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+app.config['READ_MARKER_FLUSH_MS'] = int(os.environ.get('READ_MARKER_FLUSH_MS', 250))
+app.config['READ_MARKER_MAX_BATCH'] = int(os.environ.get('READ_MARKER_MAX_BATCH', 200))
+read_marker = ReadMarker(app.config['READ_MARKER_FLUSH_MS'], app.config['READ_MARKER_MAX_BATCH'])
+# Gunicorn workers exit through sys.exit on graceful shutdown, which runs atexit
+atexit.register(read_marker.stop)
+
+FriendLink = namedtuple('FriendLink', 'chat_session_id friendship_ids')
+
+class FriendshipIndex:
+    """(min_id, max_id) -> FriendLink for the per-request "are these two friends" check.
+    Positive entries live ttl_s, negative ones negative_ttl_s (another worker may
+    have just accepted the request); handle_friend_request and delete_account
+    invalidate explicitly."""
+
+    def __init__(self, ttl_s=300, negative_ttl_s=10, max_entries=50000):
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, a, b):
+        key = (min(a, b), max(a, b))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        link = self._load(*key)
+        with self._lock:
+            self._data[key] = (now + (self.ttl_s if link else self.negative_ttl_s), link)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return link
+
+    @staticmethod
+    def _load(a, b):
+        # Both directions in one index-friendly lookup on unique (user_id, friend_id)
+        rows = db.session.query(Friendship.id, Friendship.chat_session_id, ChatSession.id).outerjoin(
+            ChatSession, ChatSession.id == Friendship.chat_session_id
+        ).filter(
+            Friendship.user_id.in_((a, b)),
+            Friendship.friend_id.in_((a, b)),
+            Friendship.user_id != Friendship.friend_id
+        ).order_by(Friendship.id).all()
+        if not rows:
+            return None
+        # Each direction has its own row and chat_session_id; the conversation's id is
+        # the one with a chat_sessions row (the first friendship created); older messages filed
+        # under the other id are moved by migrate_chat_sessions.py
+        canonical = next((r[1] for r in rows if r[2] is not None), rows[0][1])
+        return FriendLink(canonical, tuple(r[0] for r in rows))
+
+    def invalidate(self, a, b=None):
+        """Forget one pair, or every pair involving a when b is None"""
+        with self._lock:
+            if b is not None:
+                self._data.pop((min(a, b), max(a, b)), None)
+                return
+            for key in [k for k in self._data if a in k]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {'pairs': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+friendship_index = FriendshipIndex()
+
+def get_friend_link(user_id, other_id):
+    """FriendLink for two users, or None if they aren't friends (or other_id isn't an id)"""
+    try:
+        other_id = int(other_id)
+    except (TypeError, ValueError):
+        return None
+    return friendship_index.get(int(user_id), other_id)
+
+# Live message push per conversation (see /ws/messages/<chat_session_id>)
+message_hub = ChannelHub()
+# Typing relay between the two participants (see /ws/typing/<chat_session_id>)
+typing_hub = ChannelHub(max_backlog=32)
+# Read receipt events for the SSE stream (see /api/messages/<id>/read-receipts/stream)
+receipt_hub = ChannelHub()
+
+# Request / query counters for load testing (see /api/debug/stats)
+_request_stats = {'requests': 0, 'queries': 0, 'started_at': time.time()}
+_request_stats_lock = threading.Lock()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    with _request_stats_lock:
+        _request_stats['queries'] += 1
+
 # Enhanced Database Models with optimized structure
 class User(db.Model):
     __tablename__ = 'users'
@@ -158,6 +495,8 @@ class User(db.Model):
     private_key_encrypted = db.Column(db.Text)  # Encrypted private key
     is_active = db.Column(db.Boolean, default=True, index=True)
     last_login = db.Column(db.DateTime)
+    # Bumped whenever this user's posts change in a way the feed shows; see _feed_version
+    feed_version = db.Column(db.Integer, default=0, nullable=False)
     
     # Relationships
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy='dynamic')
@@ -277,6 +616,7 @@ class Message(db.Model):
     # Indexes for better performance
     __table_args__ = (
         db.Index('idx_chat_session_timestamp', 'chat_session_id', 'timestamp'),
+        db.Index('idx_chat_session_id', 'chat_session_id', 'id'),
         db.Index('idx_sender_receiver', 'sender_id', 'receiver_id'),
         db.Index('idx_unread_messages', 'receiver_id', 'is_read', 'timestamp'),
     )
@@ -316,6 +656,25 @@ class ChatSession(db.Model):
         db.Index('idx_last_message', 'last_message_at'),
     )
 
+class ConversationSummary(db.Model):
+    """One row per (user, conversation) for the messaging list, kept current by
+    send_direct_message and the read marker so the list is a single query."""
+    __tablename__ = 'conversation_summaries'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    chat_session_id = db.Column(db.String(64), primary_key=True)
+    friend_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_preview = db.Column(db.String(100), nullable=True)
+    last_message_type = db.Column(db.String(20), nullable=True)
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.Index('idx_summary_user_activity', 'user_id', 'last_message_at'),
+    )
+
 class MessageReaction(db.Model):
     __tablename__ = 'message_reactions'
     
@@ -338,7 +697,18 @@ class Avatar(db.Model):
     __tablename__ = 'avatars'
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
     mime_type = db.Column(db.String(50), nullable=False)
-    data_b64 = db.Column(db.Text, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=True)  # the uploaded image (bytea)
+    data_b64 = db.Column(db.Text, nullable=True)  # legacy base64 copy, only until the row is migrated
+    content_hash = db.Column(db.String(64), nullable=True)  # sha256 of the image: its version, ETag and URL key
+
+class AvatarVariant(db.Model):
+    """Square resized copies of an avatar (image_variants.AVATAR_SIZES)"""
+    __tablename__ = 'avatar_variants'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    size = db.Column(db.Integer, primary_key=True)
+    source_hash = db.Column(db.String(64), nullable=False)  # Avatar.content_hash it was made from
+    mime_type = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
 
 class PushSubscription(db.Model):
     __tablename__ = 'push_subscriptions'
@@ -517,12 +887,7 @@ def login():
             user.last_login = datetime.utcnow()
             
             # Store user session for fast access
-            with session_lock:
-                user_sessions[user.id] = {
-                    'last_activity': time.time(),
-                    'public_key': user.public_key,
-                    'is_online': True
-                }
+            cache_backend.touch_session(user.id, public_key=user.public_key, is_online=True)
             
             db.session.commit()
             
@@ -543,9 +908,7 @@ def logout():
             db.session.commit()
         
         # Remove from active sessions
-        with session_lock:
-            if session['user_id'] in user_sessions:
-                del user_sessions[session['user_id']]
+        cache_backend.remove_session(session['user_id'])
     
     session.clear()
     flash('You have been logged out.', 'info')
@@ -615,126 +978,190 @@ def _format_short_time(dt):
     except Exception:
         return ''
 
+def _recount_summary_unread(reader_id, chat_session_id):
+    """Set a summary's unread_count from the messages table (caller commits)"""
+    unread = db.session.query(db.func.count(Message.id)).filter(
+        Message.chat_session_id == chat_session_id,
+        Message.receiver_id == reader_id,
+        Message.is_read == False
+    ).scalar_subquery()
+    db.session.execute(
+        db.update(ConversationSummary)
+        .where(ConversationSummary.user_id == reader_id, ConversationSummary.chat_session_id == chat_session_id)
+        .values(unread_count=unread)
+        .execution_options(synchronize_session=False)
+    )
+
+def _summarize_sent_message(chat_session_id, sender_id, receiver_id, message_id, content, message_type, sent_at):
+    """Advance both participants' summaries in one UPDATE (caller commits).
+    Rows missing for older conversations are created on the spot."""
+    values = {
+        'last_message_id': message_id,
+        'last_sender_id': sender_id,
+        'last_preview': content[:100],
+        'last_message_type': message_type,
+        'last_message_at': sent_at
+    }
+    result = db.session.execute(
+        db.update(ConversationSummary)
+        .where(ConversationSummary.chat_session_id == chat_session_id)
+        .values(
+            unread_count=db.case((ConversationSummary.user_id == receiver_id, ConversationSummary.unread_count + 1), else_=0),
+            **values
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount >= 2:
+        return
+    have = {uid for (uid,) in db.session.query(ConversationSummary.user_id).filter_by(chat_session_id=chat_session_id)}
+    for uid, friend_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+        if uid in have:
+            continue
+        unread = 0
+        if uid == receiver_id:
+            unread = Message.query.filter_by(chat_session_id=chat_session_id, receiver_id=uid, is_read=False).count()
+        db.session.add(ConversationSummary(user_id=uid, chat_session_id=chat_session_id, friend_id=friend_id,
+                                           unread_count=unread, **values))
+
+# conversation_summaries.unread_count is the one unread counter. Send and the read
+# marker keep it exact; this sweep repairs anything that drifts (crashes between
+# flushes, manual SQL, rows written by older code).
+app.config['UNREAD_RECONCILE_INTERVAL_S'] = int(os.environ.get('UNREAD_RECONCILE_INTERVAL_S', 600))
+app.config['UNREAD_RECONCILE_BATCH'] = int(os.environ.get('UNREAD_RECONCILE_BATCH', 500))
+_reconcile_stats = {'runs': 0, 'checked': 0, 'corrected': 0, 'last_run_at': None, 'last_checked': 0, 'last_corrected': 0}
+_reconcile_cursor = [None]
+
+def reconcile_unread_counts(batch_size=500, max_batches=20):
+    """Recount unread_count for up to batch_size * max_batches summaries, in key order,
+    resuming where the previous run stopped. Returns (checked, corrected)."""
+    # Don't count reads that are only waiting for the write-behind flush as drift
+    read_marker.flush()
+    actual = db.select(db.func.count(Message.id)).where(
+        Message.chat_session_id == ConversationSummary.chat_session_id,
+        Message.receiver_id == ConversationSummary.user_id,
+        Message.is_read == False
+    ).scalar_subquery()
+    key = db.tuple_(ConversationSummary.user_id, ConversationSummary.chat_session_id)
+    checked = corrected = 0
+    cursor = _reconcile_cursor[0]
+    for _ in range(max_batches):
+        q = db.session.query(ConversationSummary.user_id, ConversationSummary.chat_session_id)
+        if cursor is not None:
+            q = q.filter(key > db.tuple_(*cursor))
+        keys = [tuple(k) for k in q.order_by(ConversationSummary.user_id, ConversationSummary.chat_session_id).limit(batch_size)]
+        if keys:
+            # Only rows whose stored count is wrong are written (and counted)
+            result = db.session.execute(
+                db.update(ConversationSummary)
+                .where(key.in_(keys), ConversationSummary.unread_count != actual)
+                .values(unread_count=actual)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            checked += len(keys)
+            corrected += result.rowcount or 0
+        if len(keys) < batch_size:
+            cursor = None  # wrapped around; next run starts from the top
+            break
+        cursor = keys[-1]
+    _reconcile_cursor[0] = cursor
+    _reconcile_stats['runs'] += 1
+    _reconcile_stats['checked'] += checked
+    _reconcile_stats['corrected'] += corrected
+    _reconcile_stats['last_checked'] = checked
+    _reconcile_stats['last_corrected'] = corrected
+    _reconcile_stats['last_run_at'] = datetime.utcnow().isoformat()
+    return checked, corrected
+
+def unread_reconciler():
+    while True:
+        time.sleep(app.config['UNREAD_RECONCILE_INTERVAL_S'])
+        with app.app_context():
+            try:
+                checked, corrected = reconcile_unread_counts(app.config['UNREAD_RECONCILE_BATCH'])
+                if corrected:
+                    print(f"Unread reconciler: corrected {corrected} of {checked} conversation summaries")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Unread reconciler failed: {e}")
+            finally:
+                db.session.remove()
+
+def _conversation_preview(summary, user_id):
+    """(last_text, preview, unread_badge) for a ConversationSummary row, as the messaging list shows them"""
+    last_text = ''
+    raw = (summary.last_preview or '').strip()
+    if summary.last_message_id:
+        prefix = 'You: ' if summary.last_sender_id == user_id else ''
+        if summary.last_message_type and summary.last_message_type != 'text' and not raw:
+            raw = summary.last_message_type.capitalize()
+        text = (raw[:48] + '…') if len(raw) > 49 else raw
+        last_text = f"{prefix}{text}"
+    unread = summary.unread_count or 0
+
+    # Build user-friendly preview per requirements
+    if unread == 0:
+        # No unread: show the actual last sent/received text
+        preview = last_text or 'Start the chat'
+    elif unread == 1:
+        # Exactly one unread: it is the last message (replying marks incoming as read)
+        if summary.last_sender_id == summary.friend_id and raw:
+            preview = (raw[:48] + '…') if len(raw) > 49 else raw
+        else:
+            preview = '1 message'
+    elif unread <= 3:
+        # 2–3 unread
+        preview = f"{unread} messages"
+    else:
+        # 4 or more unread
+        preview = '4+ texts'
+
+    # Badge text mirrors count cap
+    unread_badge = ''
+    if unread > 0:
+        unread_badge = '4+' if unread > 4 else str(unread)
+    return last_text, preview, unread_badge
+
 def get_user_conversations(user_id):
-    """Return list of conversations for messaging list.
+    """Return list of conversations for messaging list, newest activity first.
     Each item: { id, username, first_name, profile_picture, is_online, last_text, last_ts,
                  time_label, unread_count, chat_url }
+    One indexed query over conversation_summaries (see _summarize_sent_message).
     """
     out = []
     try:
-        friendships = Friendship.query.filter_by(user_id=user_id).all()
+        rows = db.session.query(ConversationSummary, User).join(
+            User, User.id == ConversationSummary.friend_id
+        ).filter(
+            ConversationSummary.user_id == user_id
+        ).order_by(ConversationSummary.last_message_at.desc()).all()
     except Exception as e:
         # Database connection error - return empty list gracefully
-        print(f"Error fetching friendships: {e}")
+        print(f"Error fetching conversations: {e}")
         return []
     
-    for fr in friendships:
-        try:
-            friend = User.query.get(fr.friend_id)
-            if not friend:
-                continue
-            
-            chat_session = None
-            try:
-                chat_session = ChatSession.query.get(fr.chat_session_id)
-            except Exception:
-                pass  # Chat session might not exist yet
-            
-            last_message = None
-            try:
-                if chat_session and chat_session.last_message_id:
-                    last_message = Message.query.get(chat_session.last_message_id)
-                if not last_message:
-                    # fallback: query the latest message by timestamp for this session
-                    last_message = Message.query.filter_by(chat_session_id=fr.chat_session_id)\
-                        .order_by(Message.timestamp.desc()).first()
-            except Exception:
-                pass  # Skip if message query fails
-            
-            last_text = ''
-            last_ts = fr.last_message_at
-            if last_message:
-                prefix = 'You: ' if last_message.sender_id == user_id else ''
-                raw = (last_message.content or '').strip()
-                if last_message.message_type != 'text' and not raw:
-                    raw = last_message.message_type.capitalize()
-                text = (raw[:48] + '…') if len(raw) > 49 else raw
-                last_text = f"{prefix}{text}"
-                last_ts = last_message.timestamp or last_ts
-            
-            # Compute accurate unread count from messages table (receiver == me)
-            unread = 0
-            try:
-                unread = Message.query.filter_by(chat_session_id=fr.chat_session_id, receiver_id=user_id, is_read=False).count()
-            except Exception:
-                # fallback to stored counters if something goes wrong
-                try:
-                    if chat_session:
-                        if user_id == chat_session.user1_id:
-                            unread = chat_session.unread_count_user1 or 0
-                        else:
-                            unread = chat_session.unread_count_user2 or 0
-                    else:
-                        unread = fr.unread_count or 0
-                except Exception:
-                    unread = 0
-
-            # Build user-friendly preview per requirements
-            if unread == 0:
-                # No unread: show the actual last sent/received text
-                preview = last_text or 'Start the chat'
-            elif unread == 1:
-                # Exactly one unread: show the most recent unread incoming text
-                try:
-                    one_unread = Message.query\
-                        .filter_by(chat_session_id=fr.chat_session_id, receiver_id=user_id, is_read=False)\
-                        .order_by(Message.timestamp.desc())\
-                        .first()
-                    if one_unread:
-                        rawp = (one_unread.content or '').strip()
-                        preview = (rawp[:48] + '…') if len(rawp) > 49 else rawp
-                    else:
-                        preview = '1 message'
-                except Exception:
-                    preview = '1 message'
-            elif unread <= 3:
-                # 2–3 unread
-                preview = f"{unread} messages"
-            else:
-                # 4 or more unread
-                preview = '4+ texts'
-
-            # Badge text mirrors count cap
-            unread_badge = ''
-            if unread > 0:
-                unread_badge = '4+' if unread > 4 else str(unread)
-            
-            out.append({
-                'id': friend.id,
-                'username': friend.username,
-                'first_name': friend.first_name,
-                'profile_picture': friend.profile_picture,
-                'is_online': friend.is_online,
-                'last_text': last_text,
-                'preview': preview,
-                'last_ts': last_ts,
-                'time_label': _format_short_time(last_ts) if last_ts else '',
-                'unread_count': int(unread) if unread else 0,
-                'unread_badge': unread_badge,
-                'chat_url': url_for('direct_chat', user_id=friend.id)
-            })
-        except Exception as e:
-            # Skip this conversation if there's an error processing it
-            print(f"Error processing conversation with friend_id {fr.friend_id}: {e}")
-            continue
-    
-    # Sort by last activity desc
-    try:
-        out.sort(key=lambda x: x.get('last_ts') or datetime.min, reverse=True)
-    except Exception:
-        pass  # If sorting fails, return unsorted list
+    for summary, friend in rows:
+        last_text, preview, unread_badge = _conversation_preview(summary, user_id)
+        last_ts = summary.last_message_at
+        unread = summary.unread_count or 0
+        
+        out.append({
+            'id': friend.id,
+            'username': friend.username,
+            'first_name': friend.first_name,
+            'profile_picture': sized_avatar_url(friend.profile_picture, 96),
+            'is_online': friend.is_online,
+            'last_text': last_text,
+            'preview': preview,
+            'last_ts': last_ts,
+            'time_label': _format_short_time(last_ts) if last_ts else '',
+            'unread_count': int(unread),
+            'unread_badge': unread_badge,
+            'chat_url': url_for('direct_chat', user_id=friend.id)
+        })
     
     return out
+
 @app.route('/messaging')
 def messaging():
     if 'user_id' not in session:
@@ -1035,19 +1462,27 @@ def upload_profile_picture():
         return jsonify({'error': 'No selected file'}), 400
     if not _allowed_file(file.filename):
         return jsonify({'error': 'Invalid file type'}), 400
-    # Read file bytes and store in DB (base64) for persistence across restarts
+    # Read file bytes and store in DB (bytea) for persistence across restarts
     blob = file.read()
     mime = file.mimetype or 'image/png'
-    encoded = base64.b64encode(blob).decode('ascii')
+    content_hash = hashlib.sha256(blob).hexdigest()
+    # List views link the small variants, so make them now rather than on first view
+    try:
+        variants = _make_avatar_variants(blob)
+    except ValueError:
+        return jsonify({'error': 'Invalid image'}), 400
     # Upsert avatar
     existing = Avatar.query.filter_by(user_id=session['user_id']).first()
     if existing:
         existing.mime_type = mime
-        existing.data_b64 = encoded
+        existing.data = blob
+        existing.data_b64 = None
+        existing.content_hash = content_hash
     else:
-        db.session.add(Avatar(user_id=session['user_id'], mime_type=mime, data_b64=encoded))
-    # Point profile_picture to served endpoint
-    rel_path = url_for('get_avatar', user_id=session['user_id'])
+        db.session.add(Avatar(user_id=session['user_id'], mime_type=mime, data=blob, content_hash=content_hash))
+    _store_avatar_variants(session['user_id'], content_hash, variants)
+    # Point profile_picture at the content-hash URL, cacheable forever
+    rel_path = avatar_url(session['user_id'], content_hash)
     user = User.query.get(session['user_id'])
     profile = UserProfile.query.filter_by(user_id=session['user_id']).first()
     user.profile_picture = rel_path
@@ -1062,7 +1497,12 @@ def delete_profile_picture():
         return jsonify({'error': 'Not authenticated'}), 401
     user = User.query.get(session['user_id'])
     profile = UserProfile.query.filter_by(user_id=session['user_id']).first()
-    # Remove from DB avatar storage
+    # Remove from DB avatar storage, and from this worker's memory so the old URL stops working
+    old = db.session.query(Avatar.content_hash).filter_by(user_id=session['user_id']).first()
+    if old and old.content_hash:
+        for size in (0,) + image_variants.AVATAR_SIZES:
+            avatar_blobs.discard((session['user_id'], size, old.content_hash))
+    AvatarVariant.query.filter_by(user_id=session['user_id']).delete(synchronize_session=False)
     Avatar.query.filter_by(user_id=session['user_id']).delete(synchronize_session=False)
     user.profile_picture = None
     if profile:
@@ -1072,18 +1512,132 @@ def delete_profile_picture():
 
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
+    if filename.startswith('chat/'):
+        # Chat attachments are named by content hash (older ones by upload time) and never change;
+        # ?name= restores the name the sender uploaded for the link and the download
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=31536000,
+                                   download_name=request.args.get('name') or None)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+# Conditional GET: weak ETags built from cheap version stamps, checked before the real work
+def _version_etag(*stamp):
+    return hashlib.sha1(repr(stamp).encode()).hexdigest()[:24]
+
+def _with_etag(response, etag, cache_control='private, no-cache'):
+    # no-cache: browsers keep the body but revalidate it with If-None-Match every time
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def _not_modified(etag, cache_control='private, no-cache'):
+    """A 304 when If-None-Match already names etag, else None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return _with_etag(app.response_class(status=304), etag, cache_control)
+
+def avatar_url(user_id, version, size=None):
+    """Versioned avatar URL; ?v= changes with the image, so it can be cached forever"""
+    return url_for('get_avatar', user_id=user_id, v=version, s=size or None)
+
+# Jinja filter: {{ user.profile_picture | avatar_size(96) }}
+@app.template_filter('avatar_size')
+def sized_avatar_url(url, size):
+    """A stored profile_picture URL pointed at a size variant (other URLs pass through)"""
+    if not url or not url.startswith('/api/avatar/'):
+        return url
+    base = re.sub(r'([?&])s=\d+&?', r'\1', url).rstrip('?&')
+    return f"{base}{'&' if '?' in base else '?'}s={image_variants.nearest_size(size)}"
+
+def _make_avatar_variants(blob):
+    """{size: bytes} for a new upload; {} without Pillow. Raises ValueError for non-images."""
+    if not image_variants.IMAGING_AVAILABLE:
+        return {}
+    return image_variants.square_variants(blob)
+
+def _store_avatar_variants(user_id, source_hash, variants):
+    AvatarVariant.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    for size, data in variants.items():
+        db.session.add(AvatarVariant(user_id=user_id, size=size, source_hash=source_hash,
+                                     mime_type=image_variants.VARIANT_MIME, data=data))
+
+def _avatar_original(avatar):
+    """(mime, bytes) of the uploaded image, moving a legacy base64 row to bytea on the way"""
+    if avatar.data is None:
+        avatar.data = base64.b64decode(avatar.data_b64)
+        avatar.data_b64 = None
+        avatar.content_hash = avatar.content_hash or hashlib.sha256(avatar.data).hexdigest()
+        db.session.commit()
+    elif not avatar.content_hash:
+        avatar.content_hash = hashlib.sha256(avatar.data).hexdigest()
+        db.session.commit()
+    return avatar.mime_type, avatar.data
+
+def _avatar_bytes(user_id, size):
+    """(content_hash, mime, bytes) of the current avatar at size (0 = original), or None"""
+    if size:
+        variant = db.session.query(
+            AvatarVariant.mime_type, AvatarVariant.data, AvatarVariant.source_hash, Avatar.content_hash
+        ).join(Avatar, Avatar.user_id == AvatarVariant.user_id).filter(
+            AvatarVariant.user_id == user_id, AvatarVariant.size == size
+        ).first()
+        if variant and variant.source_hash == variant.content_hash:
+            return variant.content_hash, variant.mime_type, variant.data
+    avatar = Avatar.query.get(user_id)
+    if not avatar:
+        return None
+    mime, data = _avatar_original(avatar)
+    if size and image_variants.IMAGING_AVAILABLE:
+        # Uploaded before variants existed (or replaced mid-read): make them once, keep them
+        try:
+            variants = image_variants.square_variants(data)
+        except ValueError:
+            variants = {}
+        if variants:
+            _store_avatar_variants(user_id, avatar.content_hash, variants)
+            db.session.commit()
+            return avatar.content_hash, image_variants.VARIANT_MIME, variants[size]
+    return avatar.content_hash, mime, data
+
+_AVATAR_IMMUTABLE = 'public, max-age=31536000, immutable'
+_AVATAR_REVALIDATE = 'public, no-cache'
+
 @app.route('/api/avatar/<int:user_id>')
 def get_avatar(user_id):
-    avatar = Avatar.query.filter_by(user_id=user_id).first()
-    if not avatar:
+    """?s= picks a square variant (snapped to image_variants.AVATAR_SIZES). With ?v=<content hash>
+    of the current image the response is immutable and, once cached here, needs no DB at all;
+    without it, browsers revalidate against the hash."""
+    size = image_variants.nearest_size(request.args.get('s', 0, type=int))
+    version = request.args.get('v')
+    if version:
+        cached = avatar_blobs.get((user_id, size, version))
+        if cached:
+            return _with_etag(app.response_class(cached[1], mimetype=cached[0]), f"{version}-{size}", _AVATAR_IMMUTABLE)
+    # The stored hash answers revalidations without loading the image
+    meta = db.session.query(Avatar.content_hash).filter_by(user_id=user_id).first()
+    if not meta:
         return jsonify({'error': 'not found'}), 404
-    try:
-        raw = base64.b64decode(avatar.data_b64)
-    except Exception:
-        return jsonify({'error': 'corrupt'}), 500
-    return app.response_class(raw, mimetype=avatar.mime_type)
+    cache_control = _AVATAR_IMMUTABLE if version and version == meta.content_hash else _AVATAR_REVALIDATE
+    if meta.content_hash:
+        not_modified = _not_modified(f"{meta.content_hash}-{size}", cache_control)
+        if not_modified:
+            return not_modified
+    cached = avatar_blobs.get((user_id, size, meta.content_hash)) if meta.content_hash else None
+    if cached:
+        mime, raw = cached
+        content_hash = meta.content_hash
+    else:
+        try:
+            found = _avatar_bytes(user_id, size)
+        except Exception:
+            db.session.rollback()
+            return jsonify({'error': 'corrupt'}), 500
+        if not found:
+            return jsonify({'error': 'not found'}), 404
+        content_hash, mime, raw = found
+        avatar_blobs.put((user_id, size, content_hash), mime, raw)
+        if content_hash != version:
+            cache_control = _AVATAR_REVALIDATE
+    return _with_etag(app.response_class(raw, mimetype=mime), f"{content_hash}-{size}", cache_control)
 
 # Web Push configuration
 VAPID_PUBLIC_KEY = os.environ.get('VAPID_PUBLIC_KEY')
@@ -1091,6 +1645,57 @@ VAPID_PRIVATE_KEY = os.environ.get('VAPID_PRIVATE_KEY')
 VAPID_CLAIMS = {
     'sub': os.environ.get('VAPID_SUBJECT', 'mailto:admin@example.com')
 }
+app.config['PUSH_WORKERS'] = int(os.environ.get('PUSH_WORKERS', 4))
+app.config['PUSH_QUEUE_MAX'] = int(os.environ.get('PUSH_QUEUE_MAX', 1000))
+app.config['PUSH_TIMEOUT_S'] = float(os.environ.get('PUSH_TIMEOUT_S', 5))
+app.config['PUSH_MAX_RETRIES'] = int(os.environ.get('PUSH_MAX_RETRIES', 4))
+
+_push_http = threading.local()
+
+def _send_push(job, timeout):
+    # One keep-alive session per worker thread; pywebpush fills in aud/exp on the claims dict
+    http = getattr(_push_http, 'session', None)
+    if http is None:
+        http = _push_http.session = requests.Session()
+    webpush(
+        subscription_info=job.subscription_info(),
+        data=job.payload,
+        vapid_private_key=VAPID_PRIVATE_KEY,
+        vapid_claims=dict(VAPID_CLAIMS),
+        timeout=timeout,
+        requests_session=http
+    )
+
+def _push_targets(user_id):
+    with app.app_context():
+        try:
+            return [(s.endpoint, {'p256dh': s.p256dh, 'auth': s.auth})
+                    for s in PushSubscription.query.filter_by(user_id=user_id).all()]
+        finally:
+            db.session.remove()
+
+def _delete_push_subscription(endpoint):
+    with app.app_context():
+        try:
+            PushSubscription.query.filter_by(endpoint=endpoint).delete(synchronize_session=False)
+            db.session.commit()
+            print(f"Removed expired push subscription {endpoint[:60]}")
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+# Pushes leave the request path; see push_dispatcher.py
+push_dispatcher = PushDispatcher(
+    _send_push,
+    on_expired=_delete_push_subscription,
+    resolve=_push_targets,
+    workers=app.config['PUSH_WORKERS'],
+    max_queue=app.config['PUSH_QUEUE_MAX'],
+    timeout=app.config['PUSH_TIMEOUT_S'],
+    max_retries=app.config['PUSH_MAX_RETRIES']
+)
 
 @app.route('/api/notifications/vapid-public-key')
 def vapid_public_key():
@@ -1206,12 +1811,7 @@ def send_friend_request():
         return jsonify({'error': 'Receiver ID required'}), 400
     
     # Check if already friends or request exists
-    existing_friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == receiver_id),
-            db.and_(Friendship.user_id == receiver_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    existing_friendship = get_friend_link(session['user_id'], receiver_id)
     
     if existing_friendship:
         return jsonify({'error': 'Already friends'}), 400
@@ -1261,6 +1861,10 @@ def handle_friend_request(request_id, action):
         db.session.add(friendship1)
         db.session.add(friendship2)
         db.session.add(chat_session)
+        for uid, friend_id in ((friend_request.sender_id, friend_request.receiver_id),
+                               (friend_request.receiver_id, friend_request.sender_id)):
+            db.session.add(ConversationSummary(user_id=uid, friend_id=friend_id,
+                                               chat_session_id=friendship1.chat_session_id, unread_count=0))
         
         flash('Friend request accepted!', 'success')
         
@@ -1269,6 +1873,7 @@ def handle_friend_request(request_id, action):
         flash('Friend request rejected.', 'info')
     
     db.session.commit()
+    friendship_index.invalidate(friend_request.sender_id, friend_request.receiver_id)
     return redirect(url_for('dashboard'))
 
 # Ultra-Fast Messaging System with E2E Encryption
@@ -1278,12 +1883,7 @@ def direct_chat(user_id):
         return redirect(url_for('login'))
     
     # Check if they are friends
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == user_id),
-            db.and_(Friendship.user_id == user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], user_id)
     
     if not friendship:
         flash('You can only chat with friends!', 'error')
@@ -1294,17 +1894,9 @@ def direct_chat(user_id):
     # Proactively mark any incoming messages as read when entering the chat
     try:
         if friendship:
-            Message.query.filter_by(chat_session_id=friendship.chat_session_id, receiver_id=session['user_id'], is_read=False).update({'is_read': True}, synchronize_session=False)
-            # Also reset unread counters in ChatSession for me
-            cs = ChatSession.query.get(friendship.chat_session_id)
-            if cs:
-                if session['user_id'] == cs.user1_id:
-                    cs.unread_count_user1 = 0
-                else:
-                    cs.unread_count_user2 = 0
-            db.session.commit()
+            # The read marker recounts my unread badge when it flushes
+            _mark_conversation_read(friendship.chat_session_id, user_id, session['user_id'])
     except Exception as e:
-        db.session.rollback()
         print(f"Error marking messages as read in direct_chat: {e}")
         # Continue anyway - don't block the user from viewing the chat
     # Simple online indicator based on is_online flag
@@ -1315,12 +1907,7 @@ def direct_chat(user_id):
 def clear_chat(user_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == user_id),
-            db.and_(Friendship.user_id == user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], user_id)
     if not friendship:
         return jsonify({'error': 'You can only clear chats with friends'}), 403
     # Delete messages for this chat session
@@ -1330,16 +1917,14 @@ def clear_chat(user_id):
     if chat_session:
         chat_session.last_message_at = datetime.utcnow()
         chat_session.last_message_id = None
-        chat_session.unread_count_user1 = 0
-        chat_session.unread_count_user2 = 0
-    friendship.unread_count = 0
+    ConversationSummary.query.filter_by(chat_session_id=friendship.chat_session_id).update({
+        'last_message_id': None, 'last_sender_id': None, 'last_preview': None,
+        'last_message_type': None, 'unread_count': 0
+    }, synchronize_session=False)
     # Clear cache and read receipts
     cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
-    with cache_lock:
-        if cache_key in message_cache:
-            message_cache[cache_key] = []
-    with read_receipts_lock:
-        _read_receipts.pop(friendship.chat_session_id, None)
+    cache_backend.clear_messages(cache_key)
+    cache_backend.clear_read_receipts(friendship.chat_session_id)
     db.session.commit()
     return jsonify({'message': 'Chat cleared'})
 
@@ -1367,6 +1952,8 @@ def delete_account():
     MessageReaction.query.filter_by(user_id=user_id).delete(synchronize_session=False)
     # Delete messages involving user
     Message.query.filter(db.or_(Message.sender_id == user_id, Message.receiver_id == user_id)).delete(synchronize_session=False)
+    # Delete conversation summaries on both sides
+    ConversationSummary.query.filter(db.or_(ConversationSummary.user_id == user_id, ConversationSummary.friend_id == user_id)).delete(synchronize_session=False)
     # Delete chat sessions involving user
     ChatSession.query.filter(db.or_(ChatSession.user1_id == user_id, ChatSession.user2_id == user_id)).delete(synchronize_session=False)
     # Delete friendships and requests
@@ -1379,96 +1966,164 @@ def delete_account():
     # Finally delete user
     db.session.delete(user)
     db.session.commit()
+    friendship_index.invalidate(user_id)
     session.clear()
     return jsonify({'message': 'Account deleted'})
 
+# Optional monthly partitioning of messages (message_partitions.py). On a partitioned
+# table the hot reads also bound timestamp, so Postgres prunes to the recent months.
+app.config['MESSAGE_PARTITIONS_AHEAD'] = int(os.environ.get('MESSAGE_PARTITIONS_AHEAD', 3))
+_partition_state = {'enabled': False, 'recent': None, 'min_id': None, 'checked_at': 0.0}
+_partition_lock = threading.Lock()
+_PARTITION_RECHECK_S = 300
+
+def _recent_partition_window():
+    """(recent, upper, min_id) on a partitioned table, else None. Messages are stamped
+    before upper, and every one with id >= min_id at or after recent (both allowing
+    message_partitions.CLOCK_SKEW_S of insert skew)."""
+    if not _partition_state['enabled']:
+        return None
+    recent = message_partitions.recent_window()
+    upper = message_partitions.newest_possible()
+    with _partition_lock:
+        if _partition_state['recent'] == recent and (
+                _partition_state['min_id'] is not None or time.time() - _partition_state['checked_at'] < _PARTITION_RECHECK_S):
+            return recent, upper, _partition_state['min_id']
+    min_id = message_partitions.first_id_since(
+        db.session, recent + timedelta(seconds=message_partitions.CLOCK_SKEW_S))
+    with _partition_lock:
+        _partition_state.update(recent=recent, min_id=min_id, checked_at=time.time())
+    return recent, upper, min_id
+
+def _newest_chat_messages(chat_session_id, limit):
+    """The newest `limit` messages of a chat, newest first"""
+    query = Message.query.filter_by(chat_session_id=chat_session_id).order_by(Message.id.desc())
+    window = _recent_partition_window()
+    if window and window[2] is not None:
+        recent, upper, min_id = window
+        messages = query.filter(Message.timestamp >= recent, Message.timestamp < upper).limit(limit).all()
+        # Older partitions only hold ids below min_id, so a full page reaching no lower is exact
+        if len(messages) == limit and messages[-1].id >= min_id:
+            return messages
+    return query.limit(limit).all()
+
+def _chat_messages_after(chat_session_id, since_id, limit):
+    """Up to `limit` messages of a chat with id > since_id, oldest first"""
+    query = Message.query.filter_by(chat_session_id=chat_session_id).filter(Message.id > since_id)
+    window = _recent_partition_window()
+    if window and window[2] is not None and since_id >= window[2]:
+        query = query.filter(Message.timestamp >= window[0], Message.timestamp < window[1])
+    return query.order_by(Message.id.asc()).limit(limit).all()
+
+# Message serialization: one shape for the API, the cache and the sockets
+def message_dict(msg_id, content, sender_id, receiver_id, timestamp, message_type, is_read):
+    return {
+        'id': msg_id,
+        'content': content,
+        'sender_id': sender_id,
+        'receiver_id': receiver_id,
+        'is_read': bool(is_read),
+        'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'message_type': message_type
+    }
+
+def serialize_message(msg, is_read=None):
+    """Canonical dict for a Message row; is_read overrides the row (reads are written behind)"""
+    return message_dict(msg.id, msg.content, msg.sender_id, msg.receiver_id, msg.timestamp,
+                        msg.message_type, msg.is_read if is_read is None else is_read)
+
+def _messages_response(messages, **extra):
+    """{"messages": [...], **extra} assembled from cached per-message fragments"""
+    parts = [b'{"messages":[', b','.join([message_fragments.encode(m) for m in messages]), b']']
+    if extra:
+        parts += [b',', json.dumps(extra, separators=(',', ':')).encode()[1:-1]]
+    parts.append(b'}')
+    return app.response_class(b''.join(parts), mimetype='application/json')
+
 @app.route('/api/messages/<int:user_id>')
 def get_direct_messages(user_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     # Check if they are friends
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == user_id),
-            db.and_(Friendship.user_id == user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], user_id)
     
     if not friendship:
         return jsonify({'error': 'You can only message friends'}), 403
     
-    # Get messages from cache first, then database
+    # Keyset paging: newest page first, older pages via ?before_id=<oldest loaded id>
+    limit = min(max(request.args.get('limit', 50, type=int) or 50, 1), 200)
+    before_id = request.args.get('before_id', type=int)
     cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
     
-    with cache_lock:
-        if cache_key in message_cache:
-            cached_messages = message_cache[cache_key]
-            if len(cached_messages) > 0:
-                # Mark messages as read
-                unread_ids = [msg['id'] for msg in cached_messages if msg['sender_id'] == user_id and not msg['is_read']]
-                if unread_ids:
-                    Message.query.filter(Message.id.in_(unread_ids)).update({'is_read': True}, synchronize_session=False)
-                    db.session.commit()
-                
-                return jsonify(cached_messages)
-    
-    # Fallback to database
-    messages = Message.query.filter_by(chat_session_id=friendship.chat_session_id).order_by(Message.timestamp.asc()).all()
+    # Both summaries' last message id and unread counts version the history. Only offered
+    # when the page has nothing left to mark read, so a 304 never skips a read. Older pages
+    # skip the lookup unless the client revalidates with If-None-Match.
+    etag = None
+    versions = None
+    if request.if_none_match or before_id is None:
+        versions = db.session.query(
+            ConversationSummary.user_id, ConversationSummary.last_message_id, ConversationSummary.unread_count
+        ).filter_by(chat_session_id=friendship.chat_session_id).order_by(ConversationSummary.user_id).all()
+    if versions and not read_marker.has_pending(friendship.chat_session_id) and all(
+            v.unread_count == 0 for v in versions if v.user_id == session['user_id']):
+        etag = _version_etag('history', session['user_id'], friendship.chat_session_id, limit, before_id,
+                             [tuple(v) for v in versions])
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+    
+    # The cache only ever holds the newest window, so it can serve the first page
+    if before_id is None:
+        cached_messages = cache_backend.get_messages(cache_key) or []
+        if len(cached_messages) >= limit:
+            page = cached_messages[-limit:]
+            # Mark messages as read
+            unread_ids = [msg['id'] for msg in page if msg['sender_id'] == user_id and not msg['is_read']]
+            if unread_ids:
+                newly_read = [msg_id for msg_id in unread_ids if not read_marker.is_pending(msg_id)]
+                if newly_read:
+                    read_marker.mark_ids(newly_read, session['user_id'], friendship.chat_session_id)
+                    _record_read_receipts(friendship.chat_session_id, newly_read)
+                cache_backend.mark_read(cache_key, unread_ids)
+            has_more = len(cached_messages) > limit or db.session.query(Message.id).filter(
+                Message.chat_session_id == friendship.chat_session_id,
+                Message.id < page[0]['id']
+            ).first() is not None
+            response = _messages_response(page, has_more=has_more, next_before_id=page[0]['id'] if has_more else None)
+            return _with_etag(response, etag) if etag else response
     
-    # Mark messages as read
-    unread_messages = [msg for msg in messages if msg.sender_id == user_id and not msg.is_read]
-    for msg in unread_messages:
-        msg.is_read = True
-    db.session.commit()
-    # Track read receipts and update cache on initial load
-    if unread_messages:
-        # update cache
-        cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
-        with cache_lock:
-            cached_list = []
-            for msg in messages:
-                cached_list.append({
-                    'id': msg.id,
-                    'content': msg.content,
-                    'sender_id': msg.sender_id,
-                    'receiver_id': msg.receiver_id,
-                    'is_read': msg.is_read,
-                    'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                    'message_type': msg.message_type
-                })
-            message_cache[cache_key] = cached_list
-        # receipts
-        with read_receipts_lock:
-            rr = _read_receipts.setdefault(friendship.chat_session_id, [])
-            now_ts = time.time()
-            for m in unread_messages:
-                rr.append({'id': m.id, 'ts': now_ts})
-            if len(rr) > 500:
-                _read_receipts[friendship.chat_session_id] = rr[-500:]
-        try:
-            print(f"DEBUG read:init-load chat={friendship.chat_session_id} count={len(unread_messages)} ids={[m.id for m in unread_messages]}")
-        except Exception:
-            pass
+    # Fallback to database: index-backed (chat_session_id, id) range scan
+    if before_id is None:
+        messages = _newest_chat_messages(friendship.chat_session_id, limit + 1)
+    else:
+        messages = Message.query.filter_by(chat_session_id=friendship.chat_session_id).filter(
+            Message.id < before_id
+        ).order_by(Message.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    
+    # Mark messages as read (written behind; rows already queued are not re-announced)
+    read_now = {msg.id for msg in messages if msg.sender_id == user_id and not msg.is_read}
+    newly_read = [msg_id for msg_id in read_now if not read_marker.is_pending(msg_id)]
+    if newly_read:
+        read_marker.mark_ids(newly_read, session['user_id'], friendship.chat_session_id)
+        _record_read_receipts(friendship.chat_session_id, newly_read)
     
     # Format messages for response
-    formatted_messages = []
-    for msg in messages:
-        formatted_messages.append({
-            'id': msg.id,
-            'content': msg.content,
-            'sender_id': msg.sender_id,
-            'receiver_id': msg.receiver_id,
-            'is_read': msg.is_read,
-            'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_type': msg.message_type
-        })
+    formatted_messages = [serialize_message(msg, is_read=msg.is_read or msg.id in read_now) for msg in messages]
     
-    # Cache the messages
-    with cache_lock:
-        message_cache[cache_key] = formatted_messages
+    # Cache the newest page only; older pages are served straight from the index
+    if before_id is None:
+        cache_backend.set_messages(cache_key, formatted_messages)
     
-    return jsonify(formatted_messages)
+    response = _messages_response(
+        formatted_messages,
+        has_more=has_more,
+        next_before_id=formatted_messages[0]['id'] if has_more and formatted_messages else None
+    )
+    return _with_etag(response, etag) if etag else response
 
 @app.route('/api/messages/send', methods=['POST'])
 def send_direct_message():
@@ -1484,131 +2139,69 @@ def send_direct_message():
         return jsonify({'error': 'Content and receiver required'}), 400
     
     # Check if they are friends
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == receiver_id),
-            db.and_(Friendship.user_id == receiver_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], receiver_id)
     
     if not friendship:
         return jsonify({'error': 'You can only message friends'}), 403
     
-    # Before creating my outgoing message, mark any incoming unread as read
+    receiver_id = int(receiver_id)
+    sender_id = session['user_id']
+    chat_session_id = friendship.chat_session_id
+    now = datetime.utcnow()
+
+    # Before creating my outgoing message, mark any incoming unread as read (written behind)
+    _mark_conversation_read(chat_session_id, receiver_id, sender_id)
+
+    # Hot path: INSERT ... RETURNING, one conditional update of both conversation
+    # summaries (which hold the unread counters), one commit.
     try:
-        Message.query.filter(
-            db.and_(
-                Message.sender_id == receiver_id,
-                Message.receiver_id == session['user_id'],
-                Message.is_read == False
-            )
-        ).update({'is_read': True}, synchronize_session=False)
-        # Reset my unread counter in chat session
-        cs_tmp = ChatSession.query.filter(
-            db.or_(
-                db.and_(ChatSession.user1_id == session['user_id'], ChatSession.user2_id == receiver_id),
-                db.and_(ChatSession.user1_id == receiver_id, ChatSession.user2_id == session['user_id'])
-            )
-        ).first()
-        if cs_tmp:
-            if session['user_id'] == cs_tmp.user1_id:
-                cs_tmp.unread_count_user1 = 0
-            else:
-                cs_tmp.unread_count_user2 = 0
+        message_id = db.session.execute(
+            db.insert(Message).values(
+                chat_session_id=chat_session_id,
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=content,
+                content_hash=hashlib.sha256(content.encode()).hexdigest(),
+                message_type=message_type,
+                is_read=False,
+                timestamp=now
+            ).returning(Message.id)
+        ).scalar_one()
+        _summarize_sent_message(chat_session_id, sender_id, receiver_id, message_id, content, message_type, now)
+        db.session.commit()
     except Exception as e:
-        print(f"Error marking messages as read before sending: {e}")
-        # Continue - don't block message sending if read marking fails
         db.session.rollback()
+        print(f"Error sending message: {e}")
+        return jsonify({'error': 'Failed to send message'}), 500
 
-    # Create message with plain text content
-    new_message = Message(
-        chat_session_id=friendship.chat_session_id,
-        sender_id=session['user_id'],
-        receiver_id=receiver_id,
-        content=content,
-        content_hash=hashlib.sha256(content.encode()).hexdigest(),
-        message_type=message_type
-    )
-    
-    db.session.add(new_message)
-    db.session.flush()  # Get message ID
-    
-    # Update friendship last message info
-    friendship.last_message_at = datetime.utcnow()
-    friendship.unread_count += 1
-    
-    # Update chat session
-    chat_session = ChatSession.query.get(friendship.chat_session_id)
-    if chat_session:
-        chat_session.last_message_at = datetime.utcnow()
-        chat_session.last_message_id = new_message.id
-        if receiver_id == chat_session.user1_id:
-            chat_session.unread_count_user1 += 1
-        else:
-            chat_session.unread_count_user2 += 1
-    
-    # Add to cache immediately for ultra-fast delivery
-    cache_key = f"{min(session['user_id'], receiver_id)}_{max(session['user_id'], receiver_id)}"
-    
-    with cache_lock:
-        if cache_key not in message_cache:
-            message_cache[cache_key] = []
-        
-        # Add message to cache
-        cached_message = {
-            'id': new_message.id,
-            'content': content,
-            'sender_id': new_message.sender_id,
-            'receiver_id': new_message.receiver_id,
-            'timestamp': new_message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_type': message_type,
-            'is_read': False
-        }
-        message_cache[cache_key].append(cached_message)
-    
-    db.session.commit()
+    cached_message = message_dict(message_id, content, sender_id, receiver_id, now, message_type, False)
+    # Add to cache for ultra-fast delivery (no-op unless the window is already cached)
+    cache_key = f"{min(sender_id, receiver_id)}_{max(sender_id, receiver_id)}"
+    cache_backend.append_message(cache_key, cached_message)
 
-    # After sending a message, return current unread counts so client list can refresh accurately
+    # Push to any sockets open on this conversation and wake long-polling readers
+    try:
+        message_hub.publish(chat_session_id, {'type': 'message', 'message': cached_message})
+        message_waiters.notify(chat_session_id)
+    except Exception as e:
+        print(f"Error publishing message {message_id}: {e}")
 
-    # Send Web Push notification to receiver (if configured)
+    # Send Web Push notification to receiver (if configured); subscriptions are looked up off the request path
     if PUSH_AVAILABLE and VAPID_PUBLIC_KEY and VAPID_PRIVATE_KEY:
         try:
-            subs = PushSubscription.query.filter_by(user_id=receiver_id).all()
-            if subs:
-                payload = json.dumps({
-                    'title': 'New message',
-                    'body': content[:140],
-                    'sender_id': new_message.sender_id,
-                    'chat_session_id': friendship.chat_session_id,
-                    'url': url_for('direct_chat', user_id=session['user_id'], _external=True)
-                })
-                for s in subs:
-                    try:
-                        webpush(
-                            subscription_info={
-                                'endpoint': s.endpoint,
-                                'keys': {'p256dh': s.p256dh, 'auth': s.auth}
-                            },
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims=VAPID_CLAIMS
-                        )
-                    except WebPushException as e:
-                        try:
-                            print(f"WebPush failed: {e}")
-                        except Exception:
-                            pass
-        except Exception:
-            pass
+            payload = json.dumps({
+                'title': 'New message',
+                'body': content[:140],
+                'sender_id': sender_id,
+                'chat_session_id': chat_session_id,
+                'url': url_for('direct_chat', user_id=sender_id, _external=True)
+            })
+            push_dispatcher.submit_user(receiver_id, payload)
+        except Exception as e:
+            print(f"Error queueing push for message {message_id}: {e}")
 
-    return jsonify({
-        'id': new_message.id,
-        'content': content,
-        'sender_id': new_message.sender_id,
-        'receiver_id': new_message.receiver_id,
-        'timestamp': new_message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        'message_type': message_type
-    })
+    # Encoding it here also warms the fragment the receiver's next poll will use
+    return app.response_class(message_fragments.encode(cached_message), mimetype='application/json')
 
 # Typing indicators
 @app.route('/api/typing', methods=['POST'])
@@ -1621,12 +2214,7 @@ def set_typing():
     if not other_user_id:
         return jsonify({'error': 'other_user_id required'}), 400
     # Find friendship to get chat_session_id
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == other_user_id),
-            db.and_(Friendship.user_id == other_user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], other_user_id)
     if not friendship:
         return jsonify({'error': 'Not friends'}), 403
     # Persist to DB to work across instances
@@ -1664,17 +2252,21 @@ def typing_ping():
     db.session.commit()
     return jsonify({'ok': True})
 
+# A typing signal counts for this long after it was sent
+_TYPING_WINDOW_S = 4.0
+
+def _is_typing(chat_session_id, user_id):
+    rec = TypingStatus.query.filter_by(chat_session_id=str(chat_session_id), user_id=int(user_id)).first()
+    return bool(rec and rec.last_typing_at and
+                (datetime.utcnow() - rec.last_typing_at).total_seconds() < _TYPING_WINDOW_S)
+
 @app.route('/api/typing/state')
 def typing_state():
     chat_session_id = request.args.get('chat_session_id')
     other_id = request.args.get('other_id')
     if not chat_session_id or not other_id:
         return jsonify({'is_typing': False})
-    rec = TypingStatus.query.filter_by(chat_session_id=str(chat_session_id), user_id=int(other_id)).first()
-    is_typing = False
-    if rec and rec.last_typing_at:
-        is_typing = (datetime.utcnow() - rec.last_typing_at).total_seconds() < 4.0
-    return jsonify({'is_typing': is_typing})
+    return jsonify({'is_typing': _is_typing(chat_session_id, other_id)})
 
 @app.route('/api/typing/<int:other_user_id>')
 def get_typing(other_user_id):
@@ -1684,28 +2276,69 @@ def get_typing(other_user_id):
         # Fall back to resolving via session
         if 'user_id' not in session:
             return jsonify({'is_typing': False})
-        friendship = Friendship.query.filter(
-            db.or_(
-                db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == other_user_id),
-                db.and_(Friendship.user_id == other_user_id, Friendship.friend_id == session['user_id'])
-            )
-        ).first()
+        friendship = get_friend_link(session['user_id'], other_user_id)
         if not friendship:
             return jsonify({'is_typing': False})
         chat_session_id = friendship.chat_session_id
     # Check if the OTHER user is typing
     # Read from DB (works across dynos/instances)
-    rec = TypingStatus.query.filter_by(chat_session_id=str(chat_session_id), user_id=int(other_user_id)).first()
-    is_typing = False
-    if rec and rec.last_typing_at:
-        delta = (datetime.utcnow() - rec.last_typing_at).total_seconds()
-        is_typing = delta < 4.0
+    is_typing = _is_typing(chat_session_id, other_user_id)
     try:
         print(f"DEBUG typing:get requester={session['user_id']} other={other_user_id} chat={friendship.chat_session_id} is_typing={is_typing}")
     except Exception:
         pass
     return jsonify({'is_typing': is_typing})
 
+def _collect_latest_messages(friendship, user_id, since_id, cache_key):
+    """Messages with id > since_id (the newest 50 when since_id is None) in the
+    current user's chat with user_id. Marks incoming ones read; returns (messages, read_ids)."""
+    # Check cache first: the window is id-sorted, so the cursor is a bisect
+    if since_id is None:
+        cached_messages = cache_backend.get_messages(cache_key)
+        new_messages = cached_messages[-50:] if cached_messages is not None else None
+    else:
+        cached_messages = None
+        new_messages = cache_backend.get_messages_since(cache_key, since_id)
+    if new_messages is not None:
+        # Mark messages as read (for any new ones)
+        unread_ids = [msg['id'] for msg in new_messages if msg['sender_id'] == user_id and not msg['is_read']]
+        if not unread_ids:
+            # Messages pushed over the socket are already behind the cursor; mark any left unread
+            if cached_messages is None:
+                cached_messages = cache_backend.get_messages(cache_key) or []
+            unread_ids = [cm['id'] for cm in cached_messages if cm['sender_id'] == user_id and not cm['is_read']]
+        if unread_ids:
+            read_marker.mark_ids(unread_ids, session['user_id'], friendship.chat_session_id)
+            # Update cache entries to reflect read status
+            cache_backend.mark_read(cache_key, unread_ids)
+            # Track read receipts
+            _record_read_receipts(friendship.chat_session_id, unread_ids)
+        # Include side-channel read_ids for immediate UI updates
+        return new_messages, unread_ids
+    
+    # Fallback to database: (chat_session_id, id) index range scan
+    if since_id is not None:
+        new_messages = _chat_messages_after(friendship.chat_session_id, since_id, _LATEST_MAX_BATCH)
+    else:
+        new_messages = _newest_chat_messages(friendship.chat_session_id, 50)
+        new_messages.reverse()
+    
+    # Mark messages as read (written behind; rows already queued are not re-announced)
+    read_now = {msg.id for msg in new_messages if msg.sender_id == user_id and not msg.is_read}
+    newly_read = [msg_id for msg_id in read_now if not read_marker.is_pending(msg_id)]
+    if newly_read:
+        read_marker.mark_ids(newly_read, session['user_id'], friendship.chat_session_id)
+        # Update cache too
+        cache_backend.mark_read(cache_key, newly_read)
+        # Track read receipts
+        _record_read_receipts(friendship.chat_session_id, newly_read)
+    
+    # Format and return messages
+    formatted_messages = [serialize_message(msg, is_read=msg.is_read or msg.id in read_now) for msg in new_messages]
+    # Include side-channel read_ids for immediate UI updates
+    read_ids = sorted(newly_read)
+    return formatted_messages, read_ids
+
 # Ultra-fast message retrieval with caching
 @app.route('/api/messages/<int:user_id>/latest')
 def get_latest_messages(user_id):
@@ -1713,124 +2346,80 @@ def get_latest_messages(user_id):
         return jsonify({'error': 'Not authenticated'}), 401
     
     # Check if they are friends
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == user_id),
-            db.and_(Friendship.user_id == user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], user_id)
     
     if not friendship:
         return jsonify({'error': 'You can only message friends'}), 403
     
-    last_timestamp = request.args.get('last_timestamp')
+    # Cursor: the id of the newest message the client already has
+    since_id = request.args.get('since_id', type=int)
     cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
+    # Long-poll: ?wait=N blocks (cooperatively under gevent) until a message arrives
+    wait_s = min(max(request.args.get('wait', 0, type=float) or 0, 0), _LONG_POLL_MAX_WAIT_S)
+    chat_session_id = friendship.chat_session_id
+    # Take the wake-up event before looking, so a send in between isn't missed
+    waiter = message_waiters.prepare(chat_session_id) if wait_s else None
+    
+    messages, read_ids = _collect_latest_messages(friendship, user_id, since_id, cache_key)
+    if waiter is not None and not messages and not read_ids:
+        # Don't hold a pooled connection while parked
+        db.session.close()
+        if waiter.wait(wait_s):
+            messages, read_ids = _collect_latest_messages(friendship, user_id, since_id, cache_key)
     
-    # Check cache first
-    with cache_lock:
-        if cache_key in message_cache:
-            cached_messages = message_cache[cache_key]
-            if last_timestamp:
-                # Filter new messages since last timestamp
-                new_messages = [
-                    msg for msg in cached_messages 
-                    if msg['timestamp'] > last_timestamp
-                ]
-            else:
-                # Return last 50 messages from cache
-                new_messages = cached_messages[-50:] if len(cached_messages) > 50 else cached_messages
-            
-            # Mark messages as read (for any new ones), and also catch same-second cases by scanning cache
-            unread_ids = [msg['id'] for msg in new_messages if msg['sender_id'] == user_id and not msg['is_read']]
-            if not unread_ids:
-                # If no new messages triggered a read, still mark any unread from cache
-                unread_ids = [cm['id'] for cm in cached_messages if cm['sender_id'] == user_id and not cm['is_read']]
-            if unread_ids:
-                Message.query.filter(Message.id.in_(unread_ids)).update({'is_read': True}, synchronize_session=False)
-                db.session.commit()
-                # Update cache entries to reflect read status
-                for cm in cached_messages:
-                    if cm['id'] in unread_ids:
-                        cm['is_read'] = True
-                # Track read receipts
-                with read_receipts_lock:
-                    rr = _read_receipts.setdefault(friendship.chat_session_id, [])
-                    now_ts = time.time()
-                    for mid in unread_ids:
-                        rr.append({'id': mid, 'ts': now_ts})
-                    if len(rr) > 500:
-                        _read_receipts[friendship.chat_session_id] = rr[-500:]
-                try:
-                    print(f"DEBUG read:cache-marked chat={friendship.chat_session_id} count={len(unread_ids)} ids={unread_ids}")
-                except Exception:
-                    pass
-            # Include side-channel read_ids for immediate UI updates
-            return jsonify({'messages': new_messages, 'read_ids': unread_ids})
-    
-    # Fallback to database
-    if last_timestamp:
-        new_messages = Message.query.filter_by(chat_session_id=friendship.chat_session_id).filter(
-            Message.timestamp > datetime.fromisoformat(last_timestamp.replace('Z', '+00:00'))
-        ).order_by(Message.timestamp.asc()).all()
-    else:
-        new_messages = Message.query.filter_by(chat_session_id=friendship.chat_session_id).order_by(Message.timestamp.desc()).limit(50).all()
-        new_messages.reverse()
-    
-    # Mark messages as read
-    unread_messages = [msg for msg in new_messages if msg.sender_id == user_id and not msg.is_read]
-    for msg in unread_messages:
-        msg.is_read = True
-    
-    if unread_messages:
-        db.session.commit()
-        # Update cache too
-        cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
-        with cache_lock:
-            cached = message_cache.get(cache_key)
-            if cached:
-                unread_id_set = {m.id for m in unread_messages}
-                for cm in cached:
-                    if cm['id'] in unread_id_set:
-                        cm['is_read'] = True
-        # Track read receipts
-        with read_receipts_lock:
-            rr = _read_receipts.setdefault(friendship.chat_session_id, [])
-            now_ts = time.time()
-            for mid in [m.id for m in unread_messages]:
-                rr.append({'id': mid, 'ts': now_ts})
-            if len(rr) > 500:
-                _read_receipts[friendship.chat_session_id] = rr[-500:]
-        try:
-            print(f"DEBUG read:db-marked chat={friendship.chat_session_id} count={len(unread_messages)} ids={[m.id for m in unread_messages]}")
-        except Exception:
-            pass
-    
-    # Format and return messages
-    formatted_messages = []
-    for msg in new_messages:
-        formatted_messages.append({
-            'id': msg.id,
-            'content': msg.content,
-            'sender_id': msg.sender_id,
-            'receiver_id': msg.receiver_id,
-            'is_read': msg.is_read,
-            'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_type': msg.message_type
-        })
     # Include side-channel read_ids for immediate UI updates
-    read_ids = [m.id for m in unread_messages] if unread_messages else []
-    return jsonify({'messages': formatted_messages, 'read_ids': read_ids})
+    return _messages_response(messages, read_ids=read_ids)
+
+# One request per tick for an open chat: messages, read receipts, typing and presence
+# behind a single auth check and friendship lookup
+@app.route('/api/chat/<int:user_id>/poll')
+def poll_chat(user_id):
+    """?since_id= message cursor (as /latest), ?receipts_since= receipt timestamp
+    (as /read-receipts), ?wait=N to long-poll until a message arrives."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    friendship = get_friend_link(session['user_id'], user_id)
+    if not friendship:
+        return jsonify({'error': 'You can only message friends'}), 403
+    chat_session_id = friendship.chat_session_id
+    since_id = request.args.get('since_id', type=int)
+    receipts_since = request.args.get('receipts_since', 0.0, type=float)
+    wait_s = min(max(request.args.get('wait', 0, type=float) or 0, 0), _LONG_POLL_MAX_WAIT_S)
+    cache_key = f"{min(session['user_id'], user_id)}_{max(session['user_id'], user_id)}"
+    waiter = message_waiters.prepare(chat_session_id) if wait_s else None
+
+    def collect():
+        messages, read_ids = _collect_latest_messages(friendship, user_id, since_id, cache_key)
+        receipts = cache_backend.get_read_receipts(chat_session_id, receipts_since)
+        return messages, read_ids, receipts
+
+    messages, read_ids, receipts = collect()
+    if waiter is not None and not messages and not read_ids and not receipts:
+        db.session.close()
+        if waiter.wait(wait_s):
+            messages, read_ids, receipts = collect()
+
+    # Presence straight from the session cache, no users row read
+    activity = (cache_backend.get_session(user_id) or {}).get('last_activity', 0)
+    extra = {
+        'receipts': {
+            'read_ids': [e['id'] for e in receipts],
+            'latest': max([e['ts'] for e in receipts], default=receipts_since)
+        },
+        'typing': _is_typing(chat_session_id, user_id),
+        'presence': {
+            'online': (time.time() - activity) < _PRESENCE_WINDOW_S,
+            'last_seen': datetime.utcfromtimestamp(activity).isoformat() if activity else None
+        },
+        'now': time.time()
+    }
+    return _messages_response(messages, read_ids=read_ids, **extra)
 
 @app.route('/api/messages/<int:user_id>/read-receipts')
 def get_read_receipts(user_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
-    friendship = Friendship.query.filter(
-        db.or_(
-            db.and_(Friendship.user_id == session['user_id'], Friendship.friend_id == user_id),
-            db.and_(Friendship.user_id == user_id, Friendship.friend_id == session['user_id'])
-        )
-    ).first()
+    friendship = get_friend_link(session['user_id'], user_id)
     if not friendship:
         return jsonify({'read_ids': []})
     since_param = request.args.get('since')
@@ -1838,29 +2427,410 @@ def get_read_receipts(user_id):
         since = float(since_param) if since_param is not None else 0.0
     except Exception:
         since = 0.0
-    with read_receipts_lock:
-        entries = _read_receipts.get(friendship.chat_session_id, [])
-        cutoff = time.time() - 60
-        pruned = [e for e in entries if e['ts'] >= cutoff]
-        if len(pruned) != len(entries):
-            _read_receipts[friendship.chat_session_id] = pruned
-        ready = [e for e in pruned if e['ts'] > since]
-        read_ids = [e['id'] for e in ready]
-        latest_ts = max([e['ts'] for e in ready], default=since)
+    ready = cache_backend.get_read_receipts(friendship.chat_session_id, since)
+    read_ids = [e['id'] for e in ready]
+    latest_ts = max([e['ts'] for e in ready], default=since)
     now = time.time()
+    return jsonify({'read_ids': read_ids, 'latest': latest_ts, 'now': now})
+
+def _record_read_receipts(chat_session_id, ids):
+    """Store receipts for the polling endpoint and push them to open SSE streams"""
+    ids = list(ids)
+    if not ids:
+        return
+    ts = time.time()
+    cache_backend.add_read_receipts(chat_session_id, ids, ts)
+    receipt_hub.publish(chat_session_id, {'ids': ids, 'ts': ts})
+
+def _mark_conversation_read(chat_session_id, sender_id, reader_id):
+    """Queue everything sender_id sent to reader_id as read and update the cache and receipts now"""
+    read_marker.mark_pair(sender_id, reader_id, chat_session_id)
+    cache_key = f"{min(sender_id, reader_id)}_{max(sender_id, reader_id)}"
+    cached = cache_backend.get_messages(cache_key) or []
+    unread_ids = [m['id'] for m in cached if m['sender_id'] == sender_id and not m['is_read']]
+    if unread_ids:
+        cache_backend.mark_read(cache_key, unread_ids)
+        _record_read_receipts(chat_session_id, unread_ids)
+
+def _sse_read_event(ids, ts):
+    # The receipt timestamp doubles as the event id, so Last-Event-ID resumes from it
+    return f"id: {ts!r}\nevent: read\ndata: {json.dumps({'read_ids': ids, 'ts': ts})}\n\n"
+
+# Server-Sent Events alternative to polling /read-receipts every 400 ms
+@app.route('/api/messages/<int:user_id>/read-receipts/stream')
+def stream_read_receipts(user_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    friendship = get_friend_link(session['user_id'], user_id)
+    if not friendship:
+        return jsonify({'error': 'You can only message friends'}), 403
+    chat_session_id = friendship.chat_session_id
+    # Browsers send Last-Event-ID on reconnect; ?since= covers the first connect
+    resume_from = request.headers.get('Last-Event-ID') or request.args.get('since')
     try:
-        print(f"DEBUG read:poll requester={session['user_id']} other={user_id} chat={friendship.chat_session_id} since={since} returning={read_ids}")
-    except Exception:
+        since = float(resume_from) if resume_from else time.time()
+    except ValueError:
+        since = time.time()
+    # Nothing below needs the DB; return the connection to the pool
+    db.session.close()
+
+    def generate():
+        # Subscribe before replaying so nothing falls between backlog and live events
+        q = receipt_hub.subscribe(chat_session_id)
+        last_ts = since
+        deadline = time.time() + _SSE_MAX_STREAM_S
+        try:
+            yield 'retry: 3000\n\n'
+            backlog = {}
+            for e in cache_backend.get_read_receipts(chat_session_id, since):
+                backlog.setdefault(e['ts'], []).append(e['id'])
+            for ts in sorted(backlog):
+                yield _sse_read_event(backlog[ts], ts)
+                last_ts = ts
+            while time.time() < deadline:
+                try:
+                    evt = json.loads(q.get(timeout=min(15, max(0.1, deadline - time.time()))))
+                except queue.Empty:
+                    # Comment line keeps proxies from timing out and detects dropped clients
+                    yield ': keepalive\n\n'
+                    continue
+                if evt['ts'] <= last_ts:
+                    continue
+                last_ts = evt['ts']
+                yield _sse_read_event(evt['ids'], evt['ts'])
+        finally:
+            receipt_hub.unsubscribe(chat_session_id, q)
+
+    # Streams end after _SSE_MAX_STREAM_S; EventSource reconnects with Last-Event-ID
+    return app.response_class(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Delta sync: one round trip catches up every conversation (PWA reconnect, messaging list)
+_SYNC_MAX_PER_CHAT = 50
+_SYNC_MAX_CURSORS = 500
+_SYNC_COLUMNS = 'm.id, m.chat_session_id, m.content, m.sender_id, m.receiver_id, m.timestamp, m.message_type, m.is_read'
+
+def _sync_new_messages(cursors, limit):
+    """Up to `limit` messages after each {chat_session_id: since_id} cursor, oldest first, in one query"""
+    bounds, params = '', {'n': limit}
+    window = _recent_partition_window()
+    if window and window[2] is not None and min(cursors.values()) >= window[2]:
+        bounds = ' AND timestamp >= :recent AND timestamp < :upper'
+        params.update(recent=window[0], upper=window[1])
+    if db.engine.dialect.name == 'postgresql':
+        # LATERAL: one (chat_session_id, id) index range scan per cursor, each stopping at the limit
+        sql = (f"SELECT {_SYNC_COLUMNS} FROM unnest(CAST(:chats AS varchar[]), CAST(:since AS integer[])) "
+               f"AS c(chat_id, since_id) CROSS JOIN LATERAL (SELECT * FROM messages "
+               f"WHERE chat_session_id = c.chat_id AND id > c.since_id{bounds} ORDER BY id LIMIT :n) m "
+               f"ORDER BY m.chat_session_id, m.id")
+        params.update(chats=list(cursors), since=list(cursors.values()))
+    else:
+        sql = (f"SELECT {_SYNC_COLUMNS.replace('m.', '')} FROM (SELECT {_SYNC_COLUMNS}, row_number() OVER "
+               f"(PARTITION BY m.chat_session_id ORDER BY m.id) AS rn FROM json_each(:cursors) c "
+               f"JOIN messages m ON m.chat_session_id = c.key AND m.id > c.value{bounds.replace(' timestamp', ' m.timestamp')}) "
+               f"WHERE rn <= :n ORDER BY chat_session_id, id")
+        params['cursors'] = json.dumps(cursors)
+    out = {}
+    for row in db.session.execute(text(sql).columns(timestamp=db.DateTime), params).mappings():
+        out.setdefault(row['chat_session_id'], []).append(message_dict(
+            row['id'], row['content'], row['sender_id'], row['receiver_id'], row['timestamp'],
+            row['message_type'], row['is_read'] or read_marker.is_pending(row['id'])))
+    return out
+
+@app.route('/api/sync', methods=['POST'])
+def sync_conversations():
+    """Body: {"cursors": {chat_session_id: last_seen_id}}. Returns every conversation's
+    unread count and preview, plus new messages and read state for the ones with a cursor.
+    Three queries however many conversations there are; nothing is marked read."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    me = session['user_id']
+    data = request.get_json(silent=True) or {}
+    raw = data.get('cursors', {})
+    if not isinstance(raw, dict) or len(raw) > _SYNC_MAX_CURSORS:
+        return jsonify({'error': f'cursors must be an object with at most {_SYNC_MAX_CURSORS} entries'}), 400
+    try:
+        requested = {str(chat_id): max(int(since_id or 0), 0) for chat_id, since_id in raw.items()}
+        limit = min(max(int(data.get('limit') or _SYNC_MAX_PER_CHAT), 1), _LATEST_MAX_BATCH)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Cursor values and limit must be integers'}), 400
+
+    summaries = ConversationSummary.query.filter_by(user_id=me).all()
+    # Only the caller's own conversations are synced; other ids are reported back
+    cursors = {s.chat_session_id: requested[s.chat_session_id] for s in summaries if s.chat_session_id in requested}
+    new_messages, first_unread = {}, {}
+    if cursors:
+        new_messages = _sync_new_messages(cursors, limit + 1)
+        # Lowest id of mine the friend hasn't read yet, per chat (partial unread index)
+        first_unread = dict(db.session.query(Message.chat_session_id, db.func.min(Message.id)).filter(
+            Message.chat_session_id.in_(list(cursors)),
+            Message.sender_id == me,
+            Message.is_read == False
+        ).group_by(Message.chat_session_id).all())
+
+    conversations = {}
+    for summary in summaries:
+        _, preview, unread_badge = _conversation_preview(summary, me)
+        conv = {
+            'friend_id': summary.friend_id,
+            'last_message_id': summary.last_message_id,
+            'last_message_at': summary.last_message_at.strftime('%Y-%m-%d %H:%M:%S') if summary.last_message_at else None,
+            'time_label': _format_short_time(summary.last_message_at) if summary.last_message_at else '',
+            'unread_count': summary.unread_count or 0,
+            'unread_badge': unread_badge,
+            'preview': preview
+        }
+        if summary.chat_session_id in cursors:
+            messages = new_messages.get(summary.chat_session_id, [])
+            conv['has_more'] = len(messages) > limit
+            conv['messages'] = messages[:limit]
+            # Every message I sent with id <= read_up_to has been read by the friend
+            unread_from = first_unread.get(summary.chat_session_id)
+            conv['read_up_to'] = unread_from - 1 if unread_from else (summary.last_message_id or 0)
+        conversations[summary.chat_session_id] = conv
+    return jsonify({
+        'conversations': conversations,
+        'unknown': sorted(set(requested) - set(cursors)),
+        'server_time': time.time()
+    })
+
+# Full-text search over the caller's chats (GIN tsvector on Postgres, FTS5 on SQLite)
+@app.route('/api/messages/search')
+def search_messages():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    me = session['user_id']
+    q = (request.args.get('q') or '').strip()
+    if not q or len(q) > 200:
+        return jsonify({'error': 'Query must be 1-200 characters'}), 400
+    dialect = db.engine.dialect.name
+    if not message_search.supported(dialect):
+        return jsonify({'error': 'Search is not available on this database'}), 501
+    limit = min(max(request.args.get('limit', 20, type=int) or 20, 1), 100)
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = message_search.decode_cursor(request.args['cursor'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    # ?user_id= narrows the search to one conversation
+    if request.args.get('user_id'):
+        friendship = get_friend_link(me, request.args['user_id'])
+        if not friendship:
+            return jsonify({'error': 'You can only message friends'}), 403
+        chat_ids = [friendship.chat_session_id]
+    else:
+        chat_ids = [row[0] for row in db.session.query(ConversationSummary.chat_session_id)
+                    .filter(ConversationSummary.user_id == me)]
+    try:
+        rows, next_cursor = message_search.search(db.session, dialect, q, chat_ids, limit=limit, after=after)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Message search failed: {e}")
+        return jsonify({'error': 'Search failed'}), 500
+    results = []
+    for row in rows:
+        item = message_dict(row['id'], row['content'], row['sender_id'], row['receiver_id'], row['timestamp'],
+                            row['message_type'], row['is_read'] or read_marker.is_pending(row['id']))
+        item['friend_id'] = row['receiver_id'] if row['sender_id'] == me else row['sender_id']
+        item['rank'] = row['rank']
+        results.append(item)
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+# Data export: NDJSON streamed off a server-side cursor (yield_per), so memory stays
+# flat however long the history is. ?gzip=1 compresses on the fly.
+_EXPORT_FETCH_ROWS = 1000
+_EXPORT_CHUNK_BYTES = 64 * 1024
+
+def _export_response(records, filename):
+    """Stream an iterator of dicts as one JSON object per line"""
+    use_gzip = request.args.get('gzip') in ('1', 'true')
+
+    def generate():
+        # wbits=31: gzip container, so the download is a plain .ndjson.gz file
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+        buf, size = [], 0
+        for record in records:
+            line = json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+            buf.append(line)
+            size += len(line)
+            if size < _EXPORT_CHUNK_BYTES:
+                continue
+            chunk = ''.join(buf).encode()
+            buf, size = [], 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        chunk = ''.join(buf).encode()
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+    suffix = '.ndjson.gz' if use_gzip else '.ndjson'
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='application/gzip' if use_gzip else 'application/x-ndjson', headers={
+        'Content-Disposition': f'attachment; filename="{filename}{suffix}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    })
+
+def _export_messages(chat_session_id, me):
+    """One chat's messages, oldest first, fetched _EXPORT_FETCH_ROWS at a time"""
+    stmt = db.select(
+        Message.id, Message.sender_id, Message.receiver_id, Message.content, Message.message_type,
+        Message.is_read, Message.timestamp, Message.edited_at, Message.reply_to_id
+    ).where(
+        Message.chat_session_id == chat_session_id, Message.deleted_at.is_(None)
+    ).order_by(Message.id).execution_options(yield_per=_EXPORT_FETCH_ROWS)
+    for row in db.session.execute(stmt):
+        record = message_dict(row.id, row.content, row.sender_id, row.receiver_id, row.timestamp,
+                              row.message_type, row.is_read or read_marker.is_pending(row.id))
+        record['type'] = 'message'
+        record['chat_session_id'] = chat_session_id
+        record['friend_id'] = row.receiver_id if row.sender_id == me else row.sender_id
+        record['edited_at'] = row.edited_at.isoformat() if row.edited_at else None
+        record['reply_to_id'] = row.reply_to_id
+        yield record
+
+def _export_user(user):
+    return {'id': user.id, 'username': user.username, 'first_name': user.first_name, 'last_name': user.last_name}
+
+@app.route('/api/export/chat/<int:user_id>')
+def export_chat(user_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    me = session['user_id']
+    friendship = get_friend_link(me, user_id)
+    if not friendship:
+        return jsonify({'error': 'You can only export chats with friends'}), 403
+    friend = User.query.get(user_id)
+    header = {'type': 'chat', 'chat_session_id': friendship.chat_session_id, 'exported_at': datetime.utcnow().isoformat(),
+              'user': _export_user(User.query.get(me)), 'friend': _export_user(friend)}
+
+    def records():
+        yield header
+        yield from _export_messages(friendship.chat_session_id, me)
+
+    return _export_response(records(), f"chat-{friend.username}-{datetime.utcnow():%Y%m%d}")
+
+@app.route('/api/export/account')
+def export_account():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    me = session['user_id']
+    user = User.query.get(me)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    header = {'type': 'account', 'exported_at': datetime.utcnow().isoformat(), 'user': dict(
+        _export_user(user), email=user.email, bio=user.bio,
+        created_at=user.created_at.isoformat() if user.created_at else None)}
+    chats = db.session.query(ConversationSummary.chat_session_id, User).join(
+        User, User.id == ConversationSummary.friend_id
+    ).filter(ConversationSummary.user_id == me).order_by(ConversationSummary.chat_session_id).all()
+    friends = [dict(_export_user(friend), type='friend', chat_session_id=chat_id) for chat_id, friend in chats]
+
+    def records():
+        yield header
+        yield from friends
+        # Chat by chat, so each cursor walks the (chat_session_id, id) index in order
+        for friend in friends:
+            yield from _export_messages(friend['chat_session_id'], me)
+
+    return _export_response(records(), f"account-{user.username}-{datetime.utcnow():%Y%m%d}")
+
+def _ws_participant(chat_session_id):
+    """Return the session user id if they belong to this chat, else None.
+    Releases the DB session so a long-lived socket doesn't pin a pooled connection."""
+    uid = session.get('user_id')
+    try:
+        if not uid:
+            return None
+        friendship = Friendship.query.filter_by(chat_session_id=chat_session_id).first()
+        if not friendship or uid not in (friendship.user_id, friendship.friend_id):
+            return None
+        return uid
+    finally:
+        db.session.remove()
+
+# Live message channel: replaces 400 ms polling of /api/messages/<id>/latest while connected
+@sock.route('/ws/messages/<chat_session_id>')
+def ws_messages(ws, chat_session_id):
+    if not _ws_participant(chat_session_id):
+        return
+    q = message_hub.subscribe(chat_session_id)
+    try:
+        ws.send(json.dumps({'type': 'ready'}))
+        while ws.connected:
+            try:
+                data = q.get(timeout=25)
+            except queue.Empty:
+                # Keepalive through proxies; also surfaces dead connections
+                ws.send(json.dumps({'type': 'ping'}))
+                continue
+            ws.send(data)
+    except ConnectionClosed:
         pass
-    return jsonify({'read_ids': read_ids, 'latest': latest_ts, 'now': now})
+    finally:
+        message_hub.unsubscribe(chat_session_id, q)
+
+# Typing relay: in-memory only, never touches the typing_status table
+@sock.route('/ws/typing/<chat_session_id>')
+def ws_typing(ws, chat_session_id):
+    uid = _ws_participant(chat_session_id)
+    if not uid:
+        return
+    q = typing_hub.subscribe(chat_session_id)
+
+    def pump():
+        try:
+            while ws.connected:
+                try:
+                    data = q.get(timeout=5)
+                except queue.Empty:
+                    continue
+                if data is None:
+                    break
+                ws.send(data)
+        except ConnectionClosed:
+            pass
+
+    sender = threading.Thread(target=pump, daemon=True)
+    sender.start()
+    try:
+        while True:
+            raw = ws.receive()
+            try:
+                event_type = (json.loads(raw) or {}).get('type')
+            except Exception:
+                continue
+            if event_type in ('typing', 'stop'):
+                # user_id comes from the session, never from the client payload
+                typing_hub.publish(chat_session_id, {'type': event_type, 'user_id': uid, 'ts': time.time()}, exclude=q)
+    except ConnectionClosed:
+        pass
+    finally:
+        typing_hub.unsubscribe(chat_session_id, q)
+        # Wake the pump so it exits immediately instead of on its next timeout
+        try:
+            q.put_nowait(None)
+        except queue.Full:
+            pass
 
 # Utility Functions
 def get_user_friends(user_id):
     friendships = Friendship.query.filter_by(user_id=user_id).all()
+    # Unread counts and last activity come from the conversation summaries
+    summaries = {s.friend_id: s for s in ConversationSummary.query.filter_by(user_id=user_id)}
     friends = []
     
     for friendship in friendships:
         friend = User.query.get(friendship.friend_id)
+        summary = summaries.get(friendship.friend_id)
+        last_message_at = summary.last_message_at if summary else friendship.last_message_at
         if friend:
             friends.append({
                 'id': friend.id,
@@ -1869,10 +2839,10 @@ def get_user_friends(user_id):
                 'last_name': friend.last_name,
                 'is_online': friend.is_online,
                 'public_key': friend.public_key,
-                'chat_session_id': friendship.chat_session_id,
-                'unread_count': friendship.unread_count,
-                'last_message_at': friendship.last_message_at.strftime('%Y-%m-%d %H:%M:%S') if friendship.last_message_at else None,
-                'profile_picture': friend.profile_picture
+                'chat_session_id': summary.chat_session_id if summary else (get_friend_link(user_id, friendship.friend_id) or friendship).chat_session_id,
+                'unread_count': summary.unread_count if summary else 0,
+                'last_message_at': last_message_at.strftime('%Y-%m-%d %H:%M:%S') if last_message_at else None,
+                'profile_picture': sized_avatar_url(friend.profile_picture, 96)
             })
     
     return friends
@@ -1882,23 +2852,42 @@ def cleanup_cache():
     """Clean up old cache entries and inactive sessions"""
     while True:
         time.sleep(300)  # Run every 5 minutes
-        current_time = time.time()
-        
-        with cache_lock:
-            # Remove old cache entries
-            for key in list(message_cache.keys()):
-                if len(message_cache[key]) > 1000:
-                    message_cache[key] = message_cache[key][-500:]
         
-        with session_lock:
+        # The message cache bounds itself (per-conversation window + LRU entry budget)
+        try:
             # Remove inactive sessions
-            for user_id in list(user_sessions.keys()):
-                if current_time - user_sessions[user_id]['last_activity'] > 3600:  # 1 hour
-                    del user_sessions[user_id]
+            cache_backend.prune_sessions(3600)  # 1 hour
+        except Exception as e:
+            print(f"Session cleanup failed: {e}")
 
 # Start cleanup thread
 cleanup_thread = threading.Thread(target=cleanup_cache, daemon=True)
 cleanup_thread.start()
+reconciler_thread = threading.Thread(target=unread_reconciler, daemon=True)
+reconciler_thread.start()
+
+# Idempotent DDL for databases created before a model gained new indexes
+_SCHEMA_UPGRADES = [
+    'CREATE INDEX IF NOT EXISTS idx_chat_session_id ON messages (chat_session_id, id)',
+    # Avatar ETags; rows from before the column get their hash on first view
+    'ALTER TABLE avatars ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)',
+    # Feed ETags; see _feed_version
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS feed_version INTEGER NOT NULL DEFAULT 0',
+    # Avatars moved from base64 text to bytea: decode the old rows in place and drop their base64
+    'ALTER TABLE avatars ADD COLUMN IF NOT EXISTS data BYTEA',
+    'ALTER TABLE avatars ALTER COLUMN data_b64 DROP NOT NULL',
+    "UPDATE avatars SET data = decode(data_b64, 'base64'), "
+    "content_hash = COALESCE(content_hash, encode(sha256(decode(data_b64, 'base64')), 'hex')), data_b64 = NULL "
+    "WHERE data IS NULL AND data_b64 IS NOT NULL",
+    # ...and point profile pictures still at the bare /api/avatar/<id> at the versioned URL
+    "UPDATE users SET profile_picture = '/api/avatar/' || users.id || '?v=' || a.content_hash FROM avatars a "
+    "WHERE a.user_id = users.id AND a.content_hash IS NOT NULL AND users.profile_picture = '/api/avatar/' || users.id",
+    "UPDATE user_profiles SET profile_picture = '/api/avatar/' || user_profiles.user_id || '?v=' || a.content_hash "
+    "FROM avatars a WHERE a.user_id = user_profiles.user_id AND a.content_hash IS NOT NULL "
+    "AND user_profiles.profile_picture = '/api/avatar/' || user_profiles.user_id",
+    # Unread counting (send-time recount, read marker, reconciler) only touches unread rows
+    'CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (chat_session_id, receiver_id) WHERE is_read = false',
+]
 
 # Database initialization function
 def init_database():
@@ -1906,6 +2895,30 @@ def init_database():
     try:
         with app.app_context():
             db.create_all()
+            # create_all() skips tables that already exist, so add newer indexes explicitly
+            for stmt in _SCHEMA_UPGRADES:
+                try:
+                    db.session.execute(text(stmt))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Schema upgrade skipped ({stmt.split(' ON ')[0]}): {e}")
+            if db.engine.dialect.name == 'postgresql' and message_partitions.is_partitioned(db.session):
+                _partition_state['enabled'] = True
+                try:
+                    created = message_partitions.ensure_future(db.session, ahead=app.config['MESSAGE_PARTITIONS_AHEAD'])
+                    db.session.commit()
+                    if created:
+                        print(f"Created message partitions: {', '.join(created)}")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Message partition setup skipped: {e}")
+            try:
+                message_search.setup(db.session, db.engine.dialect.name)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Message search index setup skipped: {e}")
             print("Database initialized successfully with all tables!")
             print("Users, profiles, friendships, and messages tables ready!")
     except Exception as e:
@@ -1926,39 +2939,43 @@ def presence_ping():
     user.is_online = True
     user.last_login = datetime.utcnow()
     try:
-        with session_lock:
-            user_sessions[user.id] = {
-                'last_activity': time.time(),
-                'public_key': user.public_key,
-                'is_online': True
-            }
+        cache_backend.touch_session(user.id, public_key=user.public_key, is_online=True)
     except Exception:
         pass
     db.session.commit()
     return jsonify({'ok': True, 'ts': int(time.time())})
 
+@app.before_request
+def _count_request():
+    with _request_stats_lock:
+        _request_stats['requests'] += 1
+
 # Mark user as active on every request for precise presence
+_PRESENCE_DB_TOUCH_S = 60
+_presence_db_touched = {}
+
 @app.before_request
 def _mark_active_request():
     try:
         uid = session.get('user_id')
         if uid:
-            with session_lock:
-                sess = user_sessions.get(uid) or {}
-                sess['last_activity'] = time.time()
-                sess['is_online'] = True
-                sess['public_key'] = sess.get('public_key')
-                user_sessions[uid] = sess
-            # Opportunistically set DB flag without heavy writes more often than every 60s
-            u = User.query.get(uid)
-            if u:
-                now = datetime.utcnow()
-                if not u.last_login or (now - (u.last_login or now)).total_seconds() > 60:
-                    u.last_login = now
-                    u.is_online = True
-                    db.session.commit()
+            cache_backend.touch_session(uid, is_online=True)
+            # Opportunistically set the DB flag at most every 60s per user and worker,
+            # as one conditional UPDATE instead of a SELECT on every request
+            now_mono = time.monotonic()
+            if now_mono - _presence_db_touched.get(uid, -_PRESENCE_DB_TOUCH_S) < _PRESENCE_DB_TOUCH_S:
+                return
+            _presence_db_touched[uid] = now_mono
+            now = datetime.utcnow()
+            db.session.execute(
+                db.update(User)
+                .where(User.id == uid, db.or_(User.last_login.is_(None), User.last_login < now - timedelta(seconds=_PRESENCE_DB_TOUCH_S)))
+                .values(last_login=now, is_online=True)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
     except Exception:
-        pass
+        db.session.rollback()
 
 # Presence window configuration (seconds)
 _PRESENCE_WINDOW_S = 30
@@ -1970,10 +2987,9 @@ def presence_get(user_id):
         return jsonify({'online': False, 'last_seen': None})
     active_recent = False
     try:
-        with session_lock:
-            s = user_sessions.get(user_id)
-            if s and (time.time() - s.get('last_activity', 0)) < _PRESENCE_WINDOW_S:
-                active_recent = True
+        s = cache_backend.get_session(user_id)
+        if s and (time.time() - s.get('last_activity', 0)) < _PRESENCE_WINDOW_S:
+            active_recent = True
     except Exception:
         pass
     online = bool(active_recent)
@@ -1989,11 +3005,11 @@ def presence_bulk():
         ids = []
     result = {}
     now = time.time()
-    with session_lock:
-        for uid in ids:
-            s = user_sessions.get(uid) or {}
-            online = (now - s.get('last_activity', 0)) < _PRESENCE_WINDOW_S
-            result[str(uid)] = {'online': online}
+    sessions = cache_backend.get_sessions(ids)
+    for uid in ids:
+        s = sessions.get(uid) or {}
+        online = (now - s.get('last_activity', 0)) < _PRESENCE_WINDOW_S
+        result[str(uid)] = {'online': online}
     return jsonify(result)
 
 @app.route('/api/profile/update-location', methods=['POST'])
@@ -2031,6 +3047,10 @@ def get_location(user_id):
     if not user or not user.is_active:
         return jsonify({'error': 'User not found'}), 404
     profile = UserProfile.query.filter_by(user_id=user_id).first()
+    etag = _version_etag('location', user_id, profile.last_updated if profile else None)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
     data = {'lat': None, 'lon': None, 'timezone': None}
     if profile:
         try:
@@ -2041,11 +3061,57 @@ def get_location(user_id):
         data['lat'] = loc.get('lat')
         data['lon'] = loc.get('lon')
         data['timezone'] = settings.get('timezone') or profile.timezone
-    return jsonify(data)
+    return _with_etag(jsonify(data), etag)
 
 # Chat attachments upload
+def _chat_attachment(rel_path, filename, mimetype=None, **extra):
+    """Upload response for a stored attachment. `url` is what the client sends as the message
+    content; photos also get a downscaled preview and their dimensions."""
+    url = url_for('serve_upload', filename=f"chat/{rel_path}")
+    filename = secure_filename(filename or '') or os.path.basename(rel_path)
+    out = dict(extra, url=f"{url}?name={quote(filename)}", original_url=url)
+    mimetype = mimetype or mimetypes.guess_type(filename)[0]
+    if mimetype not in image_variants.PREVIEW_MIME_TYPES or not image_variants.IMAGING_AVAILABLE:
+        return out
+
+    # Photos: the chat shows a small preview inline and links the original
+    preview_rel = f"previews/{rel_path}{image_variants.preview_format()[1]}"
+    preview_path = os.path.join(chat_uploads.root, preview_rel)
+    os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+    try:
+        info = chat_previews.run(os.path.join(chat_uploads.root, rel_path), preview_path)
+    except ValueError:
+        # Claimed to be an image but is not one; keep it as a plain attachment
+        return out
+    if info is None:
+        out['url'] = url
+        return out
+    out.update(width=info['width'], height=info['height'])
+    if 'preview_width' in info:
+        out['preview_url'] = url_for('serve_upload', filename=f"chat/{preview_rel}")
+        out['preview_width'] = info['preview_width']
+        out['preview_height'] = info['preview_height']
+        # The preview, with its size in the fragment so the chat can reserve the space
+        out['url'] = f"{out['preview_url']}#{info['preview_width']}x{info['preview_height']}"
+    else:
+        out['url'] = f"{url}#{info['width']}x{info['height']}"
+    return out
+
+def _upload_error(e):
+    body = {'error': str(e)}
+    if e.received is not None:
+        body['received'] = e.received
+    return jsonify(body), e.status
+
+def _own_upload(upload_id):
+    record = chat_uploads.status(upload_id)
+    if record is None or record['user_id'] != session['user_id']:
+        return None
+    return record
+
 @app.route('/api/chat/upload', methods=['POST'])
 def upload_chat_attachment():
+    """One-shot upload for small files (up to MAX_CONTENT_LENGTH); larger ones use the chunked routes below"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     if 'file' not in request.files:
@@ -2053,23 +3119,83 @@ def upload_chat_attachment():
     f = request.files['file']
     if f.filename == '':
         return jsonify({'error': 'Empty filename'}), 400
-    # Allow common types
-    allowed = {'image/jpeg','image/png','image/gif','image/webp','application/pdf','text/plain','application/zip','application/x-rar-compressed','application/vnd.openxmlformats-officedocument.wordprocessingml.document','application/msword'}
-    if f.mimetype not in allowed:
-        # Still accept but mark generic
-        pass
-    # Save to uploads/chat/
-    chat_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'chat')
-    os.makedirs(chat_dir, exist_ok=True)
-    filename = secure_filename(f.filename)
-    # Avoid collisions
-    ts = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
-    base, ext = os.path.splitext(filename)
-    safe_name = f"{base}_{ts}{ext}"
-    path = os.path.join(chat_dir, safe_name)
-    f.save(path)
-    url = url_for('serve_upload', filename=f"chat/{safe_name}")
-    return jsonify({'url': url})
+    try:
+        rel_path, digest, deduplicated = chat_uploads.store_stream(f.stream, f.filename)
+    except UploadError as e:
+        return _upload_error(e)
+    return jsonify(_chat_attachment(rel_path, f.filename, f.mimetype, sha256=digest, deduplicated=deduplicated))
+
+@app.route('/api/chat/upload/init', methods=['POST'])
+def init_chat_upload():
+    """Start a chunked upload. With the file's sha256, a file already stored is done right away."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    data = request.get_json(silent=True) or {}
+    filename = (data.get('filename') or '').strip()
+    if not filename:
+        return jsonify({'error': 'filename is required'}), 400
+    size = data.get('size')
+    if isinstance(size, bool):
+        size = None
+    existing = chat_uploads.find(data.get('sha256'), clean_extension(filename))
+    if existing:
+        return jsonify(_chat_attachment(existing, filename, data.get('mimetype'),
+                                        sha256=data['sha256'].lower(), deduplicated=True, done=True))
+    try:
+        record = chat_uploads.create(session['user_id'], filename, size, data.get('mimetype'))
+    except UploadError as e:
+        return _upload_error(e)
+    return jsonify({
+        'upload_id': record['id'],
+        'received': 0,
+        'size': record['size'],
+        'chunk_size': min(app.config['CHAT_UPLOAD_CHUNK_BYTES'], app.config['MAX_CONTENT_LENGTH'])
+    }), 201
+
+@app.route('/api/chat/upload/<upload_id>', methods=['GET'])
+def chat_upload_status(upload_id):
+    """Where to resume: bytes the server has for this upload"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    record = _own_upload(upload_id)
+    if record is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify({'upload_id': upload_id, 'size': record['size'], 'received': record['received'],
+                    'done': 'path' in record})
+
+@app.route('/api/chat/upload/<upload_id>', methods=['PUT'])
+def put_chat_upload_chunk(upload_id):
+    """Append the request body at ?offset=N, streamed to disk; 409 carries the offset to resume from"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if _own_upload(upload_id) is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({'error': 'offset is required'}), 400
+    try:
+        received = chat_uploads.append(upload_id, offset, request.stream)
+    except UploadError as e:
+        return _upload_error(e)
+    return jsonify({'upload_id': upload_id, 'received': received})
+
+@app.route('/api/chat/upload/<upload_id>/complete', methods=['POST'])
+def complete_chat_upload(upload_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    record = _own_upload(upload_id)
+    if record is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    try:
+        rel_path, digest, deduplicated = chat_uploads.finalize(upload_id)
+    except UploadError as e:
+        return _upload_error(e)
+    return jsonify(_chat_attachment(rel_path, record['filename'], record['mimetype'],
+                                    sha256=digest, deduplicated=deduplicated, done=True))
+
+def _bump_feed_version(author_id):
+    """Change the feed ETag of everyone who sees author_id's posts; commits with the caller's write"""
+    User.query.filter_by(id=author_id).update({User.feed_version: User.feed_version + 1}, synchronize_session=False)
 
 # Create Post API
 @app.route('/api/posts/create', methods=['POST'])
@@ -2094,6 +3220,7 @@ def create_post_api():
             content=content
         )
         db.session.add(post)
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         return jsonify({
@@ -2127,7 +3254,7 @@ def toggle_post_like(post_id):
             like = PostLike(user_id=session['user_id'], post_id=post_id)
             db.session.add(like)
             liked = True
-        
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         # Get updated like count
@@ -2167,6 +3294,7 @@ def comment_on_post(post_id):
             content=content
         )
         db.session.add(comment)
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         # Get updated comment count
@@ -2207,7 +3335,7 @@ def toggle_post_repost(post_id):
             repost = PostRepost(user_id=session['user_id'], post_id=post_id)
             db.session.add(repost)
             reposted = True
-        
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         # Get updated repost count
@@ -2256,7 +3384,7 @@ def get_post_comments(post_id):
                             'username': user.username,
                             'first_name': user.first_name,
                             'last_name': user.last_name,
-                            'profile_picture': user.profile_picture
+                            'profile_picture': sized_avatar_url(user.profile_picture, 96)
                         }
                     })
                 else:
@@ -2302,6 +3430,7 @@ def update_post(post_id):
         # Update the post
         post.content = content
         post.updated_at = datetime.utcnow()
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         return jsonify({
@@ -2328,6 +3457,7 @@ def delete_post(post_id):
         
         # Delete the post (cascade will handle likes, comments, reposts)
         db.session.delete(post)
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         return jsonify({
@@ -2389,6 +3519,7 @@ def delete_comment(comment_id):
         
         # Delete the comment
         db.session.delete(comment)
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         # Get updated comment count
@@ -2403,6 +3534,22 @@ def delete_comment(comment_id):
         db.session.rollback()
         return jsonify({'error': 'Failed to delete comment'}), 500
 
+def _feed_version(viewer_id, author_id=None):
+    """Version stamp of a post feed (one author, or the viewer and their friends): each
+    author's feed_version, bumped by every post, edit, delete, like, comment and repost
+    on their posts, plus the names and pictures the feed shows. One indexed query over
+    the authors' rows, however long their post history."""
+    if author_id is not None:
+        is_author = User.id == author_id
+    else:
+        friend_ids = db.select(Friendship.friend_id).where(Friendship.user_id == viewer_id)
+        is_author = db.or_(User.id == viewer_id, User.id.in_(friend_ids))
+    authors = db.session.execute(
+        db.select(User.id, User.feed_version, User.username, User.first_name, User.last_name, User.profile_picture)
+        .where(is_author).order_by(User.id)
+    ).all()
+    return [tuple(a) for a in authors]
+
 # Get Posts API
 @app.route('/api/posts')
 def get_posts():
@@ -2414,6 +3561,13 @@ def get_posts():
     user_id = request.args.get('user_id', type=int)
     
     try:
+        # The dashboard refreshes every 10 s; answer unchanged feeds before building them
+        etag = _version_etag('feed', session['user_id'], user_id, page, per_page,
+                             _feed_version(session['user_id'], user_id))
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+        
         if user_id:
             # Get posts for specific user
             posts = Post.query.filter_by(user_id=user_id)\
@@ -2467,17 +3621,17 @@ def get_posts():
                     'username': user.username,
                     'first_name': user.first_name,
                     'last_name': user.last_name,
-                    'profile_picture': user.profile_picture
+                    'profile_picture': sized_avatar_url(user.profile_picture, 96)
                 }
             })
         
-        return jsonify({
+        return _with_etag(jsonify({
             'posts': posts_data,
             'has_next': posts.has_next,
             'has_prev': posts.has_prev,
             'total': posts.total,
             'pages': posts.pages
-        })
+        }), etag)
     except Exception as e:
         return jsonify({'error': 'Failed to fetch posts'}), 500
 
@@ -2500,6 +3654,7 @@ def create_test_comment():
             content='This is a test comment'
         )
         db.session.add(comment)
+        _bump_feed_version(post.user_id)
         db.session.commit()
         
         return jsonify({
@@ -2566,6 +3721,40 @@ def debug_comments():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+# Debug endpoint for load testing: cumulative request and SQL statement counters
+@app.route('/api/debug/stats')
+def debug_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    with _request_stats_lock:
+        stats = dict(_request_stats)
+    stats['uptime_s'] = time.time() - stats.pop('started_at')
+    stats['message_subscribers'] = message_hub.subscriber_count()
+    stats['typing_subscribers'] = typing_hub.subscriber_count()
+    stats['long_poll_conversations'] = message_waiters.waiting_count()
+    stats['receipt_subscribers'] = receipt_hub.subscriber_count()
+    stats['push'] = push_dispatcher.stats()
+    stats['message_fragments'] = message_fragments.stats()
+    stats['avatar_cache'] = avatar_blobs.stats()
+    stats['chat_previews'] = chat_previews.stats()
+    stats['chat_uploads'] = chat_uploads.stats()
+    stats['friendship_index'] = friendship_index.stats()
+    stats['unread_reconciler'] = dict(_reconcile_stats)
+    with _partition_lock:
+        stats['message_partitions'] = {
+            'enabled': _partition_state['enabled'],
+            'recent': _partition_state['recent'].isoformat() if _partition_state['recent'] else None,
+            'min_id': _partition_state['min_id']
+        }
+    stats['read_marker'] = {
+        'pending': read_marker.pending_count(),
+        'flushes': read_marker.flushes,
+        'rows_marked': read_marker.rows_marked
+    }
+    stats['cache'] = cache_backend.stats()
+    stats['compression'] = compression.stats() if compression else None
+    return jsonify(stats)
+
 # Geocoding proxy (avoids CORS and requires UA)
 @app.route('/api/geo/search')
 def geo_search():
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Response compression benchmark: bytes saved and CPU time per response for
+the encoders in compression.py, over payloads shaped like the app's own:
+message lists from /api/messages/<id> at several sizes, a post feed, the
+big templates (dashboard / user_profile / direct_chat, raw source as a
+stand-in for the rendered HTML) and a streamed NDJSON export compressed
+chunk by chunk. Runs offline, no database or server needed. Brotli rows
+appear when the brotli package is installed.
+
+    python bench_compression.py          # best of 5 x 50 per cell
+    python bench_compression.py 200
+"""
+
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import compression
+
+TEMPLATES = ('dashboard.html', 'user_profile.html', 'direct_chat.html')
+SETTINGS = [('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if compression.brotli is not None:
+    SETTINGS += [('br', 1), ('br', 5), ('br', 11)]
+
+
+def make_messages(n):
+    base = datetime(2024, 1, 1)
+    return [{
+        'id': i,
+        'content': f"message {i} " + "lorem ipsum dolor sit amet " * 3,
+        'sender_id': 1 + i % 2,
+        'receiver_id': 2 - i % 2,
+        'is_read': i % 3 == 0,
+        'timestamp': (base + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S'),
+        'message_type': 'text'
+    } for i in range(1, n + 1)]
+
+
+def make_posts(n):
+    base = datetime(2024, 1, 1)
+    return {'posts': [{
+        'id': i,
+        'user_id': 1 + i % 40,
+        'username': f"user{1 + i % 40}",
+        'profile_picture': f"/avatar/{1 + i % 40}",
+        'content': f"post {i}: " + "what a day, check this out " * (1 + i % 5),
+        'image_url': f"/uploads/post_{i}.jpg" if i % 3 == 0 else None,
+        'likes': i * 7 % 53,
+        'comments': i * 3 % 11,
+        'liked': i % 4 == 0,
+        'created_at': (base + timedelta(minutes=i)).isoformat()
+    } for i in range(1, n + 1)]}
+
+
+def payloads():
+    out = []
+    for n in (5, 50, 200):
+        body = json.dumps({'messages': make_messages(n), 'read_ids': []}, separators=(',', ':')).encode()
+        out.append((f"messages x{n}", body))
+    out.append(("posts x20", json.dumps(make_posts(20), separators=(',', ':')).encode()))
+    templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for name in TEMPLATES:
+        path = os.path.join(templates_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                out.append((name, f.read()))
+    return out
+
+
+def stream_chunks(rows=20000, chunk_bytes=64 * 1024):
+    """NDJSON export lines grouped into chunks the way app._export_response does"""
+    chunks, buf = [], []
+    size = 0
+    for m in make_messages(rows):
+        line = json.dumps(m, separators=(',', ':')).encode() + b'\n'
+        buf.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            chunks.append(b''.join(buf))
+            buf, size = [], 0
+    if buf:
+        chunks.append(b''.join(buf))
+    return chunks
+
+
+def compress_stream(chunks, coding, level):
+    encoder = compression.make_encoder(coding, gzip_level=level, brotli_quality=level)
+    total = 0
+    for chunk in chunks:
+        total += len(encoder.compress(chunk) + encoder.flush())
+    return total + len(encoder.finish())
+
+
+def best(fn, repeat):
+    return min(timeit.repeat(fn, number=repeat, repeat=5)) / repeat
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"🗜️  Response compression benchmark (best of 5 x {repeat}, brotli "
+          f"{'installed' if compression.brotli else 'not installed'})")
+    print("=" * 78)
+    print(f"{'payload':<18} {'size':>9} {'encoding':>9} {'out':>9} {'saved':>7} {'cpu':>10} {'MB/s':>8}")
+    results = {}
+    for label, body in payloads():
+        for coding, level in SETTINGS:
+            out = len(compression.compress_bytes(body, coding, gzip_level=level, brotli_quality=level))
+            seconds = best(lambda: compression.compress_bytes(body, coding, gzip_level=level, brotli_quality=level), repeat)
+            name = f"{coding}-{level}"
+            print(f"{label:<18} {len(body):>9,} {name:>9} {out:>9,} {1 - out / len(body):>6.1%} "
+                  f"{seconds * 1e6:>7.0f} µs {len(body) / seconds / 1e6:>8.1f}")
+            results.setdefault(label, {})[name] = {'bytes': len(body), 'out': out, 'us': round(seconds * 1e6, 1)}
+        print()
+
+    chunks = stream_chunks()
+    total = sum(len(c) for c in chunks)
+    print(f"Streamed NDJSON export: {total:,} bytes in {len(chunks)} chunks, flushed after each chunk")
+    for coding, level in SETTINGS:
+        out = compress_stream(chunks, coding, level)
+        seconds = best(lambda: compress_stream(chunks, coding, level), max(1, repeat // 10))
+        print(f"{'export stream':<18} {total:>9,} {f'{coding}-{level}':>9} {out:>9,} {1 - out / total:>6.1%} "
+              f"{seconds * 1e3:>7.1f} ms {total / seconds / 1e6:>8.1f}")
+    print("\nThe app uses gzip-6 / br-5 by default (COMPRESS_GZIP_LEVEL, COMPRESS_BROTLI_QUALITY) "
+          "and skips bodies under COMPRESS_MIN_SIZE bytes")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Realtime delivery benchmark: 400 ms polling vs. the /ws/messages push channel.
+Opens N simulated chat tabs against a running instance, sends one message per
+second, and reports requests/sec and DB queries/sec from /api/debug/stats.
+"""
+
+import json
+import sys
+import threading
+import time
+
+import requests
+from simple_websocket import Client, ConnectionClosed
+
+POLL_INTERVAL = 0.4
+SEND_INTERVAL = 1.0
+
+
+def login(base_url, username, password):
+    """Return a logged-in requests session."""
+    s = requests.Session()
+    r = s.post(f"{base_url}/login", data={'username': username, 'password': password}, timeout=30)
+    r.raise_for_status()
+    if 'session' not in s.cookies:
+        raise SystemExit("✗ Login failed")
+    return s
+
+
+def read_stats(s, base_url):
+    return s.get(f"{base_url}/api/debug/stats", timeout=30).json()
+
+
+def sender(s, base_url, friend_id, stop):
+    n = 0
+    while not stop.is_set():
+        n += 1
+        s.post(f"{base_url}/api/messages/send", json={'receiver_id': friend_id, 'content': f"bench {n}"}, timeout=30)
+        time.sleep(SEND_INTERVAL)
+
+
+def polling_tab(s, base_url, friend_id, stop):
+    while not stop.is_set():
+        try:
+            s.get(f"{base_url}/api/messages/{friend_id}/latest", timeout=30)
+        except Exception:
+            pass
+        time.sleep(POLL_INTERVAL)
+
+
+def socket_tab(s, base_url, chat_session_id, stop):
+    ws_url = base_url.replace('http', 'ws', 1) + f"/ws/messages/{chat_session_id}"
+    cookie = '; '.join(f"{k}={v}" for k, v in s.cookies.items())
+    ws = Client.connect(ws_url, headers={'Cookie': cookie})
+    try:
+        while not stop.is_set():
+            try:
+                ws.receive(timeout=0.5)
+            except ConnectionClosed:
+                break
+    finally:
+        ws.close()
+
+
+def run(label, s, base_url, tab_target, tab_args, friend_id, tabs, seconds):
+    stop = threading.Event()
+    workers = [threading.Thread(target=tab_target, args=(s, base_url, *tab_args, stop), daemon=True) for _ in range(tabs)]
+    for w in workers:
+        w.start()
+    time.sleep(1)  # let sockets connect before measuring
+    before = read_stats(s, base_url)
+    send_thread = threading.Thread(target=sender, args=(s, base_url, friend_id, stop), daemon=True)
+    send_thread.start()
+    time.sleep(seconds)
+    after = read_stats(s, base_url)
+    stop.set()
+    for w in workers + [send_thread]:
+        w.join(timeout=5)
+    elapsed = after['uptime_s'] - before['uptime_s']
+    rps = (after['requests'] - before['requests']) / elapsed
+    qps = (after['queries'] - before['queries']) / elapsed
+    print(f"{label:<10} tabs={tabs:<4} requests/s={rps:8.1f}  queries/s={qps:8.1f}")
+    return rps, qps
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print("Usage: python3 bench_realtime.py <app_url> <username> <password> <friend_user_id> <chat_session_id> [tabs] [seconds]")
+        print("Example: python3 bench_realtime.py http://127.0.0.1:5050 alice secret 2 3f9a... 50 20")
+        sys.exit(1)
+
+    base_url = sys.argv[1].rstrip('/')
+    username, password = sys.argv[2], sys.argv[3]
+    friend_id = int(sys.argv[4])
+    chat_session_id = sys.argv[5]
+    tabs = int(sys.argv[6]) if len(sys.argv) > 6 else 50
+    seconds = float(sys.argv[7]) if len(sys.argv) > 7 else 20
+
+    s = login(base_url, username, password)
+    print(f"Benchmarking {base_url} ({tabs} tabs, {seconds:.0f}s per mode)")
+    poll = run('polling', s, base_url, polling_tab, (friend_id,), friend_id, tabs, seconds)
+    push = run('websocket', s, base_url, socket_tab, (chat_session_id,), friend_id, tabs, seconds)
+    print(json.dumps({
+        'polling': {'requests_per_s': round(poll[0], 1), 'queries_per_s': round(poll[1], 1)},
+        'websocket': {'requests_per_s': round(push[0], 1), 'queries_per_s': round(push[1], 1)},
+    }, indent=2))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Message search benchmark: content LIKE '%term%' vs. the text index from
+message_search (FTS5 on SQLite, GIN tsvector on Postgres) over a synthetic
+corpus, default 5M messages. Words follow a Zipf-like distribution so the
+common / mid / rare terms below match very different numbers of rows.
+
+    python bench_search.py                      # 5M rows, temp SQLite file
+    python bench_search.py 500000               # smaller corpus
+    python bench_search.py 5000000 postgresql+psycopg://user:pw@host/scratch
+
+Point it at a scratch database only: it creates and fills a messages table.
+An existing table that already holds enough rows is reused, so reruns skip
+the generation step.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+import message_search
+
+VOCABULARY = 20000
+USERS = 2000
+CHATS_PER_USER = 20
+BATCH = 20000
+QUERY_USERS = 20
+TERMS = {'common': 3, 'mid': 300, 'rare': 15000}
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+def create_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, chat_session_id VARCHAR(64) NOT NULL, "
+        "sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, content TEXT NOT NULL, "
+        "message_type VARCHAR(20) DEFAULT 'text', is_read BOOLEAN DEFAULT false, timestamp TIMESTAMP, "
+        "deleted_at TIMESTAMP)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_session_id ON messages (chat_session_id, id)"))
+
+
+def chat_of(a, b):
+    # Same shape as the app's ids: one hex token
+    return f"{min(a, b):032x}{max(a, b):032x}"
+
+
+def partners(user):
+    # Ring topology: every user has CHATS_PER_USER friends, each chat shared by two users
+    half = CHATS_PER_USER // 2
+    return [(user + d) % USERS for d in range(-half, half + 1) if d]
+
+
+def fill(conn, rows):
+    rng = random.Random(42)
+    weights = [1.0 / r for r in range(1, VOCABULARY + 1)]
+    cum, total = [], 0.0
+    for w in weights:
+        total += w
+        cum.append(total)
+    vocab = [word(r) for r in range(1, VOCABULARY + 1)]
+    base = datetime(2024, 1, 1)
+    insert = text("INSERT INTO messages (id, chat_session_id, sender_id, receiver_id, content, message_type, "
+                  "is_read, timestamp) VALUES (:id, :chat, :sender, :receiver, :content, 'text', true, :ts)")
+    started = time.monotonic()
+    for start in range(1, rows + 1, BATCH):
+        batch = []
+        for i in range(start, min(rows + 1, start + BATCH)):
+            sender = rng.randrange(USERS)
+            receiver = partners(sender)[rng.randrange(CHATS_PER_USER)]
+            content = ' '.join(rng.choices(vocab, cum_weights=cum, k=rng.randint(3, 14)))
+            batch.append({'id': i, 'chat': chat_of(sender, receiver), 'sender': sender, 'receiver': receiver,
+                          'content': content, 'ts': base + timedelta(seconds=i)})
+        conn.execute(insert, batch)
+        conn.commit()
+        done = min(rows, start + BATCH - 1)
+        if done % 500000 < BATCH:
+            print(f"  {done:>9,} rows  {time.monotonic() - started:6.1f} s")
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def like_search(conn, term, chats, limit):
+    sql = ("SELECT id FROM messages WHERE content LIKE :pattern AND message_type = 'text' AND deleted_at IS NULL")
+    params = {'pattern': f"%{term}%", 'limit': limit}
+    if chats is not None:
+        sql += " AND chat_session_id IN (%s)" % ', '.join(f":c{i}" for i in range(len(chats)))
+        params.update({f"c{i}": c for i, c in enumerate(chats)})
+    return conn.execute(text(sql + " ORDER BY id DESC LIMIT :limit"), params).fetchall()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    url = sys.argv[2] if len(sys.argv) > 2 else f"sqlite:///{os.path.join(tempfile.gettempdir(), 'bench_search.sqlite3')}"
+    engine = create_engine(url)
+    dialect = engine.dialect.name
+    if not message_search.supported(dialect):
+        raise SystemExit(f"❌ No search support for {dialect}")
+
+    print(f"🔎 Message search benchmark ({dialect}, {rows:,} messages)")
+    print("=" * 60)
+    with engine.connect() as conn:
+        create_table(conn)
+        conn.commit()
+        have = conn.execute(text("SELECT COUNT(*) FROM messages")).scalar()
+        if have < rows:
+            if have:
+                raise SystemExit(f"❌ messages already holds {have:,} rows; use an empty scratch database")
+            print("Generating corpus...")
+            fill(conn, rows)
+        started = time.monotonic()
+        message_search.setup(conn, dialect)
+        if dialect == 'postgresql':
+            conn.execute(text("ANALYZE messages"))
+        conn.commit()
+        print(f"Text index ready in {time.monotonic() - started:.1f} s\n")
+
+        rng = random.Random(7)
+        users = [rng.randrange(USERS) for _ in range(QUERY_USERS)]
+        scopes = [[chat_of(u, p) for p in partners(u)] for u in users]
+        print(f"{'term':>8} {'LIKE all':>12} {'LIKE scoped':>12} {'index scoped':>13} {'hits/user':>10}")
+        for label, rank in TERMS.items():
+            term = word(rank)
+            # Trailing space keeps w3 from matching w30..w39 in the LIKE baseline
+            like_all, _ = timed(lambda: like_search(conn, term + ' ', None, 20), 1)
+            like_scoped = indexed = hits = 0.0
+            for chats in scopes:
+                t, _ = timed(lambda: like_search(conn, term + ' ', chats, 20), 3)
+                like_scoped += t
+                t, (found, _) = timed(lambda: message_search.search(conn, dialect, term, chats, limit=20), 3)
+                indexed += t
+                hits += len(found)
+            n = len(scopes)
+            print(f"{label:>8} {like_all * 1000:>9.1f} ms {like_scoped / n * 1000:>9.2f} ms "
+                  f"{indexed / n * 1000:>10.2f} ms {hits / n:>10.1f}")
+    print("\nLIKE all = one unscoped scan; scoped columns are averaged over "
+          f"{QUERY_USERS} users x {CHATS_PER_USER} chats, best of 3")
+
+
+if __name__ == "__main__":
+    main()
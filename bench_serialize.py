@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Message serialization microbenchmark: jsonify() of the message list on every
+poll vs. joining the pre-encoded fragments from FragmentCache. Runs offline,
+no database or server needed.
+"""
+
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+from cache_backends import FragmentCache
+
+app = Flask(__name__)
+
+
+def make_messages(n):
+    base = datetime(2024, 1, 1)
+    return [{
+        'id': i,
+        'content': f"message {i} " + "lorem ipsum dolor sit amet " * 3,
+        'sender_id': 1 + i % 2,
+        'receiver_id': 2 - i % 2,
+        'is_read': i % 3 == 0,
+        'timestamp': (base + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S'),
+        'message_type': 'text'
+    } for i in range(1, n + 1)]
+
+
+def with_jsonify(messages):
+    return jsonify({'messages': messages, 'read_ids': []}).get_data()
+
+
+def with_fragments(fragments, messages):
+    # Same assembly as app._messages_response
+    parts = [b'{"messages":[', b','.join([fragments.encode(m) for m in messages]), b']',
+             b',', json.dumps({'read_ids': []}, separators=(',', ':')).encode()[1:-1], b'}']
+    return b''.join(parts)
+
+
+def bench(n, repeat):
+    messages = make_messages(n)
+    fragments = FragmentCache()
+    with app.app_context():
+        assert json.loads(with_jsonify(messages)) == json.loads(with_fragments(fragments, messages))
+        baseline = min(timeit.repeat(lambda: with_jsonify(messages), number=repeat, repeat=5)) / repeat
+        cached = min(timeit.repeat(lambda: with_fragments(fragments, messages), number=repeat, repeat=5)) / repeat
+    print(f"{n:>4} messages  jsonify={baseline * 1e6:9.1f} µs  fragments={cached * 1e6:9.1f} µs  "
+          f"saved={(baseline - cached) * 1e6:9.1f} µs/poll ({baseline / cached:4.1f}x)")
+    return baseline, cached
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"Per-poll response encoding (best of 5 x {repeat})")
+    results = {n: bench(n, repeat) for n in (50, 500)}
+    print(json.dumps({str(n): {'jsonify_us': round(b * 1e6, 1), 'fragments_us': round(c * 1e6, 1)}
+                      for n, (b, c) in results.items()}, indent=2))
@@ -0,0 +1,818 @@
+"""
+Cache backends for the chat hot paths.
+
+app.py keeps three pieces of volatile state: the per-conversation message
+windows, recent read receipts and the presence session map. With the plain
+in-process dicts each gunicorn worker saw its own copy, so everything here
+goes through one interface with three implementations:
+
+    memory  - in-process (single worker), the original behaviour
+    sqlite  - a WAL-mode SQLite file shared by every worker on the host
+    redis   - any Redis-protocol server (redis, valkey, KeyDB, a local stand-in)
+
+Pick one with CACHE_BACKEND (memory | sqlite | redis), see make_cache_backend().
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    redis = None
+
+# Read receipts older than this are dropped; clients poll far more often
+READ_RECEIPT_TTL_S = 60
+READ_RECEIPT_MAX = 500
+
+
+class FragmentCache:
+    """Pre-encoded JSON for message dicts, keyed by (id, is_read).
+
+    Message content never changes after insert, so the only field that can
+    go stale is is_read; keying on it means a read flip is a cache miss and
+    the old fragment simply ages out. Entries are evicted oldest-first once
+    max_entries is reached. Works with any backend (and rows straight from
+    the DB) because it only sees the serialized dicts.
+    """
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, msg):
+        key = (msg['id'], bool(msg['is_read']))
+        frag = self._data.get(key)
+        if frag is not None:
+            self.hits += 1
+            return frag
+        self.misses += 1
+        frag = json.dumps(msg, separators=(',', ':')).encode()
+        with self._lock:
+            self._data[key] = frag
+            # The unread copy is dead once the read one exists
+            if key[1]:
+                self._data.pop((key[0], False), None)
+            while len(self._data) > self.max_entries:
+                del self._data[next(iter(self._data))]
+        return frag
+
+    def stats(self):
+        return {'entries': len(self._data), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+
+class BlobCache:
+    """LRU of immutable byte strings (decoded avatars and their variants) under a byte budget.
+
+    Keys must change whenever the bytes do (app.py keys on the content hash),
+    so entries never need invalidating; they just age out least-recently-used
+    first once max_bytes is reached. Values larger than max_item_bytes are
+    not cached at all, so one big image can't flush everything else.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes // 8
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, mime_type, data):
+        size = len(data)
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._data[key] = (mime_type, data)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class CacheBackend:
+    """Interface used by app.py. Message dicts are the serialized cache shape
+    ({'id', 'content', 'sender_id', 'receiver_id', 'is_read', 'timestamp',
+    'message_type'}); windows are returned oldest-first."""
+
+    name = 'base'
+
+    # Message windows (newest N messages of a conversation)
+    def get_messages(self, key):
+        """Return the cached window as a list, or None if the conversation isn't cached"""
+        raise NotImplementedError
+
+    def get_messages_since(self, key, since_id):
+        """Messages with id > since_id (oldest-first), or None if the conversation isn't
+        cached or the cursor is older than the window (there may be a gap before it)"""
+        window = self.get_messages(key)
+        if window is None or (window and since_id < window[0]['id']):
+            return None
+        return window[bisect_right([m['id'] for m in window], since_id):]
+
+    def set_messages(self, key, messages):
+        raise NotImplementedError
+
+    def append_message(self, key, message):
+        """Add to a cached window; no-op (False) if the conversation isn't cached"""
+        raise NotImplementedError
+
+    def mark_read(self, key, ids):
+        raise NotImplementedError
+
+    def clear_messages(self, key):
+        """Empty a window but keep it cached (the conversation is known to be empty)"""
+        raise NotImplementedError
+
+    # Read receipts
+    def add_read_receipts(self, chat_session_id, ids, ts=None):
+        raise NotImplementedError
+
+    def get_read_receipts(self, chat_session_id, since=0.0):
+        """Return [{'id', 'ts'}] newer than `since` and younger than READ_RECEIPT_TTL_S"""
+        raise NotImplementedError
+
+    def clear_read_receipts(self, chat_session_id):
+        raise NotImplementedError
+
+    # Presence sessions
+    def touch_session(self, user_id, **fields):
+        """Merge fields into the user's session and bump last_activity"""
+        raise NotImplementedError
+
+    def get_session(self, user_id):
+        raise NotImplementedError
+
+    def get_sessions(self, user_ids):
+        """Return {user_id: session} for the ids that have a session"""
+        return {uid: s for uid in user_ids for s in [self.get_session(uid)] if s}
+
+    def remove_session(self, user_id):
+        raise NotImplementedError
+
+    def prune_sessions(self, max_idle_s):
+        """Drop sessions idle longer than max_idle_s; returns how many were removed"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class _Window:
+    """One conversation's newest messages, kept sorted by id with a parallel
+    id list so cursor lookups and read marking are bisects, not scans."""
+
+    __slots__ = ('ids', 'msgs')
+
+    def __init__(self, messages=()):
+        msgs = sorted(messages, key=lambda m: m['id'])
+        self.ids = [m['id'] for m in msgs]
+        self.msgs = msgs
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, message):
+        msg_id = message['id']
+        if not self.ids or msg_id > self.ids[-1]:
+            self.ids.append(msg_id)
+            self.msgs.append(message)
+            return
+        # Concurrent sends can commit out of order
+        i = bisect_left(self.ids, msg_id)
+        if i < len(self.ids) and self.ids[i] == msg_id:
+            self.msgs[i] = message
+            return
+        self.ids.insert(i, msg_id)
+        self.msgs.insert(i, message)
+
+    def trim(self, maxlen):
+        excess = len(self.ids) - maxlen
+        if excess > 0:
+            del self.ids[:excess]
+            del self.msgs[:excess]
+        return max(excess, 0)
+
+    def since(self, since_id):
+        if self.ids and since_id < self.ids[0]:
+            return None
+        return self.msgs[bisect_right(self.ids, since_id):]
+
+    def find(self, msg_id):
+        i = bisect_left(self.ids, msg_id)
+        if i < len(self.ids) and self.ids[i] == msg_id:
+            return self.msgs[i]
+        return None
+
+
+class MessageCache:
+    """Memory-bounded message cache.
+
+    Each conversation keeps its newest messages in an id-sorted window of at
+    most per_conversation entries; whole conversations are evicted
+    least-recently-used first once the global entry budget is exceeded.
+    get() returns a list snapshot; the message dicts are shared, so mutate
+    them only through mark_read().
+    """
+
+    def __init__(self, max_entries=50000, per_conversation=500):
+        self.max_entries = max_entries
+        self.per_conversation = per_conversation
+        self._data = OrderedDict()
+        self._entries = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            window = self._data.get(key)
+            if window is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return list(window.msgs)
+
+    def since(self, key, since_id):
+        with self._lock:
+            window = self._data.get(key)
+            found = window.since(since_id) if window is not None else None
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return found
+
+    def set(self, key, messages):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._entries -= len(old)
+            window = _Window(messages)
+            window.trim(self.per_conversation)
+            self._data[key] = window
+            self._entries += len(window)
+            self._evict()
+
+    def append(self, key, message):
+        """Append to a cached conversation; no-op if it isn't cached, so a window
+        never starts with a gap in front of it."""
+        with self._lock:
+            window = self._data.get(key)
+            if window is None:
+                return False
+            before = len(window)
+            window.add(message)
+            window.trim(self.per_conversation)
+            self._entries += len(window) - before
+            self._data.move_to_end(key)
+            self._evict()
+            return True
+
+    def mark_read(self, key, ids):
+        with self._lock:
+            window = self._data.get(key)
+            if window is None:
+                return
+            for msg_id in ids:
+                msg = window.find(msg_id)
+                if msg is not None:
+                    msg['is_read'] = True
+
+    def clear(self, key):
+        """Empty a conversation's window but keep it cached (it is known to be empty)"""
+        with self._lock:
+            window = self._data.get(key)
+            if window is not None:
+                self._entries -= len(window)
+                self._data[key] = _Window()
+
+    def _evict(self):
+        # Never evict the most recently used conversation
+        while self._entries > self.max_entries and len(self._data) > 1:
+            _, window = self._data.popitem(last=False)
+            self._entries -= len(window)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._data),
+                'entries': self._entries,
+                'max_entries': self.max_entries,
+                'per_conversation': self.per_conversation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process state; only consistent with a single worker"""
+
+    name = 'memory'
+
+    def __init__(self, max_entries=50000, per_conversation=500):
+        self.messages = MessageCache(max_entries=max_entries, per_conversation=per_conversation)
+        self._read_receipts = {}
+        self._read_receipts_lock = threading.Lock()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def get_messages(self, key):
+        return self.messages.get(key)
+
+    def get_messages_since(self, key, since_id):
+        return self.messages.since(key, since_id)
+
+    def set_messages(self, key, messages):
+        self.messages.set(key, messages)
+
+    def append_message(self, key, message):
+        return self.messages.append(key, message)
+
+    def mark_read(self, key, ids):
+        self.messages.mark_read(key, ids)
+
+    def clear_messages(self, key):
+        self.messages.clear(key)
+
+    def add_read_receipts(self, chat_session_id, ids, ts=None):
+        ts = ts or time.time()
+        with self._read_receipts_lock:
+            rr = self._read_receipts.setdefault(chat_session_id, [])
+            rr.extend({'id': mid, 'ts': ts} for mid in ids)
+            if len(rr) > READ_RECEIPT_MAX:
+                self._read_receipts[chat_session_id] = rr[-READ_RECEIPT_MAX:]
+
+    def get_read_receipts(self, chat_session_id, since=0.0):
+        with self._read_receipts_lock:
+            entries = self._read_receipts.get(chat_session_id, [])
+            cutoff = time.time() - READ_RECEIPT_TTL_S
+            pruned = [e for e in entries if e['ts'] >= cutoff]
+            if len(pruned) != len(entries):
+                self._read_receipts[chat_session_id] = pruned
+            return [e for e in pruned if e['ts'] > since]
+
+    def clear_read_receipts(self, chat_session_id):
+        with self._read_receipts_lock:
+            self._read_receipts.pop(chat_session_id, None)
+
+    def touch_session(self, user_id, **fields):
+        with self._sessions_lock:
+            sess = self._sessions.get(user_id) or {}
+            sess.update(fields)
+            sess['last_activity'] = time.time()
+            self._sessions[user_id] = sess
+
+    def get_session(self, user_id):
+        with self._sessions_lock:
+            sess = self._sessions.get(user_id)
+            return dict(sess) if sess else None
+
+    def remove_session(self, user_id):
+        with self._sessions_lock:
+            self._sessions.pop(user_id, None)
+
+    def prune_sessions(self, max_idle_s):
+        cutoff = time.time() - max_idle_s
+        with self._sessions_lock:
+            stale = [uid for uid, s in self._sessions.items() if s.get('last_activity', 0) < cutoff]
+            for uid in stale:
+                del self._sessions[uid]
+        return len(stale)
+
+    def stats(self):
+        with self._sessions_lock:
+            sessions = len(self._sessions)
+        return {'backend': self.name, 'messages': self.messages.stats(), 'sessions': sessions}
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Host-local shared cache in a WAL-mode SQLite file.
+
+    WAL lets every worker read concurrently while one writes; each thread
+    gets its own connection. Windows are trimmed to per_conversation rows and
+    whole conversations are evicted least-recently-touched first once the
+    entry budget is exceeded.
+    """
+
+    name = 'sqlite'
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS windows (key TEXT PRIMARY KEY, touched REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS idx_windows_touched ON windows (touched)',
+        'CREATE TABLE IF NOT EXISTS window_messages (key TEXT NOT NULL, id INTEGER NOT NULL, '
+        'is_read INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL, PRIMARY KEY (key, id))',
+        'CREATE TABLE IF NOT EXISTS read_receipts (chat_session_id TEXT NOT NULL, id INTEGER NOT NULL, ts REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS idx_read_receipts_chat_ts ON read_receipts (chat_session_id, ts)',
+        'CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, last_activity REAL NOT NULL, data TEXT NOT NULL)',
+    )
+
+    def __init__(self, path, max_entries=50000, per_conversation=500):
+        self.path = path
+        self.max_entries = max_entries
+        self.per_conversation = per_conversation
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        conn = self._conn()
+        with conn:
+            for stmt in self._SCHEMA:
+                conn.execute(stmt)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get_messages(self, key):
+        conn = self._conn()
+        if conn.execute('UPDATE windows SET touched = ? WHERE key = ?', (time.time(), key)).rowcount == 0:
+            self.misses += 1
+            return None
+        self.hits += 1
+        rows = conn.execute('SELECT data, is_read FROM window_messages WHERE key = ? ORDER BY id', (key,)).fetchall()
+        return self._decode(rows)
+
+    def get_messages_since(self, key, since_id):
+        conn = self._conn()
+        if conn.execute('UPDATE windows SET touched = ? WHERE key = ?', (time.time(), key)).rowcount == 0:
+            self.misses += 1
+            return None
+        first = conn.execute('SELECT MIN(id) FROM window_messages WHERE key = ?', (key,)).fetchone()[0]
+        if first is not None and since_id < first:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Range scan on the (key, id) primary key
+        rows = conn.execute('SELECT data, is_read FROM window_messages WHERE key = ? AND id > ? ORDER BY id',
+                            (key, since_id)).fetchall()
+        return self._decode(rows)
+
+    @staticmethod
+    def _decode(rows):
+        out = []
+        for data, is_read in rows:
+            msg = json.loads(data)
+            msg['is_read'] = bool(is_read)
+            out.append(msg)
+        return out
+
+    def set_messages(self, key, messages):
+        messages = list(messages)[-self.per_conversation:]
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO windows (key, touched) VALUES (?, ?)', (key, time.time()))
+            conn.execute('DELETE FROM window_messages WHERE key = ?', (key,))
+            conn.executemany(
+                'INSERT INTO window_messages (key, id, is_read, data) VALUES (?, ?, ?, ?)',
+                [(key, m['id'], int(bool(m.get('is_read'))), json.dumps(m)) for m in messages]
+            )
+            self._evict(conn)
+
+    def append_message(self, key, message):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('UPDATE windows SET touched = ? WHERE key = ?', (time.time(), key)).rowcount == 0:
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO window_messages (key, id, is_read, data) VALUES (?, ?, ?, ?)',
+                (key, message['id'], int(bool(message.get('is_read'))), json.dumps(message))
+            )
+            conn.execute(
+                'DELETE FROM window_messages WHERE key = ? AND id NOT IN '
+                '(SELECT id FROM window_messages WHERE key = ? ORDER BY id DESC LIMIT ?)',
+                (key, key, self.per_conversation)
+            )
+        return True
+
+    def mark_read(self, key, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        conn = self._conn()
+        placeholders = ','.join('?' * len(ids))
+        with conn:
+            conn.execute(f'UPDATE window_messages SET is_read = 1 WHERE key = ? AND id IN ({placeholders})', [key, *ids])
+
+    def clear_messages(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM window_messages WHERE key = ?', (key,))
+
+    def _evict(self, conn):
+        (entries,) = conn.execute('SELECT COUNT(*) FROM window_messages').fetchone()
+        while entries > self.max_entries:
+            row = conn.execute('SELECT key FROM windows ORDER BY touched LIMIT 1').fetchone()
+            (remaining,) = conn.execute('SELECT COUNT(*) FROM windows').fetchone()
+            if not row or remaining <= 1:
+                break
+            removed = conn.execute('DELETE FROM window_messages WHERE key = ?', (row[0],)).rowcount
+            conn.execute('DELETE FROM windows WHERE key = ?', (row[0],))
+            entries -= removed
+            self.evictions += 1
+
+    def add_read_receipts(self, chat_session_id, ids, ts=None):
+        ts = ts or time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany('INSERT INTO read_receipts (chat_session_id, id, ts) VALUES (?, ?, ?)',
+                             [(chat_session_id, mid, ts) for mid in ids])
+
+    def get_read_receipts(self, chat_session_id, since=0.0):
+        conn = self._conn()
+        cutoff = time.time() - READ_RECEIPT_TTL_S
+        with conn:
+            conn.execute('DELETE FROM read_receipts WHERE chat_session_id = ? AND ts < ?', (chat_session_id, cutoff))
+        rows = conn.execute(
+            'SELECT id, ts FROM read_receipts WHERE chat_session_id = ? AND ts > ? ORDER BY ts LIMIT ?',
+            (chat_session_id, since, READ_RECEIPT_MAX)
+        ).fetchall()
+        return [{'id': mid, 'ts': ts} for mid, ts in rows]
+
+    def clear_read_receipts(self, chat_session_id):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM read_receipts WHERE chat_session_id = ?', (chat_session_id,))
+
+    def touch_session(self, user_id, **fields):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+            sess = json.loads(row[0]) if row else {}
+            sess.update(fields)
+            sess['last_activity'] = now
+            conn.execute('INSERT OR REPLACE INTO sessions (user_id, last_activity, data) VALUES (?, ?, ?)',
+                         (user_id, now, json.dumps(sess)))
+
+    def get_session(self, user_id):
+        row = self._conn().execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_sessions(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        rows = self._conn().execute(f'SELECT user_id, data FROM sessions WHERE user_id IN ({placeholders})', user_ids).fetchall()
+        return {uid: json.loads(data) for uid, data in rows}
+
+    def remove_session(self, user_id):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+    def prune_sessions(self, max_idle_s):
+        conn = self._conn()
+        with conn:
+            return conn.execute('DELETE FROM sessions WHERE last_activity < ?', (time.time() - max_idle_s,)).rowcount
+
+    def stats(self):
+        conn = self._conn()
+        (conversations,) = conn.execute('SELECT COUNT(*) FROM windows').fetchone()
+        (entries,) = conn.execute('SELECT COUNT(*) FROM window_messages').fetchone()
+        (sessions,) = conn.execute('SELECT COUNT(*) FROM sessions').fetchone()
+        return {
+            'backend': self.name,
+            'path': self.path,
+            'messages': {
+                'conversations': conversations,
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'per_conversation': self.per_conversation,
+                # Counters are per worker process
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            },
+            'sessions': sessions,
+        }
+
+
+class RedisCacheBackend(CacheBackend):
+    """Shared cache on any Redis-protocol server.
+
+    Windows are hashes of id -> JSON (plus a '_' marker so an empty window
+    still counts as cached), read receipts are sorted sets scored by time and
+    sessions are plain keys. Everything carries a TTL; whole-conversation LRU
+    is left to the server's maxmemory-policy (allkeys-lru).
+    """
+
+    name = 'redis'
+    _MARKER = '_'
+
+    def __init__(self, url=None, client=None, per_conversation=500, window_ttl_s=24 * 3600,
+                 session_ttl_s=3600, prefix='xchb:'):
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise RuntimeError('CACHE_BACKEND=redis requires the redis package')
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.r = client
+        self.per_conversation = per_conversation
+        self.window_ttl_s = window_ttl_s
+        self.session_ttl_s = session_ttl_s
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _wkey(self, key):
+        return f"{self.prefix}win:{key}"
+
+    def _rkey(self, chat_session_id):
+        return f"{self.prefix}rr:{chat_session_id}"
+
+    def _skey(self, user_id):
+        return f"{self.prefix}sess:{user_id}"
+
+    def get_messages(self, key):
+        raw = self.r.hgetall(self._wkey(key))
+        if not raw:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.r.expire(self._wkey(key), self.window_ttl_s)
+        raw.pop(self._MARKER, None)
+        return [json.loads(raw[k]) for k in sorted(raw, key=int)]
+
+    def get_messages_since(self, key, since_id):
+        wkey = self._wkey(key)
+        fields = self.r.hkeys(wkey)
+        if not fields:
+            self.misses += 1
+            return None
+        ids = sorted(int(k) for k in fields if k != self._MARKER)
+        if ids and since_id < ids[0]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.r.expire(wkey, self.window_ttl_s)
+        # Only fetch the payloads past the cursor
+        wanted = ids[bisect_right(ids, since_id):]
+        if not wanted:
+            return []
+        return [json.loads(v) for v in self.r.hmget(wkey, [str(i) for i in wanted]) if v is not None]
+
+    def set_messages(self, key, messages):
+        messages = list(messages)[-self.per_conversation:]
+        wkey = self._wkey(key)
+        mapping = {self._MARKER: '1'}
+        mapping.update({str(m['id']): json.dumps(m) for m in messages})
+        pipe = self.r.pipeline()
+        pipe.delete(wkey)
+        pipe.hset(wkey, mapping=mapping)
+        pipe.expire(wkey, self.window_ttl_s)
+        pipe.execute()
+
+    def append_message(self, key, message):
+        wkey = self._wkey(key)
+        if not self.r.exists(wkey):
+            return False
+        pipe = self.r.pipeline()
+        pipe.hset(wkey, str(message['id']), json.dumps(message))
+        pipe.expire(wkey, self.window_ttl_s)
+        pipe.hlen(wkey)
+        size = pipe.execute()[-1] - 1
+        if size > self.per_conversation:
+            ids = sorted(int(k) for k in self.r.hkeys(wkey) if k != self._MARKER)
+            self.r.hdel(wkey, *[str(i) for i in ids[:size - self.per_conversation]])
+        return True
+
+    def mark_read(self, key, ids):
+        ids = [str(i) for i in ids]
+        if not ids:
+            return
+        wkey = self._wkey(key)
+        updates = {}
+        for field, raw in zip(ids, self.r.hmget(wkey, ids)):
+            if raw:
+                msg = json.loads(raw)
+                msg['is_read'] = True
+                updates[field] = json.dumps(msg)
+        if updates:
+            self.r.hset(wkey, mapping=updates)
+
+    def clear_messages(self, key):
+        wkey = self._wkey(key)
+        if self.r.exists(wkey):
+            pipe = self.r.pipeline()
+            pipe.delete(wkey)
+            pipe.hset(wkey, self._MARKER, '1')
+            pipe.expire(wkey, self.window_ttl_s)
+            pipe.execute()
+
+    def add_read_receipts(self, chat_session_id, ids, ts=None):
+        ts = ts or time.time()
+        rkey = self._rkey(chat_session_id)
+        pipe = self.r.pipeline()
+        pipe.zadd(rkey, {str(mid): ts for mid in ids})
+        pipe.zremrangebyrank(rkey, 0, -READ_RECEIPT_MAX - 1)
+        pipe.expire(rkey, READ_RECEIPT_TTL_S * 2)
+        pipe.execute()
+
+    def get_read_receipts(self, chat_session_id, since=0.0):
+        rkey = self._rkey(chat_session_id)
+        cutoff = time.time() - READ_RECEIPT_TTL_S
+        pipe = self.r.pipeline()
+        pipe.zremrangebyscore(rkey, '-inf', f'({cutoff}')
+        pipe.zrangebyscore(rkey, f'({since}', '+inf', withscores=True)
+        rows = pipe.execute()[-1]
+        return [{'id': int(mid), 'ts': ts} for mid, ts in rows]
+
+    def clear_read_receipts(self, chat_session_id):
+        self.r.delete(self._rkey(chat_session_id))
+
+    def touch_session(self, user_id, **fields):
+        skey = self._skey(user_id)
+        raw = self.r.get(skey)
+        sess = json.loads(raw) if raw else {}
+        sess.update(fields)
+        sess['last_activity'] = time.time()
+        self.r.set(skey, json.dumps(sess), ex=self.session_ttl_s)
+
+    def get_session(self, user_id):
+        raw = self.r.get(self._skey(user_id))
+        return json.loads(raw) if raw else None
+
+    def get_sessions(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self.r.mget([self._skey(uid) for uid in user_ids])
+        return {uid: json.loads(raw) for uid, raw in zip(user_ids, values) if raw}
+
+    def remove_session(self, user_id):
+        self.r.delete(self._skey(user_id))
+
+    def prune_sessions(self, max_idle_s):
+        # Sessions expire server-side after session_ttl_s
+        return 0
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'messages': {'per_conversation': self.per_conversation, 'hits': self.hits, 'misses': self.misses},
+        }
+
+
+def make_cache_backend(config):
+    """Build the backend named by config['CACHE_BACKEND'] (memory | sqlite | redis)"""
+    kind = (config.get('CACHE_BACKEND') or 'memory').lower()
+    max_entries = int(config.get('MESSAGE_CACHE_MAX_ENTRIES', 50000))
+    per_conversation = int(config.get('MESSAGE_CACHE_PER_CONVERSATION', 500))
+    if kind == 'sqlite':
+        return SQLiteCacheBackend(config.get('CACHE_SQLITE_PATH') or os.path.join('/tmp', 'xchb-cache.sqlite3'),
+                                  max_entries=max_entries, per_conversation=per_conversation)
+    if kind == 'redis':
+        return RedisCacheBackend(config.get('CACHE_REDIS_URL') or 'redis://localhost:6379/0',
+                                 per_conversation=per_conversation)
+    return MemoryCacheBackend(max_entries=max_entries, per_conversation=per_conversation)
@@ -0,0 +1,361 @@
+"""
+Resumable, content-addressed storage for chat attachments.
+
+The old upload route took the whole file in one request and saved a
+timestamped copy each time, so a forwarded photo was stored once per send
+and a mobile upload that dropped at 90% started again from zero. Uploads
+now go through three steps:
+
+    create()    -> an upload id; state is a .part file plus a small JSON
+                   record under <root>/.partial/, so any worker process
+                   (and a restarted one) can pick the upload up again
+    append()    -> streams one chunk onto the .part file at a given
+                   offset; status() reports how much arrived, which is
+                   where a client resumes
+    finalize()  -> sha256 of the bytes, then the file moves to
+                   <root>/<first 2 hex>/<sha256><ext>; the record keeps
+                   the result, so a retried finalize gets the same answer
+
+Storage is keyed by content hash: when that path already exists the part
+file is dropped and finalize returns at once, so a file is stored once
+however often it is sent. find() lets a client that hashed the file itself
+skip the upload entirely.
+
+Chunks are hashed as they are written. hashlib state cannot be saved to
+disk, so the running hash lives in this process only; if a chunk lands in
+another worker or the process restarted, finalize hashes the part file
+from the start instead.
+
+app.py passes in the uploads/chat directory plus the size and age limits,
+and turns UploadError into a JSON error with its status.
+"""
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: no cross-process chunk lock
+    fcntl = None
+
+PARTIAL_DIR = '.partial'
+COPY_BUFFER = 64 * 1024
+# How long a finalize waits for a chunk write or another finalize of the same upload
+FINALIZE_LOCK_WAIT = 30.0
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(Exception):
+    """Carries the HTTP status for the route, and the bytes received so far when that helps a retry"""
+
+    def __init__(self, message, status=400, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+def clean_extension(filename):
+    """Lower-cased extension of filename ('' if none or odd), used as the stored file's suffix"""
+    ext = os.path.splitext(filename or '')[1].lower()
+    return ext if re.fullmatch(r'\.[a-z0-9]{1,10}', ext) else ''
+
+
+def content_path(digest, ext):
+    """Path of a stored file relative to the store root"""
+    return f"{digest[:2]}/{digest}{ext}"
+
+
+class UploadStore:
+    def __init__(self, root, max_bytes=50 * 1024 * 1024, ttl=24 * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.partial = os.path.join(root, PARTIAL_DIR)
+        self._lock = threading.Lock()
+        # upload_id -> (offset the hash covers, running sha256)
+        self._hashers = {}
+        self._last_sweep = 0.0
+        self._stats = {'created': 0, 'chunks': 0, 'bytes': 0, 'stored': 0, 'deduplicated': 0,
+                       'rehashed': 0, 'swept': 0}
+
+    # --- paths -------------------------------------------------------------
+
+    def _part(self, upload_id):
+        return os.path.join(self.partial, upload_id + '.part')
+
+    def _record(self, upload_id):
+        return os.path.join(self.partial, upload_id + '.json')
+
+    def _write_record(self, record):
+        # Write then rename, so status() never reads a half-written record
+        tmp = self._record(record['id']) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, self._record(record['id']))
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    # --- lookups -----------------------------------------------------------
+
+    def find(self, digest, ext):
+        """Relative path of an already stored file with this hash, or None"""
+        if not isinstance(digest, str) or not _SHA256.match(digest.lower()):
+            return None
+        digest = digest.lower()
+        rel = content_path(digest, ext)
+        return rel if os.path.exists(os.path.join(self.root, rel)) else None
+
+    def status(self, upload_id):
+        """The upload's record plus 'received' (bytes on disk), or None if unknown.
+        Finalized uploads also have 'path' and 'sha256'. 'finalizing' is set in the
+        moment between finalize() moving the part file and recording where it went."""
+        if not _UPLOAD_ID.match(upload_id or ''):
+            return None
+        try:
+            with open(self._record(upload_id)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if 'path' in record:
+            record['received'] = record['size']
+            return record
+        try:
+            record['received'] = os.path.getsize(self._part(upload_id))
+        except OSError:
+            record['received'] = record['size']
+            record['finalizing'] = True
+        return record
+
+    # --- upload steps ------------------------------------------------------
+
+    def create(self, user_id, filename, size, mimetype=None):
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('size must be a positive number of bytes')
+        if size > self.max_bytes:
+            raise UploadError(f"File too large (max {self.max_bytes // (1024 * 1024)} MB)", status=413)
+        self.sweep()
+        os.makedirs(self.partial, exist_ok=True)
+        upload_id = secrets.token_hex(16)
+        record = {'id': upload_id, 'user_id': user_id, 'filename': filename, 'size': size,
+                  'mimetype': mimetype, 'created': time.time()}
+        open(self._part(upload_id), 'wb').close()
+        self._write_record(record)
+        with self._lock:
+            self._hashers[upload_id] = (0, hashlib.sha256())
+        self._count('created')
+        record['received'] = 0
+        return record
+
+    def append(self, upload_id, offset, stream):
+        """Write stream at offset; returns bytes received. The offset must equal what is already on
+        disk (409 with the real value otherwise), so a retried chunk can never leave a gap or overlap."""
+        record = self.status(upload_id)
+        if record is None:
+            raise UploadError('Unknown upload', status=404)
+        if 'path' in record or record.get('finalizing'):
+            raise UploadError('Upload is already finalized', status=409, received=record['size'])
+        with open(self._part(upload_id), 'ab') as f:
+            if not _flock(f):
+                raise UploadError('Another chunk is being written', status=409, received=record['received'])
+            received = f.seek(0, os.SEEK_END)
+            if offset != received:
+                raise UploadError('Offset does not match bytes received', status=409, received=received)
+            with self._lock:
+                covered, hasher = self._hashers.pop(upload_id, (None, None))
+            if covered != received:
+                hasher = None
+            written = 0
+            try:
+                while True:
+                    buf = stream.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    if received + written + len(buf) > record['size']:
+                        f.truncate(received)
+                        hasher = None
+                        raise UploadError('Chunk goes past the declared size', received=received)
+                    f.write(buf)
+                    if hasher is not None:
+                        hasher.update(buf)
+                    written += len(buf)
+            finally:
+                # Whatever reached the file stays; a dropped connection resumes from here
+                f.flush()
+                total = os.fstat(f.fileno()).st_size
+                if hasher is not None and total == received + written:
+                    with self._lock:
+                        self._hashers[upload_id] = (total, hasher)
+        self._count('chunks')
+        self._count('bytes', written)
+        return total
+
+    def finalize(self, upload_id):
+        """Move a complete upload into the store; returns (relative path, sha256, deduplicated).
+
+        Holds the same lock as append() on the part file, so it waits out a chunk still being
+        written, and an overlapping finalize (a client retrying a slow one) waits for the first
+        and then returns its result from the record.
+        """
+        record = self.status(upload_id)
+        if record is None:
+            raise UploadError('Unknown upload', status=404)
+        if 'path' in record or record.get('finalizing'):
+            return self._finalized(upload_id)
+        try:
+            # Windows has no flock, and a file that is open there cannot be renamed
+            part = open(self._part(upload_id), 'rb') if fcntl is not None else None
+        except FileNotFoundError:
+            return self._finalized(upload_id)
+        try:
+            if part is not None and not _flock(part, wait=FINALIZE_LOCK_WAIT):
+                raise UploadError('Upload is still being written', status=409, received=record['received'])
+            record = self.status(upload_id)
+            if record is None or 'path' in record or record.get('finalizing'):
+                return self._finalized(upload_id)
+            if record['received'] != record['size']:
+                raise UploadError('Upload is incomplete', status=409, received=record['received'])
+            with self._lock:
+                covered, hasher = self._hashers.pop(upload_id, (None, None))
+            if covered != record['size']:
+                hasher = _hash_file(self._part(upload_id))
+                self._count('rehashed')
+            digest = hasher.hexdigest()
+            rel, deduplicated = self._store(self._part(upload_id), digest, clean_extension(record['filename']))
+            record.pop('received')
+            record.update(path=rel, sha256=digest, deduplicated=deduplicated)
+            self._write_record(record)
+            return rel, digest, deduplicated
+        except FileNotFoundError:
+            # Only without flock: another finalize moved the part file first
+            return self._finalized(upload_id)
+        except OSError as e:
+            raise UploadError(f"Could not store the upload: {e}", status=500)
+        finally:
+            if part is not None:
+                part.close()
+
+    def _finalized(self, upload_id):
+        """Result of a finalize that another call has started, once it has recorded it"""
+        deadline = time.monotonic() + FINALIZE_LOCK_WAIT
+        while True:
+            record = self.status(upload_id)
+            if record is None:
+                raise UploadError('Unknown upload', status=404)
+            if 'path' in record:
+                return record['path'], record['sha256'], record['deduplicated']
+            if not record.get('finalizing') or time.monotonic() >= deadline:
+                raise UploadError('Upload is being finalized, try again', status=409)
+            time.sleep(0.05)
+
+    def store_stream(self, stream, filename):
+        """One-shot path: copy stream into the store while hashing it; returns (relative path, sha256, deduplicated)"""
+        os.makedirs(self.partial, exist_ok=True)
+        tmp = os.path.join(self.partial, secrets.token_hex(16) + '.tmp')
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, 'wb') as f:
+                while True:
+                    buf = stream.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    size += len(buf)
+                    if size > self.max_bytes:
+                        raise UploadError(f"File too large (max {self.max_bytes // (1024 * 1024)} MB)", status=413)
+                    hasher.update(buf)
+                    f.write(buf)
+            rel, deduplicated = self._store(tmp, hasher.hexdigest(), clean_extension(filename))
+        finally:
+            _remove(tmp)
+        return rel, hasher.hexdigest(), deduplicated
+
+    def _store(self, src, digest, ext):
+        rel = content_path(digest, ext)
+        dest = os.path.join(self.root, rel)
+        if os.path.exists(dest):
+            _remove(src)
+            self._count('deduplicated')
+            return rel, True
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Same filesystem, so this is an atomic rename; a concurrent twin just overwrites identical bytes
+        os.replace(src, dest)
+        self._count('stored')
+        return rel, False
+
+    # --- housekeeping ------------------------------------------------------
+
+    def sweep(self, force=False):
+        """Delete abandoned partial uploads older than ttl; runs at most every few minutes"""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < 300:
+                return 0
+            self._last_sweep = now
+        removed = 0
+        try:
+            names = os.listdir(self.partial)
+        except OSError:
+            return 0
+        for name in names:
+            upload_id, _, suffix = name.partition('.')
+            if suffix == 'json' and os.path.exists(self._part(upload_id)):
+                continue  # goes with its .part, whose mtime moves with every chunk
+            try:
+                if now - os.path.getmtime(os.path.join(self.partial, name)) <= self.ttl:
+                    continue
+            except OSError:
+                continue
+            _remove(os.path.join(self.partial, name))
+            if suffix == 'part':
+                _remove(self._record(upload_id))
+                with self._lock:
+                    self._hashers.pop(upload_id, None)
+            removed += 1
+        if removed:
+            self._count('swept', removed)
+        return removed
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out['hashing_in_memory'] = len(self._hashers)
+        return out
+
+
+def _flock(f, wait=0.0):
+    """Exclusive cross-process lock on f (held until it is closed); False if another holder keeps it
+    past `wait` seconds. Polls rather than blocking, so under gevent other greenlets keep running."""
+    if fcntl is None:
+        return True
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+
+def _hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(COPY_BUFFER), b''):
+            hasher.update(buf)
+    return hasher
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,255 @@
+"""
+Response compression as WSGI middleware.
+
+Wraps app.wsgi_app and compresses text responses (HTML, JSON, JS, CSS,
+NDJSON, ...) for clients that accept it: brotli when the `brotli` package
+is installed and the client prefers it, otherwise gzip. Skipped for:
+
+    - bodies smaller than min_size (the header overhead eats the gain)
+    - media that is already compressed (avatars, uploads, images) and any
+      response that already has a Content-Encoding (the gzip export)
+    - 204 / 206 / 304, HEAD, WebSocket upgrades, SSE streams, and
+      responses marked Cache-Control: no-transform
+
+Responses with a Content-Length are compressed in one go and get a new
+Content-Length. Streamed responses (no Content-Length) are compressed chunk
+by chunk, flushing after each one so the client still sees every chunk as
+the app yields it.
+
+app.py wraps app.wsgi_app in it, with the size threshold and levels from
+COMPRESS_MIN_SIZE, COMPRESS_GZIP_LEVEL and COMPRESS_BROTLI_QUALITY.
+"""
+
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Media types worth compressing; everything else (images, archives, fonts) passes through
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml', 'text/csv',
+    'application/json', 'application/javascript', 'application/xml', 'application/x-ndjson',
+    'application/manifest+json', 'image/svg+xml',
+}
+# SSE events are tiny and flushed one by one; some proxies also buffer encoded streams
+NEVER_COMPRESS_TYPES = {'text/event-stream'}
+
+
+def parse_accept_encoding(header):
+    """{coding: q} from an Accept-Encoding header; q=0 entries are kept (they forbid)"""
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header, brotli_available=None):
+    """'br', 'gzip' or None for an Accept-Encoding header; brotli wins ties when installed"""
+    if brotli_available is None:
+        brotli_available = brotli is not None
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get('*', 0.0)
+    candidates = ['br', 'gzip'] if brotli_available else ['gzip']
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _GzipEncoder:
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+def make_encoder(coding, gzip_level=6, brotli_quality=5):
+    if coding == 'br':
+        return _BrotliEncoder(brotli_quality)
+    return _GzipEncoder(gzip_level)
+
+
+def compress_bytes(data, coding, gzip_level=6, brotli_quality=5):
+    encoder = make_encoder(coding, gzip_level, brotli_quality)
+    return encoder.compress(data) + encoder.finish()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _without(headers, *names):
+    names = {n.lower() for n in names}
+    return [(k, v) for k, v in headers if k.lower() not in names]
+
+
+def _add_vary(headers):
+    vary = _header(headers, 'Vary')
+    if vary is None:
+        return headers + [('Vary', 'Accept-Encoding')]
+    if 'accept-encoding' in vary.lower() or vary.strip() == '*':
+        return headers
+    return _without(headers, 'Vary') + [('Vary', f"{vary}, Accept-Encoding")]
+
+
+def _weaken_etag(headers):
+    # The encoded bytes differ from the identity ones, so a strong validator must not carry over
+    etag = _header(headers, 'ETag')
+    if etag and not etag.startswith('W/'):
+        return _without(headers, 'ETag') + [('ETag', 'W/' + etag)]
+    return headers
+
+
+class CompressionMiddleware:
+    def __init__(self, app, min_size=512, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._lock = threading.Lock()
+        self._stats = {'compressed': 0, 'streamed': 0, 'skipped_small': 0,
+                       'bytes_in': 0, 'bytes_out': 0, 'by_encoding': {}}
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats, by_encoding=dict(self._stats['by_encoding']))
+        out['brotli_available'] = brotli is not None
+        saved = out['bytes_in'] - out['bytes_out']
+        out['bytes_saved'] = saved
+        out['ratio'] = round(out['bytes_out'] / out['bytes_in'], 3) if out['bytes_in'] else None
+        return out
+
+    def _count(self, coding, bytes_in, bytes_out, streamed=False):
+        with self._lock:
+            self._stats['streamed' if streamed else 'compressed'] += 1
+            self._stats['bytes_in'] += bytes_in
+            self._stats['bytes_out'] += bytes_out
+            self._stats['by_encoding'][coding] = self._stats['by_encoding'].get(coding, 0) + 1
+
+    def _compressible(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if _header(headers, 'Content-Encoding') or _header(headers, 'Content-Range'):
+            return False
+        if 'no-transform' in (_header(headers, 'Cache-Control') or '').lower():
+            return False
+        mimetype = (_header(headers, 'Content-Type') or '').split(';', 1)[0].strip().lower()
+        if mimetype in NEVER_COMPRESS_TYPES:
+            return False
+        return mimetype in COMPRESSIBLE_TYPES or mimetype.endswith('+json')
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or environ.get('HTTP_UPGRADE'):
+            return self.app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, list(headers), exc_info]
+            return self._write_unsupported
+
+        # werkzeug responses call start_response before returning the body iterable
+        body = self.app(environ, capture)
+        status, headers, exc_info = captured
+
+        if not self._compressible(status, headers):
+            start_response(status, headers, exc_info)
+            return body
+        headers = _add_vary(headers)
+        coding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if coding is None:
+            start_response(status, headers, exc_info)
+            return body
+
+        length = _header(headers, 'Content-Length')
+        if length is not None:
+            if int(length) < self.min_size:
+                with self._lock:
+                    self._stats['skipped_small'] += 1
+                start_response(status, headers, exc_info)
+                return body
+            try:
+                data = b''.join(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            compressed = compress_bytes(data, coding, self.gzip_level, self.brotli_quality)
+            if len(compressed) >= len(data):
+                start_response(status, headers, exc_info)
+                return [data]
+            self._count(coding, len(data), len(compressed))
+            headers = _weaken_etag(_without(headers, 'Content-Length')) + [
+                ('Content-Encoding', coding), ('Content-Length', str(len(compressed)))]
+            start_response(status, headers, exc_info)
+            return [compressed]
+
+        headers = _weaken_etag(headers) + [('Content-Encoding', coding)]
+        start_response(status, headers, exc_info)
+        return self._stream(body, coding)
+
+    def _stream(self, body, coding):
+        encoder = make_encoder(coding, self.gzip_level, self.brotli_quality)
+        bytes_in = bytes_out = 0
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+                bytes_in += len(chunk)
+                out = encoder.compress(chunk) + encoder.flush()
+                bytes_out += len(out)
+                yield out
+            out = encoder.finish()
+            bytes_out += len(out)
+            yield out
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._count(coding, bytes_in, bytes_out, streamed=True)
+
+    @staticmethod
+    def _write_unsupported(data):
+        raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
+
@@ -0,0 +1,265 @@
+"""
+Resized copies of uploaded images.
+
+Avatars show up at 40-54 px in the feed, comments, conversation list and
+chat header, but used to be served at whatever size was uploaded. At upload
+time app.py asks for square variants at AVATAR_SIZES; list views then link
+the 96 px one (crisp on 2x screens) and the profile page the 256 px one.
+
+Variants are centre-cropped squares, EXIF-rotated, encoded as WebP (small,
+keeps transparency). Animated GIFs use their first frame.
+
+Chat photos get one downscaled preview (longest side PREVIEW_MAX_SIDE) so
+the conversation view does not pull full-resolution camera files inline.
+PreviewPool runs make_preview in a small process pool: decoding a 12 MP
+JPEG is CPU-bound and would otherwise stall every greenlet in the worker.
+
+Needs Pillow. Without it IMAGING_AVAILABLE is False and callers fall back
+to serving the original. square_variants takes the uploaded bytes;
+make_preview and PreviewPool take file paths, so image data never crosses
+the process boundary.
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps, features
+    IMAGING_AVAILABLE = True
+except ImportError:
+    Image = ImageOps = features = None
+    IMAGING_AVAILABLE = False
+
+AVATAR_SIZES = (48, 96, 256)
+VARIANT_FORMAT = 'WEBP'
+VARIANT_MIME = 'image/webp'
+VARIANT_QUALITY = 82
+# Refuse decompression bombs: a 5 MB upload can still declare a huge canvas
+MAX_PIXELS = 40 * 1000 * 1000
+
+PREVIEW_MAX_SIDE = 720
+PREVIEW_QUALITY = 78
+# Image types a preview is made for; anything else is sent as-is
+PREVIEW_MIME_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/gif', 'image/bmp', 'image/tiff'}
+# EXIF orientations that swap width and height
+_ROTATED = (5, 6, 7, 8)
+
+
+def nearest_size(requested, sizes=AVATAR_SIZES):
+    """Smallest variant at least `requested` px (the largest if none is); 0 = original"""
+    if not requested or requested <= 0:
+        return 0
+    for size in sizes:
+        if size >= requested:
+            return size
+    return sizes[-1]
+
+
+def _limit_pixels():
+    if Image.MAX_IMAGE_PIXELS != MAX_PIXELS:
+        Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+
+def _open(blob):
+    _limit_pixels()
+    try:
+        img = Image.open(io.BytesIO(blob))
+        img.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not a readable image: {e}")
+    return ImageOps.exif_transpose(img)
+
+
+def square_variants(blob, sizes=AVATAR_SIZES):
+    """{size: bytes} of centre-cropped square WebP variants; raises ValueError for non-images.
+
+    Sizes larger than the source are still produced (upscaled), so every
+    size always exists and URLs never need a fallback.
+    """
+    if not IMAGING_AVAILABLE:
+        raise RuntimeError('image variants need Pillow')
+    img = _open(blob)
+    img = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+    side = min(img.size)
+    left, top = (img.width - side) // 2, (img.height - side) // 2
+    square = img.crop((left, top, left + side, top + side))
+    out = {}
+    # Largest first: each smaller one resamples the previous, which is cheaper and looks the same
+    for size in sorted(sizes, reverse=True):
+        square = square.resize((size, size), Image.LANCZOS)
+        buf = io.BytesIO()
+        square.save(buf, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+        out[size] = buf.getvalue()
+    return out
+
+
+def preview_format():
+    """('WEBP', '.webp') when this Pillow can write WebP, else ('JPEG', '.jpg')"""
+    if IMAGING_AVAILABLE and features.check('webp'):
+        return 'WEBP', '.webp'
+    return 'JPEG', '.jpg'
+
+
+def make_preview(src_path, dest_path, max_side=PREVIEW_MAX_SIDE):
+    """Write a downscaled, EXIF-rotated copy of src_path to dest_path.
+
+    Returns {'width', 'height'} of the original as displayed plus
+    'preview_width' / 'preview_height' when a preview was written. No
+    preview is written for animated images (it would freeze them) or when
+    it would not be smaller than the original. Raises ValueError for files
+    Pillow cannot read. Top-level so a process pool can pickle it.
+    """
+    if not IMAGING_AVAILABLE:
+        raise RuntimeError('image previews need Pillow')
+    _limit_pixels()
+    try:
+        img = Image.open(src_path)
+        width, height = _displayed_size(img)
+        info = {'width': width, 'height': height}
+        if getattr(img, 'is_animated', False):
+            return info
+        # JPEG only: decode at 1/2, 1/4 or 1/8 scale straight away instead of the full frame
+        img.draft('RGB', (max_side, max_side))
+        img.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not a readable image: {e}")
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    fmt, _ = preview_format()
+    has_alpha = 'A' in img.getbands() or img.mode == 'P'
+    img = img.convert('RGBA' if has_alpha and fmt == 'WEBP' else 'RGB')
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=PREVIEW_QUALITY, **({'method': 4} if fmt == 'WEBP' else {'optimize': True}))
+    data = buf.getvalue()
+    if len(data) >= os.path.getsize(src_path) and img.size == (width, height):
+        return info
+    # Write then rename, so a concurrent existing_preview() never reads half a file
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, dest_path)
+    info['preview_width'], info['preview_height'] = img.size
+    return info
+
+
+def _displayed_size(img):
+    width, height = img.size
+    if img.getexif().get(0x0112) in _ROTATED:
+        width, height = height, width
+    return width, height
+
+
+def existing_preview(src_path, dest_path):
+    """make_preview's result for a preview already on disk (headers only, nothing decoded), else None"""
+    if not os.path.exists(dest_path):
+        return None
+    _limit_pixels()
+    try:
+        with Image.open(src_path) as img:
+            width, height = _displayed_size(img)
+        with Image.open(dest_path) as preview:
+            preview_width, preview_height = preview.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return {'width': width, 'height': height, 'preview_width': preview_width, 'preview_height': preview_height}
+
+
+class PreviewPool:
+    """make_preview in worker processes, with a deadline per job.
+
+    The pool is created on first use and again after a fork, so each
+    gunicorn worker gets its own. workers=0 (or a pool that cannot start)
+    runs jobs inline. run() returns None when the deadline passes; the job
+    still finishes in the background and its file simply goes unused.
+    """
+
+    def __init__(self, workers=2, timeout=10.0, max_side=PREVIEW_MAX_SIDE):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_side = max_side
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {'jobs': 0, 'written': 0, 'skipped': 0, 'failed': 0,
+                       'timed_out': 0, 'inline': 0, 'reused': 0, 'restarts': 0, 'total_ms': 0.0}
+
+    def _executor(self):
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # fork: spawn/forkserver would re-import the app module in every worker
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                try:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                    self._pid = os.getpid()
+                except (OSError, ValueError, NotImplementedError) as e:
+                    print(f"⚠️ Preview pool unavailable, running inline: {e}")
+                    self.workers = 0
+                    return None
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._stats['restarts'] += 1
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, src_path, dest_path):
+        """make_preview's result, or None on timeout; raises ValueError for non-images"""
+        started = time.monotonic()
+        # Content-addressed uploads: the same photo sent again already has its preview
+        info = existing_preview(src_path, dest_path)
+        if info is not None:
+            self._count('reused')
+            return info
+        pool = self._executor()
+        try:
+            if pool is None:
+                self._count('inline')
+                info = make_preview(src_path, dest_path, self.max_side)
+            else:
+                try:
+                    info = pool.submit(make_preview, src_path, dest_path, self.max_side).result(self.timeout)
+                except BrokenProcessPool:
+                    # A worker died (OOM on a huge image, killed); start over next time, do this one here
+                    self._reset()
+                    self._count('inline')
+                    info = make_preview(src_path, dest_path, self.max_side)
+        except FutureTimeout:
+            self._count('timed_out')
+            return None
+        except ValueError:
+            self._count('failed')
+            raise
+        self._count('written' if 'preview_width' in info else 'skipped', time.monotonic() - started)
+        return info
+
+    def _count(self, key, seconds=None):
+        with self._lock:
+            self._stats[key] += 1
+            if seconds is not None:
+                self._stats['jobs'] += 1
+                self._stats['total_ms'] += seconds * 1000
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+        out['workers'] = self.workers
+        out['avg_ms'] = round(out['total_ms'] / out['jobs'], 1) if out['jobs'] else None
+        out['total_ms'] = round(out['total_ms'], 1)
+        return out
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.shutdown(wait=False, cancel_futures=True)
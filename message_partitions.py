@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Optional monthly range partitioning of the messages table (Postgres only).
+
+One messages table means every insert maintains every index over the whole
+history, and VACUUM / index bloat grow with it. Partitioned by month on
+timestamp, each month is its own table with its own, smaller indexes, and
+queries that bound timestamp only touch the months they need.
+
+The app keeps working on an unpartitioned table; app.py checks
+is_partitioned() at startup and only then adds the partition bounds to its
+hot queries (see recent_window()).
+
+Management command (DATABASE_URL as for the app):
+
+    python message_partitions.py status
+    python message_partitions.py create [--ahead 3]   # future months, run monthly or at deploy
+    python message_partitions.py migrate [--batch 50000]
+    python message_partitions.py explain <chat_session_id>
+
+migrate converts the existing table while the app keeps running:
+
+    1. builds messages_new, partitioned by month, with a lean index set and
+       partitions covering the data plus --ahead months and a DEFAULT one
+    2. installs a trigger that logs the id of every row written meanwhile
+       (including inserts that commit after their id range was copied)
+    3. copies rows in id batches, then builds the indexes
+    4. in one short transaction that blocks writes (reads continue): copies
+       the rows inserted since, re-copies the logged ones, drops the foreign
+       keys that point at messages.id (a partitioned table's unique keys must
+       include timestamp, so messages.id alone can't be referenced), renames
+       messages -> messages_unpartitioned and messages_new -> messages
+
+The old table is kept as messages_unpartitioned; drop it once satisfied.
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+PARTITION_PREFIX = 'messages_p'
+# Rows with a later id are assumed never to be more than this much older in
+# timestamp (concurrent inserts, clock differences between workers)
+CLOCK_SKEW_S = 3600
+
+# The partitioned table only carries the indexes the app's queries use
+PARTITION_INDEXES = [
+    ('idx_chat_session_id', '(chat_session_id, id)'),
+    ('idx_messages_unread', '(chat_session_id, receiver_id) WHERE is_read = false'),
+    # For ON DELETE CASCADE from users and delete_account
+    ('idx_messages_sender', '(sender_id)'),
+    ('idx_messages_receiver', '(receiver_id)'),
+]
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, n):
+    months = dt.year * 12 + dt.month - 1 + n
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def recent_window(now=None):
+    """Start of the previous month: hot queries read [this, now], i.e. two partitions"""
+    return add_months(month_start(now or datetime.utcnow()), -1)
+
+
+def newest_possible(now=None):
+    """Upper timestamp bound for hot queries; keeps future months and DEFAULT out of the plan"""
+    return (now or datetime.utcnow()) + timedelta(seconds=CLOCK_SKEW_S)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month.year:04d}{month.month:02d}"
+
+
+def is_partitioned(conn):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'messages' AND c.relnamespace = 'public'::regnamespace")).first() is not None
+
+
+def partitions(conn, table='messages'):
+    """[(name, bound expression)] of the table's partitions"""
+    return [tuple(r) for r in conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table ORDER BY c.relname"), {'table': table})]
+
+
+def create_partitions(conn, start, end, table='messages'):
+    """Create the monthly partitions for [start, end) that don't exist yet; returns their names"""
+    existing = {name for name, _ in partitions(conn, table)}
+    created = []
+    month = month_start(start)
+    while month < end:
+        name = partition_name(month)
+        if name not in existing:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def ensure_future(conn, ahead=3, now=None):
+    """Partitions for the recent window through `ahead` months from now"""
+    now = now or datetime.utcnow()
+    return create_partitions(conn, recent_window(now), add_months(month_start(now), ahead + 1))
+
+
+def first_id_since(conn, ts):
+    """Smallest message id stamped at or after ts (prunes to the partitions from ts on)"""
+    return conn.execute(text("SELECT MIN(id) FROM messages WHERE timestamp >= :ts"), {'ts': ts}).scalar()
+
+
+def _referencing_foreign_keys(conn, table):
+    return [tuple(r) for r in conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = CAST(CAST(:table AS text) AS regclass)"), {'table': table})]
+
+
+def migrate(conn, batch=50000, ahead=3, log=print):
+    """Convert the single messages table into a partitioned one (see module docstring)"""
+    if is_partitioned(conn):
+        log("✅ messages is already partitioned")
+        return True
+    conn.execute(text("UPDATE messages SET timestamp = now() AT TIME ZONE 'utc' WHERE timestamp IS NULL"))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS messages_new (LIKE messages INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)"))
+    conn.execute(text("ALTER TABLE messages_new ALTER COLUMN timestamp SET NOT NULL"))
+    if not conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = 'messages_new_pkey'")).first():
+        conn.execute(text("ALTER TABLE messages_new ADD CONSTRAINT messages_new_pkey PRIMARY KEY (id, timestamp)"))
+        for column in ('sender_id', 'receiver_id'):
+            conn.execute(text(
+                f"ALTER TABLE messages_new ADD FOREIGN KEY ({column}) REFERENCES users (id) ON DELETE CASCADE"))
+    oldest = conn.execute(text("SELECT MIN(timestamp) FROM messages")).scalar() or datetime.utcnow()
+    now = datetime.utcnow()
+    created = create_partitions(conn, min(oldest, recent_window(now)), add_months(month_start(now), ahead + 1),
+                                table='messages_new')
+    conn.execute(text("CREATE TABLE IF NOT EXISTS messages_pdefault PARTITION OF messages_new DEFAULT"))
+    conn.execute(text("CREATE TABLE IF NOT EXISTS messages_migration_changes (id INTEGER NOT NULL)"))
+    conn.execute(text(
+        "CREATE OR REPLACE FUNCTION messages_migration_track() RETURNS trigger AS $$ "
+        "BEGIN INSERT INTO messages_migration_changes VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END); "
+        "RETURN NULL; END $$ LANGUAGE plpgsql"))
+    conn.execute(text("DROP TRIGGER IF EXISTS messages_migration_track ON messages"))
+    conn.execute(text(
+        "CREATE TRIGGER messages_migration_track AFTER INSERT OR UPDATE OR DELETE ON messages "
+        "FOR EACH ROW EXECUTE FUNCTION messages_migration_track()"))
+    conn.commit()
+    log(f"🧱 messages_new ready with {len(created)} monthly partitions")
+
+    # Bulk copy while the app keeps writing; resumes after the highest id already copied
+    copied = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages_new")).scalar()
+    high = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+    started = time.monotonic()
+    while copied < high:
+        upper = min(high, copied + batch)
+        conn.execute(text("INSERT INTO messages_new SELECT * FROM messages WHERE id > :lo AND id <= :hi"),
+                     {'lo': copied, 'hi': upper})
+        conn.commit()
+        copied = upper
+        log(f"  copied through id {copied:,} / {high:,} ({time.monotonic() - started:.0f} s)")
+
+    for name, columns in PARTITION_INDEXES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name}_new ON messages_new {columns}"))
+    conn.commit()
+    log("🗂  Indexes built")
+
+    # Swap: writers wait here for the remaining copy, readers don't
+    conn.execute(text("LOCK TABLE messages IN EXCLUSIVE MODE"))
+    conn.execute(text("INSERT INTO messages_new SELECT * FROM messages WHERE id > :lo"), {'lo': copied})
+    conn.execute(text(
+        "DELETE FROM messages_new WHERE id IN (SELECT id FROM messages_migration_changes) AND id <= :lo"),
+        {'lo': copied})
+    conn.execute(text(
+        "INSERT INTO messages_new SELECT * FROM messages "
+        "WHERE id IN (SELECT id FROM messages_migration_changes) AND id <= :lo"), {'lo': copied})
+    conn.execute(text("DROP TRIGGER messages_migration_track ON messages"))
+    conn.execute(text("DROP FUNCTION messages_migration_track()"))
+    conn.execute(text("DROP TABLE messages_migration_changes"))
+    for table, constraint in _referencing_foreign_keys(conn, 'messages'):
+        conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+    conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    # Index names are schema-wide; free the app's names for the new table
+    for (index,) in conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages_unpartitioned'")).fetchall():
+        conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index[:50]}_unpartitioned"'))
+    conn.execute(text("ALTER TABLE messages_new RENAME TO messages"))
+    conn.execute(text("ALTER TABLE messages RENAME CONSTRAINT messages_new_pkey TO messages_pkey"))
+    for name, _ in PARTITION_INDEXES:
+        conn.execute(text(f"ALTER INDEX {name}_new RENAME TO {name}"))
+    conn.execute(text("ALTER SEQUENCE IF EXISTS messages_id_seq OWNED BY messages.id"))
+    conn.commit()
+    conn.execute(text("ANALYZE messages"))
+    conn.commit()
+    log("🎉 messages is now partitioned by month; the old table is messages_unpartitioned")
+    return True
+
+
+# The app's hot queries in SQL form, with the bounds app.py adds on a partitioned table
+_HOT_QUERIES = {
+    'first page (get_direct_messages / latest without cursor)': (
+        "SELECT id FROM messages WHERE chat_session_id = :chat AND timestamp >= :recent AND timestamp < :upper "
+        "ORDER BY id DESC LIMIT 51"),
+    'since_id cursor (get_latest_messages)': (
+        "SELECT id FROM messages WHERE chat_session_id = :chat AND id > :since "
+        "AND timestamp >= :recent AND timestamp < :upper ORDER BY id ASC LIMIT 200"),
+}
+
+
+def explain(conn, chat_session_id, log=print):
+    """EXPLAIN the hot queries and report which partitions each one reads"""
+    recent = recent_window()
+    since = first_id_since(conn, recent) or 0
+    params = {'chat': chat_session_id, 'recent': recent, 'upper': newest_possible(), 'since': since}
+    # The previous and the current month
+    allowed = {partition_name(recent), partition_name(add_months(recent, 1))}
+    ok = True
+    for label, sql in _HOT_QUERIES.items():
+        plan = [r[0] for r in conn.execute(text(f"EXPLAIN {sql}"), params)]
+        scanned = sorted({name for line in plan for name in re.findall(rf' on ({PARTITION_PREFIX}\w+)', line)})
+        pruned = set(scanned) <= allowed
+        ok = ok and pruned
+        log(f"{'✅' if pruned else '❌'} {label}: reads {', '.join(scanned) or 'no partitions'}")
+        for line in plan:
+            log(f"      {line}")
+    return ok
+
+
+def get_database_url():
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        raise SystemExit("❌ Set DATABASE_URL")
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    if url.startswith('postgresql://'):
+        url = 'postgresql+psycopg://' + url[len('postgresql://'):]
+    return url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly partitions for the messages table")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status')
+    create = sub.add_parser('create')
+    create.add_argument('--ahead', type=int, default=3, help="months to create ahead of the current one")
+    mig = sub.add_parser('migrate')
+    mig.add_argument('--batch', type=int, default=50000)
+    mig.add_argument('--ahead', type=int, default=3)
+    exp = sub.add_parser('explain')
+    exp.add_argument('chat_session_id')
+    args = parser.parse_args()
+
+    engine = create_engine(get_database_url())
+    with engine.connect() as conn:
+        if args.command == 'migrate':
+            return 0 if migrate(conn, batch=args.batch, ahead=args.ahead) else 1
+        if not is_partitioned(conn):
+            print("ℹ️  messages is not partitioned; run: python message_partitions.py migrate")
+            return 1
+        if args.command == 'status':
+            for name, bound in partitions(conn):
+                print(f"  {name:<20} {bound}")
+            return 0
+        if args.command == 'create':
+            created = ensure_future(conn, ahead=args.ahead)
+            conn.commit()
+            print(f"✅ Created {', '.join(created)}" if created else "✅ All partitions already exist")
+            return 0
+        return 0 if explain(conn, args.chat_session_id) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Full-text search over messages.content.
+
+content LIKE '%x%' can't use a btree index, so every search would scan the
+whole messages table. This module keeps a proper text index next to it:
+
+    - Postgres: an expression GIN index on to_tsvector('simple', content),
+      queried with websearch_to_tsquery() and ranked with ts_rank()
+    - SQLite (local runs, tests): an external-content FTS5 table kept in
+      sync by triggers and ranked with bm25(). chat_session_id is indexed
+      as a token too, so FTS5 intersects the term with the caller's chats
+      instead of ranking every match in the corpus and filtering afterwards
+      (Postgres gets the same from a BitmapAnd with idx_chat_session_id)
+
+Both paths return the same rows in the same order, best match first by
+(rank DESC, id DESC), restricted to the chat_session_ids the caller passes
+in, with a (rank, id) keyset cursor for the next page. The 'simple' text
+search config does no stemming or stop words, so it behaves the same for
+every language people chat in.
+
+The module knows nothing about Flask; app.py passes in db.session and
+bench_search.py a plain engine connection.
+"""
+
+from sqlalchemy import DateTime, bindparam, text
+
+TS_CONFIG = 'simple'
+
+SEARCH_DDL = {
+    'postgresql': [
+        # On a large table create this by hand first with CREATE INDEX CONCURRENTLY;
+        # IF NOT EXISTS then makes the startup run a no-op
+        f"CREATE INDEX IF NOT EXISTS idx_messages_content_fts ON messages "
+        f"USING gin (to_tsvector('{TS_CONFIG}', content))",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "content, chat_session_id, content='messages', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, content, chat_session_id) "
+        "VALUES (new.id, new.content, new.chat_session_id); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, content, chat_session_id) "
+        "VALUES ('delete', old.id, old.content, old.chat_session_id); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, chat_session_id ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, content, chat_session_id) "
+        "VALUES ('delete', old.id, old.content, old.chat_session_id); "
+        "INSERT INTO messages_fts (rowid, content, chat_session_id) "
+        "VALUES (new.id, new.content, new.chat_session_id); END",
+    ],
+}
+
+_COLUMNS = 'm.id, m.chat_session_id, m.content, m.sender_id, m.receiver_id, m.timestamp, m.message_type, m.is_read'
+
+_SEARCH_SQL = {
+    'postgresql': (
+        f"SELECT {_COLUMNS}, ts_rank(to_tsvector('{TS_CONFIG}', m.content), q) AS rank "
+        f"FROM messages m, websearch_to_tsquery('{TS_CONFIG}', :q) q "
+        f"WHERE to_tsvector('{TS_CONFIG}', m.content) @@ q"
+    ),
+    # bm25() is lower-is-better; negate it so both dialects sort rank DESC.
+    # The chat_session_id column only scopes the match, so it gets no weight.
+    'sqlite': (
+        f"SELECT {_COLUMNS}, -bm25(messages_fts, 1.0, 0.0) AS rank "
+        f"FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        f"WHERE messages_fts MATCH :q"
+    ),
+}
+
+
+def supported(dialect):
+    return dialect in _SEARCH_SQL
+
+
+def setup(conn, dialect):
+    """Create the text index for this dialect (idempotent); returns False if unsupported"""
+    if not supported(dialect):
+        return False
+    rebuild = False
+    if dialect == 'sqlite':
+        # External-content FTS tables start empty; index existing rows once, on creation
+        rebuild = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")).first() is None
+    for stmt in SEARCH_DDL[dialect]:
+        conn.execute(text(stmt))
+    if rebuild:
+        conn.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+    return True
+
+
+def _fts5_quote(term):
+    return '"%s"' % term.replace('"', '""')
+
+
+def fts5_query(q, chat_session_ids):
+    """FTS5 MATCH string: every term quoted (so user input can't trip the query
+    syntax) and ANDed, intersected with the given chats"""
+    terms = ' '.join(_fts5_quote(term) for term in q.split())
+    chats = ' OR '.join(_fts5_quote(chat_id) for chat_id in chat_session_ids)
+    return f"content : ({terms}) AND chat_session_id : ({chats})"
+
+
+def encode_cursor(rank, msg_id):
+    # repr() round-trips the float exactly, so the keyset comparison is exact too
+    return f"{float(rank)!r}:{int(msg_id)}"
+
+
+def decode_cursor(cursor):
+    """(rank, id) from encode_cursor(); raises ValueError on garbage"""
+    rank, msg_id = cursor.rsplit(':', 1)
+    return float(rank), int(msg_id)
+
+
+def search(conn, dialect, q, chat_session_ids, limit=20, after=None):
+    """Messages matching q in the given chats, best first.
+
+    Returns (rows, next_cursor); rows are mappings with the message columns plus
+    rank, next_cursor is None on the last page. after is decode_cursor() output.
+    """
+    if not chat_session_ids or not q.strip():
+        return [], None
+    if dialect == 'sqlite':
+        q = fts5_query(q, chat_session_ids)
+    sql = (f"SELECT * FROM ({_SEARCH_SQL[dialect]} "
+           f"AND m.chat_session_id IN :chats AND m.message_type = 'text' AND m.deleted_at IS NULL) s")
+    params = {'q': q, 'chats': list(chat_session_ids), 'limit': limit + 1}
+    if after is not None:
+        sql += " WHERE s.rank < :after_rank OR (s.rank = :after_rank AND s.id < :after_id)"
+        params['after_rank'], params['after_id'] = after
+    sql += " ORDER BY s.rank DESC, s.id DESC LIMIT :limit"
+    stmt = text(sql).bindparams(bindparam('chats', expanding=True)).columns(timestamp=DateTime)
+    rows = conn.execute(stmt, params).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['rank'], rows[-1]['id'])
+    return rows, next_cursor
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+One-off data migration: file every message under its conversation's
+canonical chat_session_id.
+
+Each friendship direction has its own row and chat_session_id, and messages
+used to be filed under whichever row the OR lookup returned. The app now
+reads and writes only the canonical id (the one with a chat_sessions row,
+see get_friend_link), so messages still under the other id are invisible
+until moved. This script moves them, a batch at a time, and then recounts
+both conversation_summaries rows of each conversation it touched.
+
+It used to run on every boot as part of _SCHEMA_UPGRADES, which joined the
+whole messages table (every partition, once partitioned) on each start.
+Run it once after deploying; reruns find nothing left to move.
+
+    DATABASE_URL=... python migrate_chat_sessions.py [--dry-run] [--batch 50000]
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import create_engine, text
+
+from message_partitions import get_database_url
+
+# Friendship rows whose id is not the conversation's canonical one but still has messages
+STALE_IDS = text(
+    "SELECT f.chat_session_id AS stale_id, cs.id AS canonical_id FROM friendships f "
+    "JOIN chat_sessions cs ON (cs.user1_id = f.user_id AND cs.user2_id = f.friend_id) "
+    "OR (cs.user1_id = f.friend_id AND cs.user2_id = f.user_id) "
+    "WHERE f.chat_session_id <> cs.id "
+    "AND EXISTS (SELECT 1 FROM messages m WHERE m.chat_session_id = f.chat_session_id)"
+)
+
+MOVE_BATCH = text(
+    "UPDATE messages SET chat_session_id = :canonical WHERE id IN "
+    "(SELECT id FROM messages WHERE chat_session_id = :stale ORDER BY id LIMIT :batch)"
+)
+
+# Same columns as the backfill in migrate_conversation_summaries.py
+RECOUNT_SUMMARIES = text(
+    "UPDATE conversation_summaries SET "
+    "last_message_id = (SELECT MAX(m.id) FROM messages m WHERE m.chat_session_id = :chat), "
+    "last_sender_id = (SELECT m.sender_id FROM messages m WHERE m.chat_session_id = :chat ORDER BY m.id DESC LIMIT 1), "
+    "last_preview = (SELECT SUBSTR(m.content, 1, 100) FROM messages m WHERE m.chat_session_id = :chat ORDER BY m.id DESC LIMIT 1), "
+    "last_message_type = (SELECT m.message_type FROM messages m WHERE m.chat_session_id = :chat ORDER BY m.id DESC LIMIT 1), "
+    "last_message_at = COALESCE((SELECT m.timestamp FROM messages m WHERE m.chat_session_id = :chat "
+    "ORDER BY m.id DESC LIMIT 1), last_message_at), "
+    "unread_count = (SELECT COUNT(*) FROM messages u WHERE u.chat_session_id = :chat "
+    "AND u.receiver_id = conversation_summaries.user_id AND u.is_read = false) "
+    "WHERE chat_session_id = :chat"
+)
+
+
+def canonicalize(conn, batch=50000, dry_run=False, log=print):
+    """Move stray messages to their canonical chat_session_id; returns the number of rows moved"""
+    pairs = conn.execute(STALE_IDS).fetchall()
+    if not pairs:
+        log("✅ Every message is already under its conversation's canonical id")
+        return 0
+    moved = 0
+    for stale_id, canonical_id in pairs:
+        if dry_run:
+            count = conn.execute(text("SELECT COUNT(*) FROM messages WHERE chat_session_id = :stale"),
+                                 {'stale': stale_id}).scalar()
+            log(f"  {stale_id} -> {canonical_id}: {count} messages")
+            moved += count
+            continue
+        pair_moved = 0
+        while True:
+            rows = conn.execute(MOVE_BATCH, {'canonical': canonical_id, 'stale': stale_id, 'batch': batch}).rowcount
+            conn.commit()
+            pair_moved += rows
+            if rows < batch:
+                break
+        conn.execute(RECOUNT_SUMMARIES, {'chat': canonical_id})
+        conn.commit()
+        log(f"  {stale_id} -> {canonical_id}: moved {pair_moved} messages")
+        moved += pair_moved
+    log(f"{'🔎 Would move' if dry_run else '✅ Moved'} {moved} messages in {len(pairs)} conversations")
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move messages to their conversation's canonical chat_session_id")
+    parser.add_argument('--batch', type=int, default=50000, help="rows per UPDATE (one transaction each)")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would move")
+    args = parser.parse_args()
+
+    engine = create_engine(get_database_url())
+    with engine.connect() as conn:
+        canonicalize(conn, batch=args.batch, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+One-off data migration: create the conversation_summaries rows for
+friendships that predate the table.
+
+Friend-request acceptance writes both summary rows of a new conversation, so
+only friendships made before conversation_summaries existed are missing
+theirs. Without a row the conversation drops out of the chat list. This
+script inserts one row per friendship direction, filled from the
+conversation's latest message and its unread count.
+
+It used to run on every boot as part of _SCHEMA_UPGRADES, which scanned
+friendships and messages on each start. Run it once after deploying, after
+migrate_chat_sessions.py so the last message is read from the canonical id;
+reruns insert nothing.
+
+    DATABASE_URL=... python migrate_conversation_summaries.py [--dry-run]
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import create_engine, text
+
+from message_partitions import get_database_url
+
+# Each friendship direction with its conversation's canonical chat id
+CANONICAL_CHATS = (
+    "SELECT f2.id AS fid, COALESCE(cs.id, f2.chat_session_id) AS chat_id FROM friendships f2 "
+    "LEFT JOIN chat_sessions cs ON (cs.user1_id = f2.user_id AND cs.user2_id = f2.friend_id) "
+    "OR (cs.user1_id = f2.friend_id AND cs.user2_id = f2.user_id)"
+)
+
+MISSING = (
+    "FROM friendships f "
+    f"JOIN ({CANONICAL_CHATS}) c ON c.fid = f.id "
+    "LEFT JOIN messages m ON m.id = (SELECT MAX(x.id) FROM messages x WHERE x.chat_session_id = c.chat_id) "
+    "WHERE NOT EXISTS (SELECT 1 FROM conversation_summaries s WHERE s.user_id = f.user_id AND s.chat_session_id = c.chat_id)"
+)
+
+COUNT_MISSING = text(f"SELECT COUNT(*) {MISSING}")
+
+BACKFILL_SUMMARIES = text(
+    "INSERT INTO conversation_summaries (user_id, chat_session_id, friend_id, last_message_id, last_sender_id, "
+    "last_preview, last_message_type, last_message_at, unread_count) "
+    "SELECT f.user_id, c.chat_id, f.friend_id, m.id, m.sender_id, SUBSTR(m.content, 1, 100), m.message_type, "
+    "COALESCE(m.timestamp, f.last_message_at, f.created_at, CURRENT_TIMESTAMP), "
+    "(SELECT COUNT(*) FROM messages u WHERE u.chat_session_id = c.chat_id AND u.receiver_id = f.user_id AND u.is_read = false) "
+    f"{MISSING}"
+)
+
+
+def backfill(conn, dry_run=False, log=print):
+    """Insert the missing conversation_summaries rows; returns the number of rows inserted"""
+    if dry_run:
+        missing = conn.execute(COUNT_MISSING).scalar()
+        log(f"🔎 Would create {missing} conversation summaries")
+        return missing
+    created = conn.execute(BACKFILL_SUMMARIES).rowcount
+    conn.commit()
+    if created:
+        log(f"✅ Created {created} conversation summaries")
+    else:
+        log("✅ Every friendship already has its conversation summary")
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create conversation_summaries rows for existing friendships")
+    parser.add_argument('--dry-run', action='store_true', help="only report how many rows are missing")
+    args = parser.parse_args()
+
+    engine = create_engine(get_database_url())
+    with engine.connect() as conn:
+        backfill(conn, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Background Web Push delivery.
+
+send_direct_message used to call pywebpush.webpush() inline for every
+subscription of the receiver, so a slow push service held up the sender's
+request. PushDispatcher takes jobs off the request path:
+
+    - a bounded queue drained by a fixed pool of worker threads
+    - a per-request timeout on every push endpoint
+    - exponential backoff (with jitter) for timeouts, 429 and 5xx
+    - an on_expired callback for 404/410 so dead subscriptions get deleted
+    - counters plus queue depth and send latency for /api/debug/stats
+    - optional fan-out: submit_user() defers the subscription lookup to a
+      worker, so the request path does not even run that SELECT
+
+app.py passes in the send and on_expired (and optional resolve) callables;
+test_push_dispatch.py drives it against a local fake push service.
+"""
+
+import heapq
+import random
+import threading
+import time
+import queue
+from collections import deque
+
+# Push services answer these for subscriptions that will never work again
+EXPIRED_STATUSES = (404, 410)
+# Worth another attempt later
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PushJob:
+    __slots__ = ('endpoint', 'keys', 'payload', 'attempt', 'user_id')
+
+    def __init__(self, endpoint, keys, payload, attempt=0, user_id=None):
+        self.endpoint = endpoint
+        self.keys = keys
+        self.payload = payload
+        self.attempt = attempt
+        self.user_id = user_id
+
+    def subscription_info(self):
+        return {'endpoint': self.endpoint, 'keys': self.keys}
+
+
+def response_status(exc):
+    """HTTP status carried by a WebPushException (None for network errors)"""
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class PushDispatcher:
+    """send(job, timeout) must raise on failure; exceptions with a .response
+    (WebPushException, requests.HTTPError) are classified by status code,
+    anything else is treated as a transient network error."""
+
+    def __init__(self, send, on_expired=None, resolve=None, workers=4, max_queue=1000,
+                 timeout=5.0, max_retries=4, backoff_base=0.5, backoff_max=30.0):
+        self._send = send
+        self._on_expired = on_expired
+        self._resolve = resolve
+        self.workers = workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._ready = queue.Queue(maxsize=max_queue)
+        self._delayed = []  # heap of (due, seq, job)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._stopped = False
+        self._in_flight = 0
+        self._latencies = deque(maxlen=500)
+        self._lock = threading.Lock()
+        self.counters = {'queued': 0, 'sent': 0, 'retried': 0, 'expired': 0, 'failed': 0, 'dropped': 0}
+
+    def submit(self, endpoint, keys, payload):
+        """Queue one push; returns False if the queue is full (the push is dropped)"""
+        return self._enqueue(PushJob(endpoint, keys, payload))
+
+    def submit_user(self, user_id, payload):
+        """Queue a push to every subscription of user_id; resolve(user_id) runs on a worker"""
+        return self._enqueue(PushJob(None, None, payload, user_id=user_id))
+
+    def _enqueue(self, job):
+        self._ensure_started()
+        try:
+            self._ready.put_nowait(job)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        if job.endpoint is not None:
+            self._count('queued')
+        return True
+
+    def _fan_out(self, job):
+        try:
+            targets = self._resolve(job.user_id)
+        except Exception as e:
+            print(f"Push subscription lookup failed for user {job.user_id}: {e}")
+            return
+        for endpoint, keys in targets:
+            self._enqueue(PushJob(endpoint, keys, job.payload))
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._started or self._stopped:
+                return
+            self._started = True
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, name=f'push-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._schedule, name='push-retry', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _work(self):
+        while True:
+            job = self._ready.get()
+            if job is None:
+                return
+            with self._lock:
+                self._in_flight += 1
+            try:
+                if job.endpoint is None:
+                    self._fan_out(job)
+                else:
+                    self._deliver(job)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._ready.task_done()
+
+    def _deliver(self, job):
+        started = time.monotonic()
+        try:
+            self._send(job, self.timeout)
+        except Exception as e:
+            status = response_status(e)
+            if status in EXPIRED_STATUSES:
+                self._count('expired')
+                if self._on_expired:
+                    try:
+                        self._on_expired(job.endpoint)
+                    except Exception as cb_err:
+                        print(f"Push subscription cleanup failed: {cb_err}")
+                return
+            if (status is None or status in RETRY_STATUSES) and job.attempt < self.max_retries:
+                self._retry_later(job)
+                return
+            self._count('failed')
+            print(f"WebPush failed ({status or type(e).__name__}) after {job.attempt + 1} attempt(s)")
+            return
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+            self.counters['sent'] += 1
+
+    def _retry_later(self, job):
+        job.attempt += 1
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (job.attempt - 1)))
+        delay *= random.uniform(0.5, 1.0)
+        self._count('retried')
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, self._seq, job))
+            self._cond.notify()
+
+    def _schedule(self):
+        """Move retries whose backoff has elapsed back onto the ready queue"""
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._delayed and self._delayed[0][0] <= now:
+                        break
+                    self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+                if self._stopped:
+                    return
+                _, _, job = heapq.heappop(self._delayed)
+            try:
+                self._ready.put(job, timeout=self.timeout)
+            except queue.Full:
+                self._count('dropped')
+
+    def join(self, timeout=None):
+        """Wait until nothing is queued, delayed or in flight (used by tests)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                delayed = len(self._delayed)
+            with self._lock:
+                busy = self._in_flight
+            if not delayed and not busy and self._ready.empty():
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for _ in range(self.workers):
+            try:
+                self._ready.put_nowait(None)
+            except queue.Full:
+                break
+
+    def stats(self):
+        with self._cond:
+            delayed = len(self._delayed)
+        with self._lock:
+            latencies = sorted(self._latencies)
+            out = dict(self.counters)
+            out['in_flight'] = self._in_flight
+        out['queue_depth'] = self._ready.qsize()
+        out['retry_pending'] = delayed
+        out['workers'] = self.workers
+        if latencies:
+            out['latency_ms'] = {
+                'avg': round(1000 * sum(latencies) / len(latencies), 1),
+                'p50': round(1000 * latencies[len(latencies) // 2], 1),
+                'p95': round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+                'max': round(1000 * latencies[-1], 1)
+            }
+        return out
@@ -23,6 +23,10 @@ const STATIC_FILES = [
 // Version check endpoint
 const VERSION_CHECK_URL = '/api/pwa/version';
 
+// Delta sync endpoint, and where the per-conversation cursors are kept between runs
+const SYNC_URL = '/api/sync';
+const SYNC_STATE_URL = '/__sync-state';
+
 // Install event - cache static files
 self.addEventListener('install', (event) => {
   console.log('Service Worker installing...');
@@ -291,6 +295,7 @@ async function doBackgroundSync() {
   try {
     // Sync any pending data when connection is restored
     console.log('Background sync triggered');
+    await syncConversations();
     // Check for updates during background sync
     await checkForUpdates();
   } catch (error) {
@@ -298,6 +303,66 @@ async function doBackgroundSync() {
   }
 }
 
+// Cursors ({chat_session_id: last seen message id}) live in the dynamic cache
+async function loadSyncState() {
+  const cached = await caches.match(SYNC_STATE_URL);
+  return cached ? cached.json() : {};
+}
+
+async function saveSyncState(cursors) {
+  const cache = await caches.open(DYNAMIC_CACHE);
+  await cache.put(SYNC_STATE_URL, new Response(JSON.stringify(cursors), {
+    headers: { 'Content-Type': 'application/json' }
+  }));
+}
+
+// Catch up every conversation in one round trip and hand the result to open pages.
+// Concurrent callers (online event, background sync, several tabs) share one request.
+let syncInFlight = null;
+
+function syncConversations() {
+  if (!syncInFlight) {
+    syncInFlight = runSync().finally(() => {
+      syncInFlight = null;
+    });
+  }
+  return syncInFlight;
+}
+
+async function runSync() {
+  const cursors = await loadSyncState();
+  const response = await fetch(SYNC_URL, {
+    method: 'POST',
+    credentials: 'same-origin',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ cursors })
+  });
+  if (!response.ok) {
+    throw new Error('Sync failed: ' + response.status);
+  }
+  const data = await response.json();
+
+  const next = {};
+  Object.entries(data.conversations || {}).forEach(([chatId, conv]) => {
+    if (conv.messages && conv.messages.length) {
+      // has_more: the next sync continues from the last message delivered
+      next[chatId] = conv.messages[conv.messages.length - 1].id;
+    } else if (chatId in cursors) {
+      next[chatId] = cursors[chatId];
+    } else {
+      // First time we see this conversation: the page already shows its history
+      next[chatId] = conv.last_message_id || 0;
+    }
+  });
+  await saveSyncState(next);
+
+  const clients = await self.clients.matchAll({ type: 'window' });
+  clients.forEach(client => {
+    client.postMessage({ type: 'SYNC_RESULT', data });
+  });
+  return data;
+}
+
 // Handle message events from main thread
 self.addEventListener('message', (event) => {
   if (event.data && event.data.type === 'SKIP_WAITING') {
@@ -307,6 +372,15 @@ self.addEventListener('message', (event) => {
   if (event.data && event.data.type === 'CHECK_UPDATE') {
     event.waitUntil(checkForUpdates());
   }
+
+  if (event.data && event.data.type === 'SYNC_NOW') {
+    event.waitUntil(syncConversations().catch((error) => {
+      console.error('Sync failed:', error);
+      if (event.source) {
+        event.source.postMessage({ type: 'SYNC_FAILED' });
+      }
+    }));
+  }
 });
 
 // Periodic update checks (every 30 minutes)
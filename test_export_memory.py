@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Export Memory Test
+Seeds a chat with 1M messages (once; reruns reuse it) and streams
+/api/export/chat/<id> through the app in-process, plain and gzipped,
+sampling this process's RSS as chunks arrive. Passes if RSS stays flat
+after the first chunks and every row comes through.
+
+Point DATABASE_URL at a scratch Postgres database:
+    DATABASE_URL=postgresql+psycopg://user:pw@localhost/scratch?sslmode=disable python test_export_memory.py [rows]
+"""
+
+import os
+import sys
+import time
+import zlib
+
+os.environ.setdefault('SESSION_COOKIE_SECURE', '0')
+if not os.environ.get('DATABASE_URL'):
+    raise SystemExit("❌ Set DATABASE_URL to a scratch database")
+
+from sqlalchemy import text
+
+import app as appmod
+
+app, db = appmod.app, appmod.db
+# Allowed RSS growth between the first 5% of the export and the end
+MAX_GROWTH_MB = 20
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def seed(rows):
+    """Two friends with `rows` messages between them; returns (user_id, friend_id)"""
+    ids = []
+    for name in ('export_a', 'export_b'):
+        user = appmod.User.query.filter_by(username=name).first()
+        if not user:
+            user = appmod.User(username=name, password_hash='!')
+            db.session.add(user)
+            db.session.flush()
+        ids.append(user.id)
+    a, b = ids
+    link = appmod.get_friend_link(a, b)
+    if not link:
+        f1 = appmod.Friendship(user_id=a, friend_id=b)
+        f2 = appmod.Friendship(user_id=b, friend_id=a)
+        db.session.add_all([f1, f2])
+        db.session.flush()
+        db.session.add(appmod.ChatSession(id=f1.chat_session_id, user1_id=a, user2_id=b))
+        for uid, fid in ((a, b), (b, a)):
+            db.session.add(appmod.ConversationSummary(user_id=uid, chat_session_id=f1.chat_session_id, friend_id=fid))
+        db.session.commit()
+        appmod.friendship_index.invalidate(a, b)
+        link = appmod.get_friend_link(a, b)
+    have = appmod.Message.query.filter_by(chat_session_id=link.chat_session_id).count()
+    if have < rows:
+        print(f"🌱 Seeding {rows - have:,} messages...")
+        db.session.execute(text(
+            "INSERT INTO messages (chat_session_id, sender_id, receiver_id, content, content_hash, message_type, "
+            "is_read, timestamp, encryption_version) "
+            "SELECT :chat, CASE WHEN g % 2 = 0 THEN :a ELSE :b END, CASE WHEN g % 2 = 0 THEN :b ELSE :a END, "
+            "'export test message number ' || g || ' with a bit of padding text', md5(g::text), 'text', true, "
+            "now() AT TIME ZONE 'utc' - make_interval(secs => :n - g), 'v1' FROM generate_series(1, :n) g"),
+            {'chat': link.chat_session_id, 'a': a, 'b': b, 'n': rows - have})
+        db.session.commit()
+    db.session.remove()
+    return a, b
+
+
+def run_export(client, friend_id, rows, use_gzip):
+    resp = client.get(f"/api/export/chat/{friend_id}" + ('?gzip=1' if use_gzip else ''), buffered=False)
+    decompressor = zlib.decompressobj(31) if use_gzip else None
+    lines = received = 0
+    baseline = peak = None
+    started = time.monotonic()
+    for chunk in resp.response:
+        received += len(chunk)
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        lines += chunk.count(b'\n')
+        if baseline is None and lines >= rows // 20:
+            baseline = peak = rss_mb()
+        elif baseline is not None:
+            peak = max(peak, rss_mb())
+    resp.close()
+    return lines, received, baseline, peak, time.monotonic() - started
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("🚀 Export Memory Test")
+    print("=" * 50)
+    with app.app_context():
+        me, friend = seed(rows)
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = me
+        s['username'] = 'export_a'
+
+    results = []
+    for use_gzip in (False, True):
+        lines, received, baseline, peak, elapsed = run_export(client, friend, rows, use_gzip)
+        label = 'gzip' if use_gzip else 'plain'
+        ok = lines >= rows + 1
+        print(f"{'✅' if ok else '❌'} {label}: {lines - 1:,} messages, {received / 1e6:.1f} MB in {elapsed:.1f} s")
+        results.append(ok)
+        growth = peak - baseline
+        ok = growth <= MAX_GROWTH_MB
+        print(f"{'✅' if ok else '❌'} {label}: RSS {baseline:.1f} MB -> peak {peak:.1f} MB (+{growth:.1f} MB, budget {MAX_GROWTH_MB})")
+        results.append(ok)
+
+    print("\n" + "=" * 50)
+    print("🎯 All passed" if all(results) else "❌ Some checks failed")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
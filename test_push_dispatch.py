@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Push Dispatcher Test Script
+Runs PushDispatcher with real pywebpush encryption against a local fake push
+service and checks delivery, retry with backoff, expired-subscription
+pruning, per-endpoint timeouts and that submit() never blocks the caller.
+"""
+
+import base64
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid02
+from pywebpush import webpush
+
+from push_dispatcher import PushDispatcher
+
+hits = {}
+hits_lock = threading.Lock()
+
+
+class FakePushService(BaseHTTPRequestHandler):
+    """/ok -> 201, /gone -> 410, /flaky -> 503 twice then 201, /slow -> hangs, /bad -> 400"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        name = self.path.strip('/')
+        with hits_lock:
+            hits[name] = hits.get(name, 0) + 1
+            count = hits[name]
+        if name == 'slow':
+            time.sleep(3)
+            status = 201
+        elif name == 'gone':
+            status = 410
+        elif name == 'bad':
+            status = 400
+        elif name == 'flaky' and count <= 2:
+            status = 503
+        else:
+            status = 201
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def b64(raw):
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def subscriber_keys():
+    key = ec.generate_private_key(ec.SECP256R1())
+    point = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {'p256dh': b64(point), 'auth': b64(os.urandom(16))}
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakePushService)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    vapid = Vapid02()
+    vapid.generate_keys()
+    expired = []
+
+    def send(job, timeout):
+        webpush(subscription_info=job.subscription_info(), data=job.payload,
+                vapid_private_key=vapid, vapid_claims={'sub': 'mailto:test@example.com'}, timeout=timeout)
+
+    dispatcher = PushDispatcher(send, on_expired=expired.append, workers=4, timeout=1.0,
+                                max_retries=3, backoff_base=0.1)
+
+    print("🚀 Push Dispatcher Test")
+    print("=" * 50)
+    results = []
+
+    started = time.monotonic()
+    for name in ('ok', 'gone', 'flaky', 'slow', 'bad'):
+        dispatcher.submit(f"{base}/{name}", subscriber_keys(), '{"title": "test"}')
+    submit_ms = (time.monotonic() - started) * 1000
+    ok = submit_ms < 100
+    print(f"{'✅' if ok else '❌'} submit() returned in {submit_ms:.1f} ms")
+    results.append(ok)
+
+    dispatcher.join(timeout=30)
+    stats = dispatcher.stats()
+
+    ok = hits.get('ok') == 1
+    print(f"{'✅' if ok else '❌'} Delivered to healthy endpoint (hits={hits.get('ok')})")
+    results.append(ok)
+
+    ok = expired == [f"{base}/gone"] and hits.get('gone') == 1
+    print(f"{'✅' if ok else '❌'} 410 endpoint pruned without retry (expired={expired})")
+    results.append(ok)
+
+    ok = hits.get('flaky') == 3
+    print(f"{'✅' if ok else '❌'} 503 retried with backoff until success (hits={hits.get('flaky')})")
+    results.append(ok)
+
+    ok = hits.get('slow') == 4
+    print(f"{'✅' if ok else '❌'} Timed-out endpoint retried then abandoned (hits={hits.get('slow')})")
+    results.append(ok)
+
+    ok = hits.get('bad') == 1
+    print(f"{'✅' if ok else '❌'} 400 not retried (hits={hits.get('bad')})")
+    results.append(ok)
+
+    ok = stats['sent'] == 2 and stats['expired'] == 1 and stats['failed'] == 2 and stats['queue_depth'] == 0
+    print(f"{'✅' if ok else '❌'} Stats: {stats}")
+    results.append(ok)
+
+    dispatcher.stop()
+    server.shutdown()
+    print("\n" + "=" * 50)
+    print("🎯 All passed" if all(results) else "❌ Some checks failed")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
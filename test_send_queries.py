@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Send Path Query Budget Test
+Sends messages through /api/messages/send on a running instance and fails if
+the average number of SQL statements per send (from /api/debug/stats) goes
+over the budget. The streamlined path is: friendship lookup (usually served
+by the in-process pair index), INSERT ... RETURNING and one
+conversation_summaries UPDATE. Run it against an otherwise idle instance,
+otherwise other traffic is counted too.
+"""
+
+import sys
+
+import requests
+
+MAX_STATEMENTS_PER_SEND = 3
+
+
+def login(base_url, username, password):
+    s = requests.Session()
+    s.post(f"{base_url}/login", data={'username': username, 'password': password}, timeout=30)
+    if 'session' not in s.cookies:
+        raise SystemExit(f"❌ Login failed for {username}")
+    return s
+
+
+def query_count(base_url, s):
+    return s.get(f"{base_url}/api/debug/stats", timeout=30).json()['queries']
+
+
+def send(base_url, s, friend_id, content):
+    r = s.post(f"{base_url}/api/messages/send", json={'receiver_id': friend_id, 'content': content}, timeout=30)
+    r.raise_for_status()
+
+
+def main():
+    if len(sys.argv) < 5:
+        print("Usage: python test_send_queries.py <base_url> <username> <password> <friend_user_id> [sends]")
+        print("Example: python test_send_queries.py http://localhost:5050 alice secret 2 20")
+        sys.exit(1)
+
+    base_url = sys.argv[1].rstrip('/')
+    s = login(base_url, sys.argv[2], sys.argv[3])
+    friend_id = int(sys.argv[4])
+    sends = int(sys.argv[5]) if len(sys.argv) > 5 else 20
+
+    print("🚀 Send Path Query Budget Test")
+    print("=" * 50)
+    # Warm-up absorbs the once-a-minute presence write and any lazy setup
+    send(base_url, s, friend_id, "query budget warm-up")
+    before = query_count(base_url, s)
+    for i in range(sends):
+        send(base_url, s, friend_id, f"query budget {i + 1}/{sends}")
+    after = query_count(base_url, s)
+
+    per_send = (after - before) / sends
+    ok = per_send <= MAX_STATEMENTS_PER_SEND
+    print(f"{'✅' if ok else '❌'} {per_send:.2f} SQL statements per send (budget {MAX_STATEMENTS_PER_SEND})")
+    print("\n" + "=" * 50)
+    print("🎯 All passed" if ok else "❌ Query budget exceeded")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Typing WebSocket Test Script
+Drives two fake clients through /ws/typing/<chat_session_id> on a running
+instance: checks typing events are relayed to the other participant only,
+and that the hub drops subscribers when a connection goes away.
+"""
+
+import json
+import sys
+import time
+
+import requests
+from simple_websocket import Client, ConnectionClosed
+
+
+def login(base_url, username, password):
+    s = requests.Session()
+    s.post(f"{base_url}/login", data={'username': username, 'password': password}, timeout=30)
+    if 'session' not in s.cookies:
+        raise SystemExit(f"❌ Login failed for {username}")
+    return s
+
+
+def connect(base_url, s, chat_session_id):
+    ws_url = base_url.replace('http', 'ws', 1) + f"/ws/typing/{chat_session_id}"
+    cookie = '; '.join(f"{k}={v}" for k, v in s.cookies.items())
+    return Client.connect(ws_url, headers={'Cookie': cookie})
+
+
+def typing_subscribers(base_url, s):
+    return s.get(f"{base_url}/api/debug/stats", timeout=30).json().get('typing_subscribers')
+
+
+def receive_json(ws, timeout):
+    try:
+        raw = ws.receive(timeout=timeout)
+    except ConnectionClosed:
+        return None
+    return json.loads(raw) if raw else None
+
+
+def test_relay(base_url, alice, bob, chat_session_id):
+    """A typing event from one client reaches the other, not the sender"""
+    print("\n⌨️ Testing typing relay...")
+    ws_a = connect(base_url, alice, chat_session_id)
+    ws_b = connect(base_url, bob, chat_session_id)
+    try:
+        time.sleep(0.3)
+        ws_a.send(json.dumps({'type': 'typing', 'user_id': 999999}))
+        got_b = receive_json(ws_b, 3)
+        got_a = receive_json(ws_a, 0.5)
+        ok = bool(got_b) and got_b.get('type') == 'typing' and got_a is None
+        print(f"{'✅' if ok else '❌'} Relay: other={got_b} sender={got_a}")
+        spoofed = bool(got_b) and got_b.get('user_id') == 999999
+        print(f"{'❌' if spoofed else '✅'} user_id taken from session, not payload")
+        return ok and not spoofed
+    finally:
+        ws_a.close()
+        ws_b.close()
+
+
+def test_cleanup(base_url, alice, bob, chat_session_id):
+    """Dropped connections are removed from the hub"""
+    print("\n🧹 Testing subscriber cleanup...")
+    baseline = typing_subscribers(base_url, alice)
+    ws_a = connect(base_url, alice, chat_session_id)
+    ws_b = connect(base_url, bob, chat_session_id)
+    time.sleep(0.3)
+    connected = typing_subscribers(base_url, alice)
+    ws_a.close()
+    ws_b.close()
+    time.sleep(1.0)
+    after = typing_subscribers(base_url, alice)
+    ok = connected == baseline + 2 and after == baseline
+    print(f"{'✅' if ok else '❌'} Subscribers: before={baseline} connected={connected} after={after}")
+    return ok
+
+
+def main():
+    if len(sys.argv) != 7:
+        print("Usage: python test_typing_ws.py <base_url> <user_a> <pass_a> <user_b> <pass_b> <chat_session_id>")
+        print("Example: python test_typing_ws.py http://localhost:5050 alice secret bob secret 3f9a...")
+        sys.exit(1)
+
+    base_url = sys.argv[1].rstrip('/')
+    alice = login(base_url, sys.argv[2], sys.argv[3])
+    bob = login(base_url, sys.argv[4], sys.argv[5])
+    chat_session_id = sys.argv[6]
+
+    print("🚀 Typing WebSocket Test")
+    print("=" * 50)
+    results = [
+        test_relay(base_url, alice, bob, chat_session_id),
+        test_cleanup(base_url, alice, bob, chat_session_id),
+    ]
+    print("\n" + "=" * 50)
+    print("🎯 All passed" if all(results) else "❌ Some checks failed")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()